@@ -0,0 +1,63 @@
+"""
+Benchmark of the cold start of the Circle world data: parsing all the world files serially,
+parsing them in a pool of worker processes, and loading the parsed records from the world cache.
+
+Run it from the root of the source tree:  python benchmarks/circle_world_load.py
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "stories", "circle"))
+
+from tale.vfs import VirtualFileSystem
+from zones.circledata import parse_mob_files, parse_obj_files, parse_shp_files, parse_wld_files, parse_zon_files, world_cache
+from zones.circledata import parallel_parse
+
+
+def forget_world() -> None:
+    for parsed in (parse_mob_files._mobs, parse_obj_files._objs, parse_shp_files._shops, parse_wld_files._rooms, parse_zon_files._zones):
+        parsed.clear()
+
+
+def parse_world() -> None:
+    parse_mob_files.get_mobs()
+    parse_obj_files.get_objs()
+    parse_shp_files.get_shops()
+    parse_wld_files.get_rooms()
+    parse_zon_files.get_zones()
+
+
+def timed(title: str, function, *args, rounds: int=5) -> float:
+    best = None
+    for _ in range(rounds):
+        forget_world()
+        start = time.perf_counter()
+        function(*args)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    print("%-30s %.3f sec. (best of %d)" % (title, best, rounds))
+    return best
+
+
+def main() -> None:
+    user_resources = VirtualFileSystem(root_path=tempfile.mkdtemp(), readonly=False)
+    forget_world()
+    world_cache.load_world(user_resources)     # writes the cache
+    parsing = timed("parse the world files:", parse_world)
+    print("parsing in a process pool (%d cpus):" % os.cpu_count())
+    for workers in (2, 4, os.cpu_count()):
+        parallel = timed("  with %d worker processes:" % workers, parallel_parse.parse_world, None, workers)
+        print("  %.2fx the speed of serial parsing" % (parsing / parallel))
+    loading = timed("load the world cache:", world_cache.load_world, user_resources)
+    print("cache size: %d bytes, %.1fx faster" % (len(user_resources[world_cache.cache_filename].data), parsing / loading))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark of loading a savegame of the whole Circle world:
+the previous loader (one serpent literal for the whole game, converted to intermediate dicts
+and resolved via the objects finder of the IF driver) versus the streaming loader (one record per object,
+resolved via the vnum dictionaries while the records come in).
+
+Run it from the root of the source tree:  python benchmarks/savegame_load.py
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import datetime
+import io
+import os
+import sys
+import tempfile
+import time
+from typing import Union
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "stories", "circle"))
+
+from tale import base, driver, errors, mud_context, savegames, story, util
+from tale.player import Player
+from tale.vfs import VirtualFileSystem
+
+
+class SavegameExistingObjectsFinder:
+    """The objects finder that the IF driver used with the previous loader."""
+    def resolve_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.MudObject:
+        if baseclassname == "tale.base.Item":
+            return self.resolve_item_ref(vnum, name, classname, baseclassname)
+        elif baseclassname == "tale.base.Location":
+            return self.resolve_location_ref(vnum, name, classname, baseclassname)
+        elif baseclassname == "tale.base.Living":
+            return self.resolve_living_ref(vnum, name, classname, baseclassname)
+        else:
+            raise errors.TaleError("invalid base class for resolve_ref: " + baseclassname)
+
+    def resolve_location_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Location:
+        loc = base.MudObjRegistry.all_locations.get(vnum, None)
+        if not loc:
+            raise LookupError("location vnum not found: " + str(vnum))
+        if loc.name != name or savegames.qual_baseclassname(loc) != baseclassname:
+            raise errors.TaleError("location inconsistency for vnum " + str(vnum))
+        return loc
+
+    def resolve_living_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Living:
+        liv = base.MudObjRegistry.all_livings.get(vnum, None)
+        if not liv:
+            raise LookupError("living vnum not found: " + str(vnum))
+        if liv.name != name:
+            if savegames.qual_baseclassname(liv) != baseclassname:
+                if baseclassname == "tale.player.Player":
+                    return liv  # special case when the living is the Player
+                raise errors.TaleError("living inconsistency for vnum " + str(vnum))
+        return liv
+
+    def resolve_item_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Item:
+        item = base.MudObjRegistry.all_items.get(vnum, None)
+        if not item:
+            raise LookupError("item vnum not found: " + str(vnum))
+        if item.name != name or savegames.qual_baseclassname(item) != baseclassname:
+            raise errors.TaleError("item inconsistency for vnum " + str(vnum))
+        return item
+
+    def resolve_exit(self, vnum: int, name: str, classname: str, baseclassname: str) -> Union[base.Exit, base.Door]:
+        assert baseclassname == "tale.base.Exit"
+        exit = base.MudObjRegistry.all_exits[vnum]
+        if exit.name != name or savegames.qual_baseclassname(exit) != baseclassname:
+            raise errors.TaleError("exit/door inconsistency for vnum " + str(vnum))
+        return exit
+
+
+def create_world() -> Player:
+    game_driver = driver.Driver()
+    game_driver.game_clock = util.GameDateTime(datetime.datetime(2015, 5, 14, 14, 0, 0))
+    game_driver.moneyfmt = util.MoneyFormatter.create_for(story.MoneyType.FANTASY)
+    game_driver.user_resources = VirtualFileSystem(root_path=tempfile.mkdtemp(), readonly=False)
+    config = story.StoryConfig()
+    config.money_type = story.MoneyType.FANTASY
+    config.playable_races = {"human"}
+    mud_context.driver = game_driver
+    mud_context.config = config
+    from zones import init_zones
+    from zones.circledata.circle_locations import make_location
+    init_zones(game_driver)
+    player = Player("julie", "f")
+    make_location(3001).insert(player, None)
+    return player
+
+
+def all_objects():
+    locations = list(base.MudObjRegistry.all_locations.values())
+    items = [i for i in base.MudObjRegistry.all_items.values() if i.contained_in]
+    livings = [l for l in base.MudObjRegistry.all_livings.values() if l.location]
+    exits = list(base.MudObjRegistry.all_exits.values())
+    return items, livings, locations, exits
+
+
+def previous_loader(data: bytes) -> Player:
+    # this is how the IF driver used to load a savegame
+    deserializer = savegames.TaleDeserializer()
+    state = deserializer.deserialize(data)
+    finder = SavegameExistingObjectsFinder()
+    deserializer.recreate_classes(state.pop("clock"), None)
+    deserializer.recreate_classes(state.pop("story_config"), None)
+    deserializer.recreate_classes(list(sorted(state.pop("exits"), key=lambda d: d.get("vnum"))), finder)
+    items_info = deserializer.recreate_classes(list(sorted(state.pop("items"), key=lambda d: d.get("vnum"))), finder)
+    for item_info in items_info:
+        if item_info["contains"]:
+            item_info["item"].init_inventory({finder.resolve_item_ref(*ref) for ref in item_info["contains"]})
+    deserializer.recreate_classes(list(sorted(state.pop("locations"), key=lambda d: d.get("vnum"))), finder)
+    livings_info = deserializer.recreate_classes(list(sorted(state.pop("livings"), key=lambda d: d.get("vnum"))), finder)
+    for living_info in livings_info:
+        living = living_info["living"]
+        if living_info["inventory"]:
+            living.init_inventory({finder.resolve_item_ref(*ref) for ref in living_info["inventory"]})
+        loc = finder.resolve_location_ref(*living_info["location"])
+        if living.location and living.location is not loc:
+            living.location.remove(living, living)
+        loc.insert(living, living)
+    player_info = deserializer.recreate_classes(state.pop("player"), None)
+    player = player_info["player"]
+    base.MudObjRegistry.all_livings[player.vnum] = player
+    player.init_inventory({finder.resolve_item_ref(*ref) for ref in player_info["inventory"]})
+    loc = finder.resolve_location_ref(*player_info["location"])
+    if player.location and player.location is not loc:
+        player.location.remove(player, player)
+    loc.insert(player, player)
+    for living_info in livings_info:
+        if living_info["following"]:
+            living_info["living"].following = finder.resolve_living_ref(*living_info["following"])
+    return player
+
+
+def streaming_loader(data: bytes) -> Player:
+    return savegames.SavegameLoader().load(savegames.SavegameReader(data).records())
+
+
+def timed(name: str, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print("{:<40s} {:8.3f} sec".format(name, time.perf_counter() - start))
+    return result
+
+
+def main() -> None:
+    player = create_world()
+    items, livings, locations, exits = all_objects()
+    print("\nWorld: {} locations, {} items, {} livings, {} exits\n".format(len(locations), len(items), len(livings), len(exits)))
+    config, clock = mud_context.config, mud_context.driver.game_clock
+    old_data = timed("save (previous format)", savegames.TaleSerializer().serialize,
+                     config, player, items, livings, locations, exits, [], clock)
+    stream = io.BytesIO()
+    timed("save (streaming format)", savegames.SavegameWriter().write,
+          stream, config, player, items, livings, locations, exits, [], clock)
+    new_data = stream.getvalue()
+    print("savegame sizes: {} bytes (previous), {} bytes (streaming)\n".format(len(old_data), len(new_data)))
+    player = timed("load (previous loader)", previous_loader, old_data)
+    player.destroy(util.Context.from_global())
+    player = timed("load (streaming loader)", streaming_loader, new_data)
+    player.destroy(util.Context.from_global())
+
+
+if __name__ == "__main__":
+    main()
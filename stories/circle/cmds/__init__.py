@@ -6,6 +6,7 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
 from typing import Union, List
+import zones
 from zones import make_location, make_item, make_mob
 
 from tale import lang, util
@@ -88,3 +89,17 @@ def spawn_cvnum(player: Player, parsed: ParseResult, ctx: util.Context) -> None:
     else:
         player.tell("Spawned " + repr(mob) + " (into your current location)")
         mob.move(player.location, actor=player)
+
+
+@wizcmd("czones")
+def show_zones(player: Player, parsed: ParseResult, ctx: util.Context) -> None:
+    """Show the active circle zones, the zone resets, and how much of the tick budget the mob activity uses."""
+    active = sorted(zones.active_zones)
+    player.tell("Active zones (%d): %s" % (len(active), ", ".join(str(vnum) for vnum in active)), end=True)
+    player.tell("Zones with players: %s" % (", ".join(str(vnum) for vnum in sorted(zones.occupied_zones(ctx))) or "none"), end=True)
+    player.tell("Zone resets done: %d, in progress: %d" % (sum(zones.num_zone_resets.values()), len(zones.reset_queue)), end=True)
+    stats = zones.mob_activity.stats()
+    player.tell("Mob activity: %(npcs)d special mobs, %(runs)d runs in %(ticks)d ticks, %(asleep)d skipped while asleep, "
+                "%(carried_over)d carried over to a next tick (%(pending)d now)." % stats, end=True)
+    player.tell("Tick budget of %.1f ms: %.0f%% used on average, %.0f%% at most, exceeded %d times." % (
+        stats["budget"] * 1000, stats["budget_used_mean"] * 100, stats["budget_used_max"] * 100, stats["over_budget"]), end=True)
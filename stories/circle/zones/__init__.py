@@ -5,145 +5,269 @@ Package containing the zones of the game.
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
-from collections import deque
-from typing import MutableSequence, List
+import itertools
+import time
+import weakref
+from collections import deque, defaultdict, Counter
+from typing import MutableSequence, List, Dict, Iterator, Optional, Set, Tuple
+from tale import mud_context
+from tale.activity import ActivityScheduler
 from tale.driver import Driver
-from tale.base import Door, Container, Item
+from tale.base import Door, Container, Item, _limbo
 from tale.util import Context
-from .circledata.parse_zon_files import get_zones
-from .circledata.circle_mobs import make_mob, converted_mobs, mobs_with_special, MShopkeeper, init_circle_mobs
+from .circledata.parse_zon_files import get_zones, ZZone, ZMobile, ZObject
+from .circledata.world_cache import load_world
+from .circledata.circle_mobs import make_mob, converted_mobs, mobs_with_special, CircleMob, MShopkeeper, init_circle_mobs
 from .circledata.circle_locations import make_location, converted_rooms, make_shop, converted_shops, init_circle_locations
-from .circledata.circle_items import make_item, converted_items, unconverted_objs, init_circle_items
+from .circledata.circle_locations import active_zones, permanent_zones, deactivate_zone
+from .circledata.circle_items import make_item, converted_items, init_circle_items
+from .circledata import circle_locations
+
+
+# zones without players are deactivated after this many seconds (0 = zones stay active once they've been entered)
+zone_idle_time = 15 * 60.0
+
+shopkeeper_shops = {}   # type: Dict[int, int]   # mob vnum -> vnum of the shop it works for
+zone_last_visited = {}  # type: Dict[int, float]   # zone vnum -> last time it was seen with a player in it
+
+# zone resets
+zone_reset_batch = 50   # number of reset commands that pulse_zone executes at most
+zone_resets_due = {}    # type: Dict[int, float]   # zone vnum -> time of its next reset
+reset_queue = deque()   # type: MutableSequence[Tuple[ZZone, Iterator[Optional[str]]]]   # the zone resets in progress
+num_zone_resets = Counter()     # type: Dict[int, int]
+# the live mobs and items that the zone resets spawned, per circle vnum (to check the max_exist limits)
+live_mobs = defaultdict(weakref.WeakSet)    # type: Dict[int, weakref.WeakSet]
+live_items = defaultdict(weakref.WeakSet)   # type: Dict[int, weakref.WeakSet]
+
+# mob activity
+mob_activity_budget = 0.02   # seconds per server tick that the special behavior of mobs may use
+mob_activity = None          # type: ActivityScheduler   # created in init_zones
 
 
 def init_zones(driver: Driver) -> None:
-    """Populate the zones and initialize inventories and door states. Set up shops."""
+    """
+    Load the world data and set up the zone activation. The zones are activated (their rooms built,
+    their inventories and door states initialized) on demand, when the first of their rooms is needed.
+    """
     print("Initializing zones.")
+    if load_world(driver.user_resources):
+        print("World data loaded from the cache.")
     zones = get_zones()
     print(len(zones), "zones loaded.")
     init_circle_mobs()
     init_circle_items()
     all_shop_defs = init_circle_locations()
-    num_shops = num_mobs = num_items = 0
-    all_shopkeepers = {shop.shopkeeper for shop in all_shop_defs.values()}
-    for vnum in sorted(zones):
-        zone = zones[vnum]
-        for mobref in zone.mobs:
-            if mobref.vnum in all_shopkeepers:
-                # mob is a shopkeeper, we need to make a shop+shopkeeper rather than a regular mob
-                mob = make_mob(mobref.vnum, mob_class=MShopkeeper)
-                # find the shop it works for
-                shop_vnums = [vnum for vnum, shop in all_shop_defs.items() if shop.shopkeeper == mobref.vnum]
-                assert len(shop_vnums) == 1
-                shop_vnum = shop_vnums[0]
-                shopdata = make_shop(shop_vnum)
-                mob.shop = shopdata
-                num_shops += 1
-            else:
-                mob = make_mob(mobref.vnum)
-            inventory = []  # type: List[Item]
-            for wear_position, obj_ref in mobref.equip.items():
-                obj = make_item(obj_ref.vnum)
-                inventory.append(obj)    # @todo actually wield/wear the item! instead of putting it in the inventory
-                num_items += 1
-                if obj_ref.contains:
-                    items_in_equipped = []  # type: List[Item]
-                    for (c_vnum, c_max_exists) in obj_ref.contains:
-                        items_in_equipped.append(make_item(c_vnum))
-                    obj.init_inventory(items_in_equipped)
-                    num_items += len(items_in_equipped)
-            for obj_ref in mobref.inventory:
-                obj = make_item(obj_ref.vnum)
-                inventory.append(obj)
-                num_items += 1
-                if obj_ref.contains:
-                    items_in_carried = []  # type: List[Item]
-                    for (c_vnum, c_max_exists) in obj_ref.contains:
-                        items_in_carried.append(make_item(c_vnum))
-                    obj.init_inventory(items_in_carried)
-                    num_items += len(items_in_carried)
-            if inventory:
-                mob.init_inventory(inventory)
-                del inventory
-            if mobref.vnum in all_shopkeepers:
-                # if it is a shopkeeper, the shop.forsale items should also be present in his inventory
-                if mob.inventory_size < len(mob.shop.forsale):
-                    raise ValueError("shopkeeper %d's inventory missing some shop.forsale items from shop %d" %
-                                     (mobref.vnum, mob.shop.circle_vnum))
-                for item in mob.shop.forsale:
-                    if not any(i for i in mob.inventory if i.title == item.title):
-                        raise ValueError("shop.forsale item %d (%s) not in shopkeeper %d's inventory" %
-                                         (item.circle_vnum, item.title, mobref.vnum))
-            loc = make_location(mobref.room)
-            loc.insert(mob, None)
-            num_mobs += 1
-        for obj_ref in zone.objects:
-            obj = make_item(obj_ref.vnum)
-            loc = make_location(obj_ref.room)
-            loc.insert(obj, None)
-            if obj_ref.contains:
-                items_in_room_obj = []  # type: List[Item]
-                for vnum, max_exists in obj_ref.contains:
-                    items_in_room_obj.append(make_item(vnum))
-                obj.init_inventory(items_in_room_obj)
-                num_items += len(items_in_room_obj)
-            num_items += 1
-        for door_state in zone.doorstates:
-            loc = make_location(door_state.room)
-            try:
-                xt = loc.exits[door_state.exit]
-            except KeyError:
-                pass
+    shopkeeper_shops.clear()
+    for shop_vnum, shop in all_shop_defs.items():
+        assert shop.shopkeeper not in shopkeeper_shops
+        shopkeeper_shops[shop.shopkeeper] = shop_vnum
+    circle_locations.zone_populator = populate_zone
+    # set up the periodical pulse events
+    global mob_activity
+    tick_time = mud_context.config.server_tick_time
+    mob_activity = ActivityScheduler(_mob_activity, _mob_zone, period=10.0, tick_time=tick_time, budget=mob_activity_budget)
+    driver.defer((1.6, tick_time, tick_time), pulse_mobile)
+    driver.defer((4.5, 2.0, 2.0), pulse_zone)
+    if zone_idle_time > 0:
+        driver.defer((60.0, 60.0, 60.0), deactivate_idle_zones)
+
+
+def populate_zone(zone_vnum: int) -> None:
+    """
+    Spawn the mobs and items of a zone that was just activated, and initialize its door states.
+    This is the first reset of the zone, it is done completely right away. The next one is scheduled.
+    """
+    zone = get_zones().get(zone_vnum)
+    zone_last_visited[zone_vnum] = time.time()
+    if zone is None:
+        return    # rooms without zone definition
+    spawned = Counter(reset_commands(zone))
+    schedule_reset(zone)
+    _schedule_special_mobs()
+    print("Zone %d activated: spawned %d mobs, %d room items, %d shops. Now %d zones active with %d mob types, %d item types, %d rooms."
+          % (zone_vnum, spawned["mob"], spawned["item"], spawned["shop"], len(active_zones),
+             len(converted_mobs), len(converted_items), len(converted_rooms)))
+
+
+def schedule_reset(zone: ZZone) -> None:
+    if zone.resetmode != "never" and zone.lifespan_minutes > 0:
+        zone_resets_due[zone.vnum] = time.time() + zone.lifespan_minutes * 60.0
+
+
+def reset_commands(zone: ZZone) -> Iterator[Optional[str]]:
+    """
+    Replays the reset commands of the zone. Mobs and items are only spawned as long as there are less than the
+    max_exist of them (counted by their prototype's circle vnum). Yields after every command (what kind of thing
+    it spawned, or None), so that the reset can be spread over several pulses.
+    """
+    for room_vnum, obj_vnum in zone.removes:
+        loc = make_location(room_vnum)
+        for item in [item for item in loc.items if getattr(item, "circle_vnum", None) == obj_vnum]:
+            loc.remove(item, None)
+            item.destroy(None)
+        yield None
+    for mobref in zone.mobs:
+        if live_mob_count(mobref.vnum) < mobref.max_exist:
+            yield spawn_mob(mobref)
+        else:
+            yield None
+    for obj_ref in zone.objects:
+        if len(live_items[obj_ref.vnum]) < obj_ref.max_exist:
+            obj = spawn_item(obj_ref)
+            make_location(obj_ref.room).insert(obj, None)
+            yield "item"
+        else:
+            yield None
+    for door_state in zone.doorstates:
+        loc = make_location(door_state.room)
+        try:
+            xt = loc.exits[door_state.exit]
+        except KeyError:
+            pass
+        else:
+            if not isinstance(xt, Door):
+                raise TypeError("exit type not door, but asked to set state")
+            if door_state.state == "open":
+                xt.locked = False
+                xt.opened = True
+            elif door_state.state == "closed":
+                xt.locked = False
+                xt.opened = False
+            elif door_state.state == "locked":
+                xt.locked = True
+                xt.opened = False
             else:
-                if not isinstance(xt, Door):
-                    raise TypeError("exit type not door, but asked to set state")
-                if door_state.state == "open":
-                    xt.locked = False
-                    xt.opened = True
-                elif door_state.state == "closed":
-                    xt.locked = False
-                    xt.opened = False
-                elif door_state.state == "locked":
-                    xt.locked = True
-                    xt.opened = False
-                else:
-                    raise ValueError("invalid door state: " + door_state.state)
-
-    # create the handful of rooms that have no incoming paths (unreachable)
-    for vnum in (0, 3, 3055):
-        make_location(vnum)
-
-    print("Activated: %d mob types, %d item types, %d rooms, %d shop types" % (
-        len(converted_mobs), len(converted_items), len(converted_rooms), len(converted_shops)))
-    print("Spawned: %d mobs (%d specials), %d items, %d shops" % (num_mobs, len(mobs_with_special), num_items, num_shops))
-    print(len(unconverted_objs()), "unused item defs.")
-
-    # divide all the special mobs over the 5 mobs buckets (via their hash number)
-    # this prevents all 300+ special mobs doing something every 10 seconds at the same time
-    global _special_mobs_buckets
-    assert len(_special_mobs_buckets) == 5
+                raise ValueError("invalid door state: " + door_state.state)
+        yield None
+
+
+def live_mob_count(vnum: int) -> int:
+    # destroyed mobs may still be referenced somewhere, but they are in limbo
+    return sum(1 for mob in live_mobs[vnum] if mob.location is not _limbo)
+
+
+def spawn_mob(mobref: ZMobile) -> str:
+    """Spawns the mob with its equipment and inventory in its room. Returns what kind of mob it was (mob or shop)."""
+    kind = "mob"
+    if mobref.vnum in shopkeeper_shops:
+        # mob is a shopkeeper, we need to make a shop+shopkeeper rather than a regular mob
+        mob = make_mob(mobref.vnum, mob_class=MShopkeeper)
+        mob.shop = make_shop(shopkeeper_shops[mobref.vnum])
+        kind = "shop"
+    else:
+        mob = make_mob(mobref.vnum)
+    live_mobs[mobref.vnum].add(mob)
+    inventory = []  # type: List[Item]
+    for wear_position, obj_ref in mobref.equip.items():
+        if len(live_items[obj_ref.vnum]) < obj_ref.max_exist:
+            inventory.append(spawn_item(obj_ref))    # @todo actually wield/wear the item! instead of putting it in the inventory
+    for obj_ref in mobref.inventory:
+        if len(live_items[obj_ref.vnum]) < obj_ref.max_exist:
+            inventory.append(spawn_item(obj_ref))
+    if inventory:
+        mob.init_inventory(inventory)
+    if kind == "shop":
+        # if it is a shopkeeper, the shop.forsale items should also be present in his inventory
+        for item in mob.shop.forsale:
+            if not any(i for i in mob.inventory if i.title == item.title):
+                raise ValueError("shop.forsale item %d (%s) not in shopkeeper %d's inventory" %
+                                 (item.circle_vnum, item.title, mobref.vnum))
+    make_location(mobref.room).insert(mob, None)
+    return kind
+
+
+def spawn_item(obj_ref: ZObject) -> Item:
+    """Spawns the item and the items it contains (the caller puts it somewhere)."""
+    obj = make_item(obj_ref.vnum)
+    live_items[obj_ref.vnum].add(obj)
+    if obj_ref.contains:
+        contents = []  # type: List[Item]
+        for vnum, max_exists in obj_ref.contains:
+            if len(live_items[vnum]) < max_exists:
+                item = make_item(vnum)
+                live_items[vnum].add(item)
+                contents.append(item)
+        obj.init_inventory(contents)
+    return obj
+
+
+def deactivate_idle_zones(ctx: Context=None) -> None:
+    """
+    Called every minute to deactivate the zones where no player has been for a while (see zone_idle_time).
+    Everything in a deactivated zone is destroyed, it is spawned anew when a player enters the zone again.
+    """
+    now = time.time()
+    for zone_vnum in occupied_zones(ctx):
+        zone_last_visited[zone_vnum] = now
+    for zone_vnum in sorted(active_zones - permanent_zones):
+        if now - zone_last_visited.get(zone_vnum, 0.0) >= zone_idle_time:
+            destroyed = deactivate_zone(zone_vnum, ctx)
+            if destroyed:
+                for living in destroyed:
+                    live_mobs[getattr(living, "circle_vnum", 0)].discard(living)
+                    mob_activity.remove(living)
+            print("Zone %d deactivated (%d active)." % (zone_vnum, len(active_zones)))
+
+
+def occupied_zones(ctx: Context) -> Set[int]:
+    """The zones that have players in them."""
+    zones = {getattr(conn.player.location, "circle_zone", None) for conn in ctx.driver.all_players.values()}
+    zones.discard(None)
+    return zones
+
+
+def _schedule_special_mobs() -> None:
     for mob in mobs_with_special:
-        _special_mobs_buckets[(hash(mob) // 10) % 5].append(mob)
+        mob_activity.add(mob)
     mobs_with_special.clear()
-    # set up the periodical pulse events
-    mobile_timer = 10.0 / len(_special_mobs_buckets)
-    driver.defer((1.6, mobile_timer, mobile_timer), pulse_mobile)
-    driver.defer((4.5, 10.0, 10.0), pulse_zone)
 
 
-_special_mobs_buckets = deque([[], [], [], [], []])   # type: MutableSequence[list]
+def _mob_activity(mob: CircleMob, ctx: Context) -> None:
+    if mob.location is _limbo:
+        mob_activity.remove(mob)    # destroyed
+    else:
+        mob.do_special(ctx)
+
+
+def _mob_zone(mob: CircleMob) -> Optional[int]:
+    return getattr(mob.location, "circle_zone", None)
 
 
 def pulse_mobile(ctx: Context=None) -> None:
     """
-    Called every so often to handle mob activity (other than combat).
-    Via round robin scheduling every mob gets called once every 10 seconds, but not all at the same time.
+    Called every server tick to handle mob activity (other than combat).
+    The mob_activity scheduler gives every special mob its turn about once every 10 seconds, within the
+    mob_activity_budget of the tick. The mobs in zones without players sleep.
     """
-    for mob in _special_mobs_buckets[0]:
-        mob.do_special(ctx)
-    _special_mobs_buckets.rotate()
+    mob_activity.tick(ctx, occupied_zones(ctx))
 
 
 def pulse_zone(ctx: Context=None) -> None:
-    """Called every 10 seconds to handle zone activity"""
-    pass   # @todo zone pulse
+    """
+    Called every 2 seconds to handle zone activity: queue the resets of the zones whose lifespan has passed,
+    and run the next zone_reset_batch commands of the queued resets (so that many zones resetting
+    at the same time don't make a single server tick slow).
+    """
+    now = time.time()
+    occupied = occupied_zones(ctx)
+    zones = get_zones()
+    for zone_vnum, due in list(zone_resets_due.items()):
+        zone = zones[zone_vnum]
+        if zone_vnum not in active_zones:
+            del zone_resets_due[zone_vnum]
+        elif due <= now and not (zone.resetmode == "deserted" and zone_vnum in occupied):
+            del zone_resets_due[zone_vnum]
+            reset_queue.append((zone, reset_commands(zone)))
+    budget = zone_reset_batch
+    while reset_queue and budget > 0:
+        zone, commands = reset_queue[0]
+        if zone.vnum in active_zones:
+            budget -= sum(1 for _ in itertools.islice(commands, budget))
+            if budget > 0:
+                # the zone reset is complete
+                reset_queue.popleft()
+                schedule_reset(zone)
+                num_zone_resets[zone.vnum] += 1
+        else:
+            reset_queue.popleft()
+    _schedule_special_mobs()
@@ -52,9 +52,23 @@ circle_banks = {
 }
 
 
-@no_type_check
+# the prototype item per vnum. Instances are clones of it, that share its descriptive data.
+item_prototypes = {}   # type: Dict[int, Item]
+
+
 def make_item(vnum: int) -> Item:
     """Create an instance of an item for the given vnum"""
+    if vnum in circle_bulletin_boards or vnum in circle_banks:
+        return _make_item(vnum)     # these load their contents from a storage file
+    prototype = item_prototypes.get(vnum)
+    if prototype is None:
+        prototype = item_prototypes[vnum] = _make_item(vnum)
+        prototype.aliases = frozenset(prototype.aliases)
+    return prototype.clone()
+
+
+@no_type_check
+def _make_item(vnum: int) -> Item:
     c_obj = objs[vnum]
     aliases = list(c_obj.aliases)
     name = aliases[0]
@@ -5,9 +5,10 @@ It also builds the Shops (which are not strictly locations but are most natural
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import weakref
 from types import SimpleNamespace
-from typing import Dict
-from tale import mud_context, lang
+from typing import Callable, Dict, List, Optional, Set
+from tale import mud_context, lang, util
 from tale.base import Location, Living, ParseResult, Exit, Door
 from tale.errors import ActionRefused, LocationIntegrityError
 from tale.shop import ShopBehavior
@@ -17,17 +18,22 @@ from .circle_mobs import make_mob
 from .circle_items import make_item
 
 
-__all__ = ("converted_rooms", "converted_shops", "make_location", "make_exit", "make_shop", "init_circle_locations")
+__all__ = ("converted_rooms", "converted_shops", "make_location", "make_exit", "make_shop", "init_circle_locations",
+           "active_zones", "permanent_zones", "activate_zone", "deactivate_zone")
 
 
 rooms = {}  # type: Dict[int, SimpleNamespace]
 shops = {}   # type: Dict[int, SimpleNamespace]
+zone_rooms = {}   # type: Dict[int, List[int]]   # zone vnum -> vnums of the rooms in that zone
 
 
 def init_circle_locations() -> Dict[int, SimpleNamespace]:
     global rooms, shops
     rooms = get_rooms()
     print(len(rooms), "rooms loaded.")
+    zone_rooms.clear()
+    for vnum in sorted(rooms):
+        zone_rooms.setdefault(rooms[vnum].zone, []).append(vnum)
     shops = get_shops()
     print(len(shops), "shops loaded.")
     return shops   # zone init needs these
@@ -72,7 +78,7 @@ class PetShop(Location):
                         name = parsed.args[1].lower()
                         pet.title = "%s %s" % (pet.name, lang.capital(name))
                         pet.description += " A small sign on a chain around the neck says 'My name is %s'." % lang.capital(name)
-                        pet.aliases.add(pet.name)
+                        pet.aliases = pet.aliases | {pet.name}
                         pet.name = name
                     pet.following = actor   # @todo make pet charmed as well (see circle doc/src)
                     pet.is_pet = True
@@ -97,9 +103,38 @@ class Garbagedump(Location):
     # @todo trash cleanup
 
 
+class ZoneEntrance:
+    """
+    Mixin for an exit that leads into another zone. As long as that zone is not active, the exit's target is a
+    placeholder room (without exits, so mobs don't wander through it). Passing the exit activates the zone.
+    """
+    target_vnum = 0
+
+    def allow_passage(self, actor: Living) -> None:
+        super().allow_passage(actor)    # type: ignore
+        if self.target_vnum not in converted_rooms:
+            make_location(self.target_vnum)     # activates the zone, which binds this exit to the actual room
+
+
+class ZoneExit(ZoneEntrance, Exit):
+    pass
+
+
+class ZoneDoor(ZoneEntrance, Door):
+    pass
+
+
 # various caches, DO NOT CLEAR THESE, or duplicates might be spawned
+# (deactivate_zone removes the rooms of a zone after it has destroyed everything in them)
 converted_rooms = {}     # type: Dict[int, Location]
 converted_shops = {}     # type: Dict[int, ShopBehavior]
+placeholder_rooms = {}   # type: Dict[int, Location]   # targets of the zone entrances into zones that are not active
+zone_entrances = {}      # type: Dict[int, weakref.WeakSet]   # zone vnum -> the ZoneEntrance exits that lead into the zone
+
+active_zones = set()     # type: Set[int]   # zones whose rooms have been built
+permanent_zones = set()  # type: Set[int]   # zones that are never deactivated (the zone modules keep references to their rooms)
+# spawns the mobs and items of a zone that has just been activated (set by init_zones)
+zone_populator = None    # type: Optional[Callable[[int], None]]
 
 circle_donation_room = 3063    # items and gold donated by wizards end up here as help for newbies  @todo make donation room
 circle_pet_shops = {3031}      # special shops, they sell living creatures!
@@ -109,61 +144,128 @@ circle_dump_rooms = {3030}     # special rooms that are a garbage dump and destr
 def make_location(vnum: int) -> Location:
     """
     Get a Tale location object for the given circle room vnum.
-    This performs an on-demand conversion of the circle room data to Tale.
+    This performs an on-demand conversion of the circle room data to Tale:
+    the first room of a zone that is needed activates the whole zone (see activate_zone).
     """
-    # @todo deal with location type ('inside') and attributes ('nomob', 'dark', 'death'...)
     try:
         return converted_rooms[vnum]   # get cached version if available
     except KeyError:
-        c_room = rooms[vnum]
-        loc = None
-        if vnum in circle_dump_rooms or "death" in c_room.attributes:
-            loc = Garbagedump(c_room.name, c_room.desc)
-        elif vnum in circle_pet_shops:
-            loc = PetShop(c_room.name, c_room.desc)
-        else:
-            loc = Location(c_room.name, c_room.desc)
-        loc.circle_vnum = vnum   # keep the circle vnum
-        loc.circle_zone = c_room.zone    # keep the circle zone number
-        for ed in c_room.extradesc:
-            loc.add_extradesc(ed["keywords"], ed["text"])
-        converted_rooms[vnum] = loc
-        for circle_exit in c_room.exits.values():
-            if circle_exit.roomlink >= 0:
-                xt = make_exit(circle_exit)
-                while True:
-                    try:
-                        xt.bind(loc)
-                        break
-                    except LocationIntegrityError as x:
-                        if x.direction in xt.aliases:
-                            # circlemud exit keywords can be duplicated over various exits
-                            # if we have a conflict, just remove the alias from the exit and try again
-                            xt.aliases = xt.aliases - {x.direction}
-                            continue
+        activate_zone(rooms[vnum].zone)
+        return converted_rooms[vnum]
+
+
+def activate_zone(zone_vnum: int) -> None:
+    """
+    Builds all rooms of the zone and their exits, binds the entrances from other zones to them,
+    and lets the zone populator spawn the zone's mobs and items.
+    """
+    if zone_vnum in active_zones:
+        return
+    active_zones.add(zone_vnum)
+    locations = [_build_location(vnum) for vnum in zone_rooms[zone_vnum]]
+    for loc in locations:
+        _build_exits(loc)
+    for entrance in zone_entrances.get(zone_vnum, ()):
+        entrance.target = converted_rooms[entrance.target_vnum]
+    if zone_populator:
+        zone_populator(zone_vnum)
+
+
+def deactivate_zone(zone_vnum: int, ctx: Optional[util.Context]) -> List[Living]:
+    """
+    Destroys the rooms of the zone and everything in them (the caller must make sure no players are there).
+    The entrances from other zones get their placeholder targets back. Returns the livings that were destroyed.
+    """
+    if zone_vnum not in active_zones or zone_vnum in permanent_zones:
+        return []
+    active_zones.discard(zone_vnum)
+    for entrance in zone_entrances.get(zone_vnum, ()):
+        entrance.target = _placeholder_room(entrance.target_vnum)
+    destroyed = []  # type: List[Living]
+    for vnum in zone_rooms[zone_vnum]:
+        loc = converted_rooms.pop(vnum, None)
+        if loc:
+            destroyed.extend(loc.livings)
+            for living in list(loc.livings):
+                living.destroy(ctx)
+            for item in list(loc.items):
+                item.destroy(ctx)
+            loc.destroy(ctx)
+    return destroyed
+
+
+def _build_location(vnum: int) -> Location:
+    # @todo deal with location type ('inside') and attributes ('nomob', 'dark', 'death'...)
+    c_room = rooms[vnum]
+    loc = None
+    if vnum in circle_dump_rooms or "death" in c_room.attributes:
+        loc = Garbagedump(c_room.name, c_room.desc)
+    elif vnum in circle_pet_shops:
+        loc = PetShop(c_room.name, c_room.desc)
+    else:
+        loc = Location(c_room.name, c_room.desc)
+    loc.circle_vnum = vnum   # keep the circle vnum
+    loc.circle_zone = c_room.zone    # keep the circle zone number
+    for ed in c_room.extradesc:
+        loc.add_extradesc(ed["keywords"], ed["text"])
+    converted_rooms[vnum] = loc
+    return loc
+
+
+def _build_exits(loc: Location) -> None:
+    c_room = rooms[loc.circle_vnum]
+    for circle_exit in c_room.exits.values():
+        if circle_exit.roomlink >= 0:
+            xt = make_exit(circle_exit, c_room.zone)
+            while True:
+                try:
+                    xt.bind(loc)
+                    break
+                except LocationIntegrityError as x:
+                    if x.direction in xt.aliases:
+                        # circlemud exit keywords can be duplicated over various exits
+                        # if we have a conflict, just remove the alias from the exit and try again
+                        xt.aliases = xt.aliases - {x.direction}
+                        continue
+                    else:
+                        if loc.exits[x.direction] is xt:
+                            # this can occur, the exit is already bound
+                            break
                         else:
-                            if loc.exits[x.direction] is xt:
-                                # this can occur, the exit is already bound
-                                break
-                            else:
-                                # in this case a true integrity error occurred
-                                raise
-            else:
-                # add the description of the inaccessible exit to the room's own description.
-                loc.description += " " + circle_exit.desc
+                            # in this case a true integrity error occurred
+                            raise
+        else:
+            # add the description of the inaccessible exit to the room's own description.
+            loc.description += " " + circle_exit.desc
+
+
+def _placeholder_room(vnum: int) -> Location:
+    try:
+        return placeholder_rooms[vnum]
+    except KeyError:
+        c_room = rooms[vnum]
+        loc = placeholder_rooms[vnum] = Location(c_room.name)
+        loc.circle_vnum = vnum
+        loc.circle_zone = c_room.zone
         return loc
 
 
-def make_exit(c_exit: SimpleNamespace) -> Exit:
-    """Create an instance of a door or exit for the given circle exit"""
-    if c_exit.type in ("normal", "pickproof"):  # @todo other door types? reverse doors? locks/keys?
-        door = Door(c_exit.direction, make_location(c_exit.roomlink), c_exit.desc)
-        door.aliases |= c_exit.keywords
-        return door
+def make_exit(c_exit: SimpleNamespace, from_zone: int) -> Exit:
+    """
+    Create an instance of a door or exit for the given circle exit, that leaves a room in the given zone.
+    Exits into another zone are zone entrances, they don't activate that zone until someone passes them.
+    """
+    is_door = c_exit.type in ("normal", "pickproof")  # @todo other door types? reverse doors? locks/keys?
+    target_zone = rooms[c_exit.roomlink].zone
+    if target_zone == from_zone:
+        exit = (Door if is_door else Exit)(c_exit.direction, converted_rooms[c_exit.roomlink], c_exit.desc)
     else:
-        exit = Exit(c_exit.direction, make_location(c_exit.roomlink), c_exit.desc)
-        exit.aliases |= c_exit.keywords
-        return exit
+        target = converted_rooms.get(c_exit.roomlink) or _placeholder_room(c_exit.roomlink)
+        exit = (ZoneDoor if is_door else ZoneExit)(c_exit.direction, target, c_exit.desc)
+        exit.target_vnum = c_exit.roomlink
+        zone_entrances.setdefault(target_zone, weakref.WeakSet()).add(exit)
+    exit.aliases |= c_exit.keywords
+    return exit
 
 
 def make_shop(vnum: int) -> ShopBehavior:
@@ -7,6 +7,7 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 
 import re
 import random
+import weakref
 from types import SimpleNamespace
 from typing import Type, List, Set, Dict
 from tale.base import Living, Item
@@ -431,6 +432,8 @@ circle_mob_class = {
 # various caches, DO NOT CLEAR THESE, or duplicates might be spawned
 converted_mobs = set()   # type: Set[int]
 mobs_with_special = set()     # type: Set[CircleMob]
+# a mob per vnum whose descriptive data is shared by the other mobs of that vnum (as long as it exists)
+mob_prototypes = weakref.WeakValueDictionary()    # type: weakref.WeakValueDictionary[int, Living]
 
 
 def make_mob(vnum: int, mob_class: Type[CircleMob]=CircleMob) -> Living:
@@ -446,12 +449,18 @@ def make_mob(vnum: int, mob_class: Type[CircleMob]=CircleMob) -> Living:
     # for now, we take the stats from the 'human' race because the circle data lacks race and stats
     # @todo map circle mobs on races?
     mob_class = circle_mob_class.get(vnum, mob_class)
-    mob = mob_class(name, c_mob.gender, race="human", title=title, descr=c_mob.detaileddesc, short_descr=c_mob.longdesc)
+    prototype = mob_prototypes.get(vnum)
+    if prototype:
+        mob = mob_class(name, c_mob.gender, race="human", title=title)
+        mob.share_descriptions(prototype)
+    else:
+        mob = mob_class(name, c_mob.gender, race="human", title=title, descr=c_mob.detaileddesc, short_descr=c_mob.longdesc)
+        if hasattr(c_mob, "extradesc"):
+            for ed in c_mob.extradesc:
+                mob.add_extradesc(ed["keywords"], ed["text"])
+        mob.aliases = frozenset(aliases)
+        mob_prototypes[vnum] = mob
     mob.circle_vnum = vnum  # keep the vnum
-    if hasattr(c_mob, "extradesc"):
-        for ed in c_mob.extradesc:
-            mob.add_extradesc(ed["keywords"], ed["text"])
-    mob.aliases = aliases
     mob.aggressive = "aggressive" in c_mob.actions
     mob.money = float(c_mob.gold)
     mob.stats.alignment = c_mob.alignment
@@ -0,0 +1,67 @@
+"""
+Parses the CircleMUD world files in a pool of worker processes.
+
+The parse_file functions of the parse_*_files modules are pure functions from the text of a world file
+to its records, so the files can be parsed independently. The records are merged into the same
+dictionaries that get_mobs, get_objs, get_shops, get_rooms and get_zones return, in index file order.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from tale.vfs import VirtualFileSystem
+from . import parse_mob_files, parse_obj_files, parse_shp_files, parse_wld_files, parse_zon_files
+
+__all__ = ["parse_world"]
+
+
+# world file kind -> (parser module, dict with the parsed records, attribute with the record's vnum)
+world_kinds = {
+    "mob": (parse_mob_files, parse_mob_files._mobs, "circle_vnum"),
+    "obj": (parse_obj_files, parse_obj_files._objs, "circle_vnum"),
+    "shp": (parse_shp_files, parse_shp_files._shops, "circle_vnum"),
+    "wld": (parse_wld_files, parse_wld_files._rooms, "circle_vnum"),
+    "zon": (parse_zon_files, parse_zon_files._zones, "vnum")
+}
+
+
+def world_files(vfs: VirtualFileSystem) -> List[Tuple[str, str]]:
+    """The (kind, text) of all world files, in the order of their index files."""
+    files = []
+    for kind in world_kinds:
+        for filename in vfs["world/%s/index" % kind].text.splitlines():
+            if filename == "$":
+                break
+            files.append((kind, vfs["world/%s/%s" % (kind, filename)].text))
+    return files
+
+
+def parse_text(kind: str, text: str) -> List[Any]:
+    """Parses the text of a single world file (this runs in the worker processes)."""
+    parser = world_kinds[kind][0]
+    if kind == "zon":
+        return [parser.parse_file(text)]
+    return parser.parse_file(text.splitlines())
+
+
+def parse_world(vfs: VirtualFileSystem=None, workers: Optional[int]=None) -> Dict[str, int]:
+    """
+    Parses all world files that haven't been parsed yet, with the given number of worker processes
+    (None = the number of cpus, 0 = in this process). Returns the number of records per kind.
+    """
+    vfs = vfs or VirtualFileSystem(root_package="zones.circledata", everythingtext=True)
+    files = [(kind, text) for kind, text in world_files(vfs) if not world_kinds[kind][1]]
+    if files:
+        if workers == 0:
+            results = map(parse_text, *zip(*files))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(parse_text, *zip(*files)))
+        for (kind, _), records in zip(files, results):
+            parser, parsed, vnum_attribute = world_kinds[kind]
+            for record in records:
+                parsed[getattr(record, vnum_attribute)] = record
+    return {kind: len(parsed) for kind, (parser, parsed, vnum_attribute) in world_kinds.items()}
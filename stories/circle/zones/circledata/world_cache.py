@@ -0,0 +1,113 @@
+"""
+Cache of the parsed CircleMUD world data, so that the world files don't have to be parsed on every start.
+
+The parsed records of all mob, obj, shp, wld and zon files are pickled into a single file.
+It starts with a key that is computed from the names, sizes and modification times of the world files,
+a cache with a different key is outdated and ignored. The cache is looked for in the world directory
+(where the build step puts it: python -m zones.circledata.world_cache, run from the story's directory)
+and in the user data directory (where it is written at runtime if there was no valid cache).
+"""
+
+import hashlib
+import os
+import pickle
+import time
+from typing import Any, Dict, Optional
+
+from tale.vfs import VirtualFileSystem
+from . import parse_mob_files, parse_obj_files, parse_shp_files, parse_wld_files, parse_zon_files
+
+__all__ = ["load_world", "build_cache"]
+
+cache_version = 1     # increase when the parsers produce different records
+cache_filename = "world.cache"
+world_dir = os.path.join(os.path.dirname(__file__), "world")
+world_kinds = ("mob", "obj", "shp", "wld", "zon")
+prebuilt_cache = os.path.join(world_dir, cache_filename)
+
+
+def source_key() -> str:
+    """Digest of the names, sizes and modification times of all world files (raises OSError if they're not regular files)."""
+    digest = hashlib.sha1(("world cache %d\n" % cache_version).encode("ascii"))
+    for kind in world_kinds:
+        for entry in sorted(os.scandir(os.path.join(world_dir, kind)), key=lambda entry: entry.name):
+            stat = entry.stat()
+            digest.update(("%s/%s %d %d\n" % (kind, entry.name, stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _parsed_world() -> Dict[str, Any]:
+    return {
+        "mob": parse_mob_files.get_mobs(),
+        "obj": parse_obj_files.get_objs(),
+        "shp": parse_shp_files.get_shops(),
+        "wld": parse_wld_files.get_rooms(),
+        "zon": parse_zon_files.get_zones()
+    }
+
+
+def _dump(key: str) -> bytes:
+    return pickle.dumps(key, pickle.HIGHEST_PROTOCOL) + pickle.dumps(_parsed_world(), pickle.HIGHEST_PROTOCOL)
+
+
+def _load(data: bytes, key: str) -> bool:
+    try:
+        header_size = len(pickle.dumps(key, pickle.HIGHEST_PROTOCOL))
+        if pickle.loads(data[:header_size]) != key:
+            return False
+        world = pickle.loads(data[header_size:])
+    except Exception:
+        return False   # corrupt or written by another python version
+    parse_mob_files._mobs.update(world["mob"])
+    parse_obj_files._objs.update(world["obj"])
+    parse_shp_files._shops.update(world["shp"])
+    parse_wld_files._rooms.update(world["wld"])
+    parse_zon_files._zones.update(world["zon"])
+    return True
+
+
+def load_world(user_resources: Optional[VirtualFileSystem]=None) -> bool:
+    """
+    Makes the parsed world data available (to get_mobs, get_zones etc.) from the cache if possible,
+    otherwise by parsing the world files (and then the cache is written in the user_resources).
+    Returns True if the data came from the cache.
+    """
+    if parse_zon_files._zones:
+        return True     # already loaded
+    try:
+        key = source_key()
+    except OSError:
+        return False    # the world files aren't regular files (zipped story?), they will be parsed on demand
+    try:
+        with open(prebuilt_cache, "rb") as cachefile:
+            if _load(cachefile.read(), key):
+                return True
+    except OSError:
+        pass
+    if user_resources:
+        try:
+            if _load(user_resources[cache_filename].data, key):
+                return True
+        except (OSError, LookupError):
+            pass
+    data = _dump(key)
+    if user_resources:
+        try:
+            user_resources[cache_filename] = data
+        except OSError as x:
+            print("Can't write the world cache:", x)
+    return False
+
+
+def build_cache() -> str:
+    """Parses the world files and writes the cache in the world directory. Returns the path of the cache file."""
+    data = _dump(source_key())
+    with open(prebuilt_cache, "wb") as cachefile:
+        cachefile.write(data)
+    return prebuilt_cache
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    print("Cache written:", build_cache())
+    print("Parsing and writing took %.3f seconds." % (time.perf_counter() - start))
@@ -1,10 +1,12 @@
-from .circledata.circle_locations import make_location
+from .circledata.circle_locations import make_location, permanent_zones
 
 zone_vnum = 12   # god simplex
 boardroom_vnum = 1204    # start room for wizards
 icebox_vnum = 1202   # start room for frozen
 
 
+permanent_zones.add(zone_vnum)   # this module keeps references to its rooms
+
 boardroom = make_location(boardroom_vnum)
 
 icebox = make_location(icebox_vnum)
@@ -1,6 +1,8 @@
-from .circledata.circle_locations import make_location
+from .circledata.circle_locations import make_location, permanent_zones
 
 zone_vnum = 30   # midgaard city
 temple_vnum = 3001
 
+permanent_zones.add(zone_vnum)   # this module keeps references to its rooms
+
 temple = make_location(temple_vnum)
@@ -5,14 +5,22 @@ Player account code.
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import binascii
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
 import hashlib
+import hmac
+import os
 import random
 import re
 import sqlite3
+import threading
 import time
 import json
-from typing import Set, Tuple, List, Dict, Any, Optional
+from typing import Set, Tuple, List, Dict, Any, Optional, Iterator, Callable
 import serpent
 
 from . import base
@@ -51,22 +59,84 @@ class MudAccounts:
         account(name, email, pw_hash, pw_salt, created, logged_in, locked)
         privilege(account, privilege)
         charstat(account, gender, stat1, stat2,...)
+        storydata(account, format, data)
+
+    A single connection to the database is kept open (in WAL mode, so reading doesn't wait for writing),
+    and sqlite caches the prepared statements on it. The connection is shared by the threads that
+    use the accounts, one at a time.
+    The most recently used accounts are cached (and the list of all accounts, once it has been asked for).
+    Changes are written to the database right away, and remove the changed account from the cache.
+
+    Passwords are hashed with a key derivation function: pbkdf2 (default) or scrypt. The hash records the function and
+    its parameters, so the function can be changed later; a password is rehashed with the current one when its owner logs in.
+    (Hashes without this prefix are from older versions, they are a single round of sha1.)
+    Because hashing is slow on purpose, it can be done by a pool of worker threads (see submit) rather than by the driver.
     """
+    cached_statements = 64
+    cache_size = 200
+    kdf = "pbkdf2"
+    pbkdf2_iterations = 100000
+    scrypt_n, scrypt_r, scrypt_p = 2 ** 14, 8, 1
 
-    def __init__(self, databasefile: str) -> None:
+    def __init__(self, databasefile: str, kdf: str="", workers: int=0) -> None:
+        self.kdf = kdf or self.kdf
+        self.kdf_parameters(self.kdf)    # validates it
+        self.pool = None    # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        if workers > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(workers)
         self.sqlite_dbpath = databasefile
+        self.conn = None    # type: sqlite3.Connection
+        self.lock = threading.RLock()
+        self.cache = collections.OrderedDict()    # type: Dict[str, Account]  # in order of use, the least recently used first
+        self.cached_all_accounts = None           # type: Optional[List[Account]]
+        self.cache_hits = 0
+        self.cache_misses = 0
         self._create_database()
 
     def _sqlite_connect(self) -> sqlite3.Connection:
         urimode = self.sqlite_dbpath.startswith("file:")
-        conn = sqlite3.connect(self.sqlite_dbpath, detect_types=sqlite3.PARSE_DECLTYPES, timeout=5, uri=urimode)
+        conn = sqlite3.connect(self.sqlite_dbpath, detect_types=sqlite3.PARSE_DECLTYPES, timeout=5, uri=urimode,
+                               check_same_thread=False, cached_statements=self.cached_statements)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys=ON;")
+        conn.execute("PRAGMA journal_mode=WAL;")
         return conn
 
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Use the connection in a transaction (that is committed at the end, or rolled back on an exception)."""
+        with self.lock:
+            with self.conn:
+                yield self.conn
+
+    def close(self) -> None:
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def submit(self, function: Callable, *args: Any) -> concurrent.futures.Future:
+        """
+        Calls the function (such as check_password or create) in the worker pool, and returns its future.
+        In a dialog generator you can wait for it with: result = yield "wait", future.
+        Without worker threads, the function is called right away.
+        """
+        if self.pool:
+            return self.pool.submit(function, *args)
+        future = concurrent.futures.Future()   # type: concurrent.futures.Future
+        try:
+            future.set_result(function(*args))
+        except Exception as x:
+            future.set_exception(x)
+        return future
+
     def _create_database(self) -> None:
         try:
-            with self._sqlite_connect() as conn:
+            self.conn = self._sqlite_connect()
+            with self._transaction() as conn:
                 table_exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Account'").fetchone()
                 if not table_exists:
                     print("%s: Creating new user accounts database." % mud_context.config.name)
@@ -128,73 +198,172 @@ class MudAccounts:
             raise SystemExit("Cannot launch mud mode without a user accounts database.")
 
     def get(self, name: str) -> Account:
-        with self._sqlite_connect() as conn:
-            result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
-            if not result:
+        """
+        Get the account with the given name. It is a copy of the cached account, changing it doesn't change
+        the account in the database (use the methods of MudAccounts for that).
+        """
+        with self.lock:
+            account = self.cache.get(name)
+            if account:
+                self.cache_hits += 1
+                self.cache.move_to_end(name)
+                return copy.deepcopy(account)
+            self.cache_misses += 1
+            with self._transaction() as conn:
+                accounts = self._fetch_accounts(conn, "WHERE a.name=?", (name,))
+            if not accounts:
                 raise LookupError(name)
-            return self._fetch_account(conn, result["id"])
-
-    def _fetch_account(self, conn: sqlite3.Connection, account_id: int) -> Account:
-        acc = conn.execute("SELECT * FROM Account WHERE id=?", (account_id,)).fetchone()
-        priv_result = conn.execute("SELECT privilege FROM Privilege WHERE account=?", (account_id,)).fetchall()
-        privileges = {pr["privilege"] for pr in priv_result}
-        storydata_result = conn.execute("SELECT format, data FROM StoryData WHERE account=?", (account_id,)).fetchone()
-        if storydata_result:
-            if storydata_result["format"] == "json":
-                storydata = json.loads(storydata_result["data"], encoding="utf-8")
-            elif storydata_result["format"] == "serpent":
-                storydata = serpent.loads(storydata_result["data"])
+            self._cache(accounts[0])
+            return copy.deepcopy(accounts[0])
+
+    def _cache(self, account: Account) -> None:
+        self.cache[account.name] = account
+        self.cache.move_to_end(account.name)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _invalidate(self, name: str) -> None:
+        with self.lock:
+            self.cache.pop(name, None)
+            self.cached_all_accounts = None
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.cache),
+            "max_size": self.cache_size,
+            "hits": self.cache_hits,
+            "misses": self.cache_misses
+        }
+
+    # everything of an account in a single query; the CharStat columns come last and are turned into the stats
+    _account_query = """
+        SELECT a.id AS account_id, a.name, a.email, a.pw_hash, a.pw_salt, a.created, a.logged_in, a.banned,
+               (SELECT group_concat(p.privilege, ' ') FROM Privilege p WHERE p.account=a.id) AS privileges,
+               sd.format AS storydata_format, sd.data AS storydata,
+               c.*
+        FROM Account a LEFT JOIN CharStat c ON c.account=a.id LEFT JOIN StoryData sd ON sd.account=a.id
+        """
+    _account_query_columns = 11
+
+    def _fetch_accounts(self, conn: sqlite3.Connection, where: str, parameters: Tuple=()) -> List[Account]:
+        return [self._make_account(row) for row in conn.execute(self._account_query + where, parameters)]
+
+    def _make_account(self, row: sqlite3.Row) -> Account:
+        privileges = set(row["privileges"].split()) if row["privileges"] else set()
+        if row["storydata_format"]:
+            if row["storydata_format"] == "json":
+                storydata = json.loads(row["storydata"])
+            elif row["storydata_format"] == "serpent":
+                storydata = serpent.loads(row["storydata"])
             else:
-                raise ValueError("invalid storydata format in database: " + storydata_result["format"])
+                raise ValueError("invalid storydata format in database: " + row["storydata_format"])
             if not isinstance(storydata, dict):
                 raise TypeError("storydata should be a dict")
         else:
             storydata = {}
-        stats_result = dict(conn.execute("SELECT * FROM CharStat WHERE account=?", (account_id,)).fetchone() or {})
-        del stats_result["id"]
-        del stats_result["account"]
         stats = base.Stats()
-        for key, value in stats_result.items():
+        for key in row.keys()[self._account_query_columns:]:
+            if key in ("id", "account"):
+                continue
             if hasattr(stats, key):
-                setattr(stats, key, value)
+                setattr(stats, key, row[key])
             else:
                 raise AttributeError("stats doesn't have attribute: " + key)
         stats.set_stats_from_race()   # initialize static stats from races table
-        return Account(acc["name"], acc["email"], acc["pw_hash"], acc["pw_salt"], privileges,
-                       acc["created"], acc["logged_in"], bool(acc["banned"]), stats, storydata)
+        return Account(row["name"], row["email"], row["pw_hash"], row["pw_salt"], privileges,
+                       row["created"], row["logged_in"], bool(row["banned"]), stats, storydata)
 
     def all_accounts(self, having_privilege: str="") -> List[Account]:
-        with self._sqlite_connect() as conn:
-            if having_privilege:
-                result = conn.execute("SELECT a.id FROM Account a INNER JOIN Privilege p ON p.account=a.id AND p.privilege=? "
-                                      "ORDER BY a.name",  (having_privilege,)).fetchall()
+        """All accounts ordered by name (or only those with the given privilege). They are copies, see get."""
+        with self.lock:
+            accounts = self.cached_all_accounts
+            if accounts is None:
+                self.cache_misses += 1
+                with self._transaction() as conn:
+                    accounts = self.cached_all_accounts = self._fetch_accounts(conn, "ORDER BY a.name")
+                for account in accounts[:self.cache_size]:
+                    self.cache.setdefault(account.name, account)
             else:
-                result = conn.execute("SELECT id FROM Account ORDER BY name").fetchall()
-            account_ids = [ar["id"] for ar in result]
-            accounts = [self._fetch_account(conn, account_id) for account_id in account_ids]
-            return accounts
+                self.cache_hits += 1
+        if having_privilege:
+            accounts = [account for account in accounts if having_privilege in account.privileges]
+        return copy.deepcopy(accounts)
 
     def logged_in(self, name: str) -> None:
         timestamp = datetime.datetime.now().replace(microsecond=0)
-        with self._sqlite_connect() as conn:
+        with self._transaction() as conn:
+            self._invalidate(name)
             conn.execute("UPDATE Account SET logged_in=? WHERE name=?", (timestamp, name))
 
     def valid_password(self, name: str, password: str) -> None:
-        with self._sqlite_connect() as conn:
-            result = conn.execute("SELECT pw_hash, pw_salt FROM Account WHERE name=?", (name,)).fetchone()
-        if result:
-            stored_hash, stored_salt = result["pw_hash"], result["pw_salt"]
-            pwhash, _ = self._pwhash(password, stored_salt)
-            if pwhash == stored_hash:
-                return
-        raise ValueError("Invalid name or password.")
+        try:
+            account = self.get(name)
+        except LookupError:
+            raise ValueError("Invalid name or password.")
+        self.check_password(account, password)
 
-    @staticmethod
-    def _pwhash(password: str, salt: str="") -> Tuple[str, str]:
+    def check_password(self, account: Account, password: str) -> None:
+        """Like valid_password, but for an account that has already been fetched (so it doesn't need the database)."""
+        if not self._verify_pwhash(password, account.pw_hash, account.pw_salt):
+            raise ValueError("Invalid name or password.")
+
+    def needs_rehash(self, account: Account) -> bool:
+        """Is the password of the account hashed with something else than the current hashing function and parameters?"""
+        prefix = "$".join([self.kdf] + [str(p) for p in self.kdf_parameters(self.kdf)]) + "$"
+        return not account.pw_hash.startswith(prefix)
+
+    def rehash_password(self, name: str, password: str) -> None:
+        """Hash the (already verified) password again, with the current hashing function."""
+        pwhash, salt = self._pwhash(password, kdf=self.kdf)
+        with self._transaction() as conn:
+            self._invalidate(name)
+            conn.execute("UPDATE Account SET pw_hash=?, pw_salt=? WHERE name=?", (pwhash, salt, name))
+
+    @classmethod
+    def kdf_parameters(cls, kdf: str) -> Tuple[int, ...]:
+        if kdf == "pbkdf2":
+            return (cls.pbkdf2_iterations,)
+        elif kdf == "scrypt":
+            if not hasattr(hashlib, "scrypt"):
+                raise ValueError("scrypt password hashing is not available in this Python version")
+            return cls.scrypt_n, cls.scrypt_r, cls.scrypt_p
+        elif kdf == "sha1":
+            return ()
+        raise ValueError("invalid password hashing function: " + kdf)
+
+    @classmethod
+    def _pwhash(cls, password: str, salt: str="", kdf: str="") -> Tuple[str, str]:
+        """Returns (hash, salt) of the password, hashed with the given function (or the default one)."""
+        kdf = kdf or cls.kdf
+        if kdf == "sha1":
+            # the way passwords were hashed in older versions
+            if not salt:
+                salt = str(random.random() * time.time() + id(password)).replace('.', '')
+            return hashlib.sha1((salt + password).encode("utf-8")).hexdigest(), salt
         if not salt:
-            salt = str(random.random() * time.time() + id(password)).replace('.', '')
-        pwhash = hashlib.sha1((salt + password).encode("utf-8")).hexdigest()
-        return pwhash, salt
+            salt = binascii.hexlify(os.urandom(16)).decode("ascii")
+        return cls._derive_key(password, salt, kdf, cls.kdf_parameters(kdf)), salt
+
+    @staticmethod
+    def _derive_key(password: str, salt: str, kdf: str, parameters: Tuple[int, ...]) -> str:
+        if kdf == "pbkdf2":
+            key = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), parameters[0])
+        elif kdf == "scrypt":
+            n, r, p = parameters
+            key = hashlib.scrypt(password.encode("utf-8"), salt=salt.encode("utf-8"), n=n, r=r, p=p,   # type: ignore
+                                 maxmem=256 * n * r + 1024 * 1024, dklen=32)
+        else:
+            raise ValueError("invalid password hashing function: " + kdf)
+        return "$".join([kdf] + [str(p) for p in parameters] + [binascii.hexlify(key).decode("ascii")])
+
+    @classmethod
+    def _verify_pwhash(cls, password: str, pwhash: str, salt: str) -> bool:
+        if "$" in pwhash:
+            kdf, *parameters, _ = pwhash.split("$")
+            computed = cls._derive_key(password, salt, kdf, tuple(int(p) for p in parameters))
+        else:
+            computed, _ = cls._pwhash(password, salt, kdf="sha1")
+        return hmac.compare_digest(computed, pwhash)
 
     @staticmethod
     def accept_password(password: str) -> str:
@@ -236,8 +405,9 @@ class MudAccounts:
         for p in privileges:
             self.accept_privilege(p)
         created = datetime.datetime.now().replace(microsecond=0)
-        pwhash, salt = self._pwhash(password)
-        with self._sqlite_connect() as conn:
+        pwhash, salt = self._pwhash(password, kdf=self.kdf)
+        with self._transaction() as conn:
+            self._invalidate(name)
             result = conn.execute("SELECT COUNT(*) FROM Account WHERE name=?", (name,)).fetchone()[0]
             if result > 0:
                 raise ValueError("That name is not available.")
@@ -267,13 +437,14 @@ class MudAccounts:
             self.accept_password(new_password)
         if new_email:
             self.accept_email(new_email)
-        with self._sqlite_connect() as conn:
+        with self._transaction() as conn:
+            self._invalidate(name)
             result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
             if not result:
                 raise LookupError("Unknown name.")
             account_id = result["id"]
             if new_password:
-                pwhash, salt = self._pwhash(new_password)
+                pwhash, salt = self._pwhash(new_password, kdf=self.kdf)
                 conn.execute("UPDATE Account SET pw_hash=?, pw_salt=? WHERE id=?", (pwhash, salt, account_id))
             if new_email:
                 conn.execute("UPDATE Account SET email=? WHERE id=?", (new_email, account_id))
@@ -281,23 +452,25 @@ class MudAccounts:
     def save_story_data(self, name: str, story_data: Dict[Any, Any]) -> None:
         if not isinstance(story_data, dict):
             raise TypeError("story data should be a dict")
-        with self._sqlite_connect() as conn:
-            result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
-            if not result:
-                raise LookupError("Unknown name.")
-            account_id = result["id"]
+        with self._transaction() as conn:
+            self._invalidate(name)
             data = serpent.dumps(story_data)
-            result = conn.execute("UPDATE StoryData SET format=?, data=? WHERE id=?", ("serpent", data, account_id))
+            result = conn.execute("UPDATE StoryData SET format=?, data=? WHERE account=(SELECT id FROM Account WHERE name=?)",
+                                  ("serpent", data, name))
             if result.rowcount == 0:
                 # there's no storydata yet, insert it
-                conn.execute("INSERT INTO StoryData(account, format, data) VALUES (?,?,?)", (account_id, "serpent", data))
+                result = conn.execute("INSERT INTO StoryData(account, format, data) SELECT id, ?, ? FROM Account WHERE name=?",
+                                      ("serpent", data, name))
+                if result.rowcount == 0:
+                    raise LookupError("Unknown name.")
 
     @util.authorized("wizard")
     def update_privileges(self, name: str, privileges: Set[str], actor: player.Player) -> Set[str]:
         privileges = {p.strip() for p in privileges}
         for p in privileges:
             self.accept_privilege(p)
-        with self._sqlite_connect() as conn:
+        with self._transaction() as conn:
+            self._invalidate(name)
             result = conn.execute("SELECT id FROM Account WHERE name=?", (name,)).fetchone()
             if not result:
                 raise LookupError("Unknown name.")
@@ -309,14 +482,16 @@ class MudAccounts:
 
     @util.authorized("wizard")
     def ban(self, name: str, actor: player.Player) -> None:
-        with self._sqlite_connect() as conn:
+        with self._transaction() as conn:
+            self._invalidate(name)
             updated = conn.execute("UPDATE Account SET banned=1 WHERE name=?", (name,)).rowcount
             if updated == 0:
                 raise LookupError("Unknown name.")
 
     @util.authorized("wizard")
     def unban(self, name: str, actor: player.Player) -> None:
-        with self._sqlite_connect() as conn:
+        with self._transaction() as conn:
+            self._invalidate(name)
             updated = conn.execute("UPDATE Account SET banned=0 WHERE name=?", (name,)).rowcount
             if updated == 0:
                 raise LookupError("Unknown name.")
@@ -0,0 +1,114 @@
+"""
+Scheduling of the periodic activity of NPCs, spread over the server ticks within a time budget.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import collections
+import time
+from typing import Any, Callable, Dict, Iterable, List, MutableSequence, Set
+
+from . import util
+from .tickstats import LatencyHistogram
+
+__all__ = ["ActivityScheduler"]
+
+
+class ActivityScheduler:
+    """
+    Runs the periodic activity of NPCs (for instance their special behavior), so that every NPC gets
+    its turn about once per period, without all of them doing something in the same server tick.
+    The NPCs are divided over period/tick_time shards by their hash; every tick the next shard is due.
+    The activities that are run in a tick are limited by a time budget (in seconds): whatever doesn't fit
+    is carried over to the next tick. At least one activity is run every tick.
+    NPCs are grouped in regions (for instance zones), and the regions where players are count as awake.
+    NPCs in awake regions go first. NPCs in the other regions sleep: they are skipped until a player arrives,
+    or if sleep_idle is False, they run after the awake ones as far as the budget allows.
+    """
+    def __init__(self, activity: Callable[[Any, util.Context], None], region: Callable[[Any], Any],
+                 period: float=10.0, tick_time: float=1.0, budget: float=0.01, sleep_idle: bool=True) -> None:
+        self.activity = activity
+        self.region = region
+        self.budget = budget
+        self.sleep_idle = sleep_idle
+        self.shards = [set() for _ in range(max(1, round(period / tick_time)))]    # type: List[Set[Any]]
+        self.next_shard = 0
+        self.pending = collections.deque()        # type: MutableSequence[Any]  # due NPCs in awake regions
+        self.pending_idle = collections.deque()   # type: MutableSequence[Any]  # due NPCs in the other regions
+        self.queued = set()     # type: Set[Any]
+        self.tick_durations = LatencyHistogram()
+        self.num_runs = 0
+        self.num_asleep = 0
+        self.num_carried_over = 0
+        self.num_over_budget = 0
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, npc: Any) -> bool:
+        return npc in self._shard(npc)
+
+    def _shard(self, npc: Any) -> Set[Any]:
+        return self.shards[hash(npc) % len(self.shards)]
+
+    def add(self, npc: Any) -> None:
+        self._shard(npc).add(npc)
+
+    def remove(self, npc: Any) -> None:
+        """Removes the NPC (for instance when it is destroyed). NPCs that aren't scheduled are ignored."""
+        self._shard(npc).discard(npc)
+
+    def tick(self, ctx: util.Context, awake_regions: Iterable[Any]) -> int:
+        """
+        Makes the next shard due and runs the due activities that fit in the budget.
+        Returns the number of activities that were run.
+        """
+        awake_regions = set(awake_regions)
+        shard = self.shards[self.next_shard]
+        self.next_shard = (self.next_shard + 1) % len(self.shards)
+        for npc in shard:
+            if npc in self.queued:
+                continue
+            if self.region(npc) in awake_regions:
+                self.pending.append(npc)
+            elif self.sleep_idle:
+                self.num_asleep += 1
+                continue
+            else:
+                self.pending_idle.append(npc)
+            self.queued.add(npc)
+        start = time.perf_counter()
+        runs = 0
+        for pending in (self.pending, self.pending_idle):
+            while pending:
+                if runs and time.perf_counter() - start >= self.budget:
+                    break
+                npc = pending.popleft()
+                self.queued.discard(npc)
+                if npc in self._shard(npc):
+                    self.activity(npc, ctx)
+                    runs += 1
+        duration = time.perf_counter() - start
+        self.tick_durations.add(duration)
+        if duration > self.budget:
+            self.num_over_budget += 1
+        self.num_runs += runs
+        self.num_carried_over += len(self.queued)
+        return runs
+
+    def stats(self) -> Dict[str, Any]:
+        """How much of the tick budget the activities used, and how many NPCs were run, carried over, or asleep."""
+        durations = self.tick_durations
+        return {
+            "npcs": len(self),
+            "ticks": durations.count,
+            "runs": self.num_runs,
+            "asleep": self.num_asleep,
+            "carried_over": self.num_carried_over,
+            "pending": len(self.queued),
+            "budget": self.budget,
+            "budget_used_mean": durations.mean / self.budget,
+            "budget_used_max": durations.max / self.budget,
+            "over_budget": self.num_over_budget
+        }
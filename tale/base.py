@@ -40,12 +40,14 @@ import copy
 import random
 import re
 from weakref import WeakValueDictionary
-from collections import OrderedDict
+from collections import OrderedDict, ChainMap
 from textwrap import dedent
 from types import ModuleType
+import typing
 from typing import Iterable, Any, Sequence, Optional, Set, Dict, Union, FrozenSet, Tuple, List, Type, no_type_check
 
 from . import lang
+from .nameindex import NameIndex
 from . import mud_context
 from . import pubsub
 from . import races
@@ -56,9 +58,11 @@ from .errors import ActionRefused, ParseError, LocationIntegrityError, TaleError
 
 __all__ = ["MudObject", "Armour", 'Container', "Door", "Exit", "Item", "Living", "Stats", "Location", "Weapon", "Key", "Soul"]
 
+WIRETAP_IDLE_EXPIRY = 30.0     # seconds after which an unused wiretap topic is cleaned up
 pending_actions = pubsub.topic("driver-pending-actions")
 pending_tells = pubsub.topic("driver-pending-tells")
 async_dialogs = pubsub.topic("driver-async-dialogs")
+_immutable_types = {int, float, bool, str, bytes, frozenset, type(None)}   # attribute values that clones can share
 
 
 ParsedWhoType = Union['Living', 'Item', 'Exit']
@@ -320,6 +324,7 @@ class MudObject:
     def extra_desc(self, value: Dict[str, str]) -> None:
         assert isinstance(value, dict)
         self._extradesc = value
+        self._extradesc_shared = False
 
     def init_names(self, name: str, title: str, descr: str, short_descr: str) -> None:
         """(re)set the name and description attributes"""
@@ -330,6 +335,24 @@ class MudObject:
         self._description = dedent(descr).strip() if descr else ""
         self._short_description = short_descr.strip() if short_descr else ""
         self._extradesc = {}   # maps keyword to description
+        self._extradesc_shared = False   # True when the dict is shared with other objects (copy-on-write)
+
+    def share_descriptions(self, prototype: 'MudObject') -> None:
+        """
+        Makes this object use the name, titles, descriptions, extra descriptions and aliases of the prototype,
+        instead of its own copies. Many instances of the same thing (mobs and items loaded from a world file)
+        can share this immutable data. The extra descriptions are copy-on-write: add_extradesc gives the
+        object its own copy first (so change them with add_extradesc or by assigning extra_desc, not in place).
+        The aliases are only shared when they are a frozenset, so that changing them means assigning a new set.
+        """
+        self.name = prototype.name
+        self._title = prototype._title
+        self._description = prototype._description
+        self._short_description = prototype._short_description
+        self._extradesc = prototype._extradesc
+        self._extradesc_shared = prototype._extradesc_shared = True
+        if isinstance(prototype.aliases, frozenset):
+            self.aliases = prototype.aliases
 
     def _check_title(self, title: str) -> None:
         w = title.partition(" ")[0].lower()
@@ -338,6 +361,8 @@ class MudObject:
 
     def add_extradesc(self, keywords: Set[str], description: str) -> None:
         """For the set of keywords, add the extra description text"""
+        if self._extradesc_shared:
+            self.extra_desc = dict(self._extradesc)
         for keyword in keywords:
             self._extradesc[keyword] = description
 
@@ -556,17 +581,24 @@ class Item(MudObject):
         Create a copy of an existing Item.
         Only allowed when it has an empty inventory (to avoid problems).
         Caller has to make sure the resulting copy is moved to its proper destination location.
+        The copy shares the descriptive data with the original (see share_descriptions), the other attributes are copied.
         """
         try:
             if self.inventory_size > 0:
                 raise ValueError("can't clone something that has other stuff in it")
         except ActionRefused:
             pass
-        # avoid deepcopying the location
-        location, self.location = self.location, None
-        duplicate = copy.deepcopy(self)
-        self.location = duplicate.location = location
-        MudObjRegistry.track_vnum(duplicate, fix_clones=True)   # deepcopy resets initially given vnum so hand out a new one
+        duplicate = type(self).__new__(type(self))     # this hands out a new vnum
+        memo = {id(self): duplicate}   # type: Dict[int, Any]
+        state = vars(duplicate)
+        for name, value in vars(self).items():
+            if name == "vnum":
+                continue
+            if type(value) in _immutable_types or name in ("contained_in", "_extradesc"):
+                state[name] = value     # immutable or shared, and avoid deepcopying the location
+            else:
+                state[name] = copy.deepcopy(value, memo)
+        duplicate._extradesc_shared = self._extradesc_shared = True
         mud_context.driver.register_periodicals(duplicate)
         return duplicate
 
@@ -597,12 +629,47 @@ class Location(MudObject):
         self.livings = set()  # type: Set[Living] # set of livings in this location
         self.items = set()    # type: Set[Item] # set of all items in the room
         self.exits = {}       # type: Dict[str, Exit] # dictionary of all exits: exit_direction -> Exit object with target & descr
+        self._wiretap = None  # type: Optional[pubsub.Topic]  # only created when someone taps this location
+        self._contents_version = 0
+        self._living_names = NameIndex()    # livings in this location by name and aliases
+        self._item_names = NameIndex()      # items in this location by name and aliases
+        self._indexed_sets = (self.livings, self.items)     # the sets that the name indexes were built from
         super().__init__(name, descr=descr)
         self.name = name      # make sure we preserve the case; base object overwrites it in lowercase
 
     def __contains__(self, obj: Union['Living', Item]) -> bool:
         return obj in self.livings or obj in self.items
 
+    @property
+    def contents_version(self) -> int:
+        """Changes whenever livings, items or exits are added to or removed from this location."""
+        return self._contents_version
+
+    @property
+    def living_names(self) -> NameIndex:
+        """The livings in this location, by name and aliases."""
+        if len(self._living_names.registered) != len(self.livings) or self._indexed_sets[0] is not self.livings:
+            self.contents_changed()     # the set was manipulated directly
+        return self._living_names
+
+    @property
+    def item_names(self) -> NameIndex:
+        """The items in this location, by name and aliases."""
+        if len(self._item_names.registered) != len(self.items) or self._indexed_sets[1] is not self.items:
+            self.contents_changed()     # the set was manipulated directly
+        return self._item_names
+
+    def contents_changed(self) -> None:
+        """
+        Signal that the contents (livings, items, exits) of this location changed, so that information derived
+        from it will be recomputed. Only needed when the sets are manipulated directly instead of via insert/remove,
+        or when the names or aliases of the things in here have been changed.
+        """
+        self._contents_version += 1
+        self._living_names = NameIndex(self.livings)
+        self._item_names = NameIndex(self.items)
+        self._indexed_sets = (self.livings, self.items)
+
     def init_inventory(self, objects: Iterable[Union[Item, 'Living']]) -> None:
         """Set the location's initial item and livings 'inventory'"""
         if len(self.items) > 0 or len(self.livings) > 0:
@@ -618,6 +685,7 @@ class Location(MudObject):
         self.livings.clear()
         self.items.clear()
         self.exits.clear()
+        self.contents_changed()
 
     def add_exits(self, exits: Iterable['Exit']) -> None:
         """Adds every exit from the sequence as an exit to this room."""
@@ -628,7 +696,9 @@ class Location(MudObject):
 
     def get_wiretap(self) -> pubsub.Topic:
         """get a wiretap for this location"""
-        return pubsub.topic(("wiretap-location", "%s#%d" % (self.name, self.vnum)))
+        if self._wiretap is None or self._wiretap.destroyed:
+            self._wiretap = pubsub.topic(("wiretap-location", "%s#%d" % (self.name, self.vnum)), idle_expiry=WIRETAP_IDLE_EXPIRY)
+        return self._wiretap
 
     def tell(self, room_msg: str, exclude_living: 'Living'=None, specific_targets: Set[Union[ParsedWhoType]]=None,
              specific_target_msg: str="") -> None:
@@ -648,9 +718,13 @@ class Location(MudObject):
                 living.tell(specific_target_msg)
             else:
                 living.tell(room_msg)
-        if room_msg:
-            tap = self.get_wiretap()
-            tap.send((self.name, room_msg))
+        tap = self._wiretap
+        if tap is not None and room_msg:
+            # only locations that have been tapped have a wiretap topic
+            if tap.destroyed:
+                self._wiretap = None
+            else:
+                tap.send((self.name, room_msg))
 
     def message_nearby_locations(self, message: str) -> None:
         """
@@ -766,22 +840,28 @@ class Location(MudObject):
         assert obj is not None
         if isinstance(obj, Living):
             self.livings.add(obj)
+            self._living_names.add(obj)
         elif isinstance(obj, Item):
             self.items.add(obj)
+            self._item_names.add(obj)
         else:
             raise TypeError("can only add Living or Item")
         obj.location = self
+        self._contents_version += 1
 
     def remove(self, obj: Union['Living', Item], actor: Optional['Living']) -> None:
         """Remove obj from this location (either a Living or an Item)"""
         assert obj is not None
         if obj in self.livings:
             self.livings.remove(obj)    # type: ignore
+            self._living_names.remove(obj)
         elif obj in self.items:
             self.items.remove(obj)      # type: ignore
+            self._item_names.remove(obj)
         else:
             return   # just ignore an object that wasn't present in the first place
         obj.location = None
+        self._contents_version += 1
 
     def handle_verb(self, parsed: ParseResult, actor: 'Living') -> bool:
         """
@@ -946,6 +1026,9 @@ class Living(MudObject):
         self.teleported_from = None   # type: Optional[Location]   # used by teleport/return commands
         self.following = None   # type: Optional[Living]
         self.is_pet = False   # set this to True if creature is/becomes someone's pet
+        self._wiretap = None  # type: Optional[pubsub.Topic]  # only created when someone taps this living
+        self._inventory_version = 0
+        self._inventory_names = NameIndex()     # the inventory by name and aliases
         super().__init__(name, title=title, descr=descr, short_descr=short_descr)
 
     def init_gender(self, gender: str) -> None:
@@ -969,6 +1052,16 @@ class Living(MudObject):
     def inventory_size(self) -> int:
         return len(self.__inventory)
 
+    @property
+    def inventory_version(self) -> int:
+        """Changes whenever items are added to or removed from the inventory."""
+        return self._inventory_version
+
+    @property
+    def inventory_names(self) -> NameIndex:
+        """The inventory, by name and aliases."""
+        return self._inventory_names
+
     @property
     def inventory(self) -> FrozenSet[Item]:
         return frozenset(self.__inventory)
@@ -988,7 +1081,9 @@ class Living(MudObject):
                     raise ActionRefused("It's probably not a good idea to give things to %s." % self.title)
                 raise
         self.__inventory.add(item)
+        self._inventory_names.add(item)
         item.contained_in = self
+        self._inventory_version += 1
 
     def remove(self, item: Union['Living', Item], actor: Optional['Living']) -> None:
         """remove an item from the inventory"""
@@ -997,7 +1092,9 @@ class Living(MudObject):
             raise ActionRefused("You can't do that.")
         if actor is self or actor is not None and "wizard" in actor.privileges:
             self.__inventory.remove(item)
+            self._inventory_names.remove(item)
             item.contained_in = None
+            self._inventory_version += 1
         else:
             raise ActionRefused("You can't take %s from %s." % (item.title, self.title))
 
@@ -1005,10 +1102,13 @@ class Living(MudObject):
         super().destroy(ctx)
         if self.location and self in self.location.livings:
             self.location.livings.remove(self)
+            self.location.living_names.remove(self)
         self.location = _limbo
         for item in self.__inventory:
             item.destroy(ctx)
         self.__inventory.clear()
+        self._inventory_names.clear()
+        self._inventory_version += 1
         # @todo: remove attack status, etc.
         self.soul = None   # type: ignore  # truly die ;-)
 
@@ -1017,8 +1117,10 @@ class Living(MudObject):
         if make_clone:
             # avoid deepcopying the location
             location, self.location = self.location, _limbo
+            wiretap, self._wiretap = self._wiretap, None     # the clone gets its own wiretap
             duplicate = copy.deepcopy(self)
             self.location = location
+            self._wiretap = wiretap
             MudObjRegistry.track_vnum(duplicate, fix_clones=True)   # deepcopy overwrites initially given vnum so make a new one
             mud_context.driver.register_periodicals(duplicate)
         else:
@@ -1050,7 +1152,9 @@ class Living(MudObject):
 
     def get_wiretap(self) -> pubsub.Topic:
         """get a wiretap for this living"""
-        return pubsub.topic(("wiretap-living", "%s#%d" % (self.name, self.vnum)))
+        if self._wiretap is None or self._wiretap.destroyed:
+            self._wiretap = pubsub.topic(("wiretap-living", "%s#%d" % (self.name, self.vnum)), idle_expiry=WIRETAP_IDLE_EXPIRY)
+        return self._wiretap
 
     def tell(self, message: str, *, end: bool=False, format: bool=True) -> 'Living':
         """
@@ -1066,8 +1170,13 @@ class Living(MudObject):
         Note: end and format parameters are ignored for Livings but may be
         useful when this function is called on a subclass such as Player.
         """
-        tap = self.get_wiretap()
-        tap.send((self.name, str(message)))
+        tap = self._wiretap
+        if tap is not None:
+            # only livings that have been tapped have a wiretap topic
+            if tap.destroyed:
+                self._wiretap = None
+            else:
+                tap.send((self.name, str(message)))
         return self
 
     def tell_later(self, message: str) -> None:
@@ -1091,7 +1200,7 @@ class Living(MudObject):
             spec_msg = message.format(actor=self.title, Actor=lang.capital(self.title), target="you", Target="You")
             self.location.tell(room_msg, exclude_living=self, specific_targets={target}, specific_target_msg=spec_msg)
 
-    def parse(self, commandline: str, external_verbs: Set[str]=set()) -> ParseResult:
+    def parse(self, commandline: str, external_verbs: typing.Container[str]=frozenset()) -> ParseResult:
         """Parse the commandline into something that can be processed by the soul (ParseResult)"""
         if commandline == "again":
             # special case, repeat previous command
@@ -1195,7 +1304,7 @@ class Living(MudObject):
         try:
             if parsed.qualifier:
                 raise ParseError("That action doesn't support qualifiers.")  # for now, quals are only supported on soul-verbs (emotes).
-            custom_verbs = set(ctx.driver.current_custom_verbs(self))
+            custom_verbs = ctx.driver.current_custom_verbs(self)
             if parsed.verb in custom_verbs:
                 if self.location.handle_verb(parsed, self):       # note: can't deal with async dialogs
                     pending_actions.send(lambda actor=self: actor.location._notify_action_all(parsed, actor))
@@ -1526,6 +1635,7 @@ class Exit(MudObject):
             if direction in location.exits:
                 raise LocationIntegrityError("exit already exists: '%s' in %s" % (direction, location), direction, self, location)
             location.exits[direction] = self
+        location.contents_changed()
 
     def _bind_target(self, game_zones_module: ModuleType) -> None:
         """
@@ -1581,7 +1691,7 @@ class Door(Exit):
                  locked: bool=False, opened: bool=False, key_code: str="") -> None:
         self.locked = locked
         self.opened = opened
-        self.__description_prefix = long_descr or short_descr
+        self.__description_prefix = long_descr or short_descr or ""
         self.key_code = key_code   # you can optionally set this to any code that a key must match to unlock the door
         super().__init__(directions, target_location, short_descr, long_descr, enter_msg=enter_msg)
         if locked and opened:
@@ -1625,7 +1735,9 @@ class Door(Exit):
             status += "and locked."
         else:
             status += "and unlocked."
-        return self.__description_prefix + " " + status
+        if self.__description_prefix:
+            return self.__description_prefix + " " + status
+        return status
 
     @description.setter
     def description(self, value: str) -> None:
@@ -1961,7 +2073,7 @@ class Soul:
         action_room = action_room.replace("$", "s")
         return result_messages(action, action_room)
 
-    def parse(self, player: Living, cmd: str, external_verbs: Set[str]=set()) -> ParseResult:
+    def parse(self, player: Living, cmd: str, external_verbs: typing.Container[str]=frozenset()) -> ParseResult:
         """Parse a command string, returns a ParseResult object."""
         qualifier = ""
         message_verb = False  # does the verb expect a message?
@@ -2034,20 +2146,10 @@ class Soul:
             unparsed = unparsed[len(verb):].lstrip()
         include_flag = True
         collect_message = False
-        all_livings = {}  # livings in the room (including player) by name + aliases
-        all_items = {}  # all items in the room or player's inventory, by name + aliases
-        for living in player.location.livings:
-            all_livings[living.name] = living
-            for alias in living.aliases:
-                all_livings[alias] = living
-        for item in player.location.items:
-            all_items[item.name] = item
-            for alias in item.aliases:
-                all_items[alias] = item
-        for item in player.inventory:
-            all_items[item.name] = item
-            for alias in item.aliases:
-                all_items[alias] = item
+        all_livings = player.location.living_names  # livings in the room (including player) by name + aliases
+        # all items in the room or player's inventory, by name + aliases (the inventory takes precedence)
+        name_indexes = (all_livings, player.inventory_names, player.location.item_names)
+        all_items = ChainMap(player.inventory_names, player.location.item_names)
         previous_word = None
         words_enumerator = enumerate(words)
         for index, word in words_enumerator:
@@ -2165,7 +2267,7 @@ class Soul:
                         next(words_enumerator)
                         wordcount -= 1
                     continue
-            item_or_living, full_name, wordcount = self.check_name_with_spaces(words, index, all_livings, all_items, {})
+            item_or_living, full_name, wordcount = self.match_name_with_spaces(words, index, name_indexes)
             if item_or_living:
                 while wordcount > 1:
                     next(words_enumerator)
@@ -2316,6 +2418,20 @@ class Soul:
             return False
         return True
 
+    def match_name_with_spaces(self, words: Sequence[str], startindex: int, name_indexes: Sequence[NameIndex]) \
+            -> Tuple[Optional[ParsedWhoType], str, int]:
+        """
+        Like check_name_with_spaces, but searches in name indexes (in the given order of precedence) using their tries.
+        The shortest name that matches is returned as a tuple (matched_object, matched_name, number of words used in match).
+        If nothing is found, a tuple (None, "", 0) is returned.
+        """
+        result = None, "", 0    # type: Tuple[Optional[ParsedWhoType], str, int]
+        for name_index in name_indexes:
+            match = name_index.match(words, startindex)
+            if match[0] is not None and (result[0] is None or match[2] < result[2]):
+                result = match
+        return result
+
     def check_name_with_spaces(self, words: Sequence[str], startindex: int, all_livings: Dict[str, Living],
                                all_items: Dict[str, Item], all_exits: Dict[str, Exit]) \
             -> Tuple[Optional[ParsedWhoType], str, int]:
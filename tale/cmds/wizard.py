@@ -9,6 +9,7 @@ import datetime
 import gc
 import importlib
 import inspect
+import json
 import os
 import platform
 import sys
@@ -19,6 +20,7 @@ from . import wizcmd, disabled_in_gamemode
 from .. import base, lang, util, pubsub, races, __version__
 from ..errors import ParseError, ActionRefused, NonSoulVerb, TaleError, TaleFlowControlException
 from ..player import Player
+from ..savegames import find_missing_references
 from ..story import *
 
 
@@ -471,6 +473,12 @@ def do_server(player: Player, parsed: base.ParseResult, ctx: util.Context) -> No
         txt.append("Loop duration:  %.2f sec. (avg)" % avg_loop_duration)
     elif config.server_tick_method == TickMethod.COMMAND:
         txt.append("Loop duration:  n/a (command driven)")
+    if driver.world_store:
+        store = driver.world_store
+        txt.append("World store:    %d keys, %d dirty, %d checkpoints (%d states written)"
+                   % (len(store.objects), len(store.dirty), store.num_checkpoints, store.num_written))
+        txt.append("  journal:      %d entries written, %d compactions, %d writes queued"
+                   % (store.num_journaled, store.num_compacted, store.writes.qsize()))
     txt.append("Number of objects:")
     txt.append("  locations: %d" % len(list(base.MudObjRegistry.all_locations.keys())))
     txt.append("  livings:   %d" % len(list(base.MudObjRegistry.all_livings.keys())))
@@ -497,6 +505,43 @@ def do_events(player: Player, parsed: base.ParseResult, ctx: util.Context) -> No
     player.tell("\n".join(txt), format=False)
 
 
+@wizcmd("tickstats")
+def do_tickstats(player: Player, parsed: base.ParseResult, ctx: util.Context) -> None:
+    """Show timing statistics of the server ticks, and the slowest deferred actions and commands.
+'tickstats reset' clears the statistics, 'tickstats dump' writes them to a json file."""
+    stats = ctx.driver.tick_stats
+    if parsed.args:
+        if parsed.args[0] == "reset":
+            stats.reset()
+            player.tell("Tick statistics have been reset.")
+        elif parsed.args[0] == "dump":
+            filename = "tickstats-%s.json" % datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            ctx.driver.user_resources[filename] = json.dumps(stats.dump(), indent=2)
+            player.tell("Tick statistics have been written to %s." % filename)
+        else:
+            raise ActionRefused("Use 'reset' or 'dump', or no arguments to show the statistics.")
+        return
+    ms = 1000.0
+    player.tell("<bright>Server tick timings.</>  (all times in milliseconds)", end=True)
+    txt = ["Ticks:  %d, of which %d took longer than the tick time (%.1f sec)."
+           % (stats.num_ticks, stats.late_ticks, ctx.config.server_tick_time),
+           "",
+           "<ul> phase      <dim>|</><ul>   mean <dim>|</><ul>    p95 <dim>|</><ul>    max <dim>|</><ul>  count</>"]
+    phases = [("whole tick", stats.tick_durations)] + [(phase, stats.phase_durations[phase]) for phase in stats.phases]
+    for name, histogram in phases:
+        txt.append(" %-10s <dim>|</> %6.2f <dim>|</> %6.2f <dim>|</> %6.1f <dim>|</> %6d"
+                   % (name, histogram.mean * ms, histogram.percentile(0.95) * ms, histogram.max * ms, histogram.count))
+    for title, histograms in [("deferred action", stats.deferred_actions), ("command verb", stats.verbs)]:
+        txt.append("")
+        txt.append("<ul> %-30s<dim>|</><ul>  total <dim>|</><ul>   mean <dim>|</><ul>    max <dim>|</><ul>  count</>"
+                   % (title + " (slowest)"))
+        for name, histogram in stats.slowest(histograms, 10):
+            txt.append(" %-30.30s<dim>|</> %6.1f <dim>|</> %6.2f <dim>|</> %6.1f <dim>|</> %6d"
+                       % (name, histogram.total * ms, histogram.mean * ms, histogram.max * ms, histogram.count))
+    txt.append("")
+    player.tell("\n".join(txt), format=False)
+
+
 @wizcmd("pubsub")
 def do_pubsub(player: Player, parsed: base.ParseResult, ctx: util.Context) -> None:
     """Give an overview of the pubsub topics."""
@@ -514,6 +559,21 @@ def do_pubsub(player: Player, parsed: base.ParseResult, ctx: util.Context) -> No
     player.tell("\n".join(txt), format=False)
 
 
+@wizcmd("integrity")
+def do_integrity(player: Player, parsed: base.ParseResult, ctx: util.Context) -> None:
+    """Check the consistency of the world: that everything referenced by the objects (inventories, location contents,
+exits, the location of livings) is known in the registry of all objects."""
+    problems = find_missing_references([i for i in base.MudObjRegistry.all_items.values() if i.contained_in],
+                                       [l for l in base.MudObjRegistry.all_livings.values() if l.location],
+                                       base.MudObjRegistry.all_locations.values(),
+                                       base.MudObjRegistry.all_exits.values())
+    if problems:
+        player.tell("<bright>Found %d missing references:</>" % len(problems), end=True)
+        player.tell("\n".join(problems[:100]), format=False)
+    else:
+        player.tell("The world is consistent.")
+
+
 @wizcmd("force")
 def do_force(player: Player, parsed: base.ParseResult, ctx: util.Context) -> None:
     """Force another living being into performing a given command."""
@@ -566,6 +626,8 @@ def do_accounts(player: Player, parsed: base.ParseResult, ctx: util.Context) ->
         txt.append(" %-12s <dim>|</> %19s <dim>|</> %-20s <dim>|</> %s <dim>|</> %s" %
                    (account.name, account.logged_in, account.email, "*" if account.banned else " ", lang.join(account.privileges, "")))
     txt.append("\nWizards: " + lang.join(wizards))
+    cache = ctx.driver.mud_accounts.cache_stats()
+    txt.append("Account cache: {size} of max {max_size} accounts cached, {hits} hits, {misses} misses.".format(**cache))
     player.tell("\n".join(txt), format=False)
 
 
@@ -582,8 +644,7 @@ def do_add_priv(player: Player, parsed: base.ParseResult, ctx: util.Context) ->
         account = ctx.driver.mud_accounts.get(name)
     except LookupError:
         raise ActionRefused("No such account.")
-    account.privileges.add(priv)
-    new_privs = ctx.driver.mud_accounts.update_privileges(name, account.privileges, player)
+    new_privs = ctx.driver.mud_accounts.update_privileges(name, account.privileges | {priv}, player)
     player.tell("Privileges of account %s updated to: %s." % (name, new_privs))
     player.tell("It will become active on their next login.")
 
@@ -604,8 +665,7 @@ def do_remove_priv(player: Player, parsed: base.ParseResult, ctx: util.Context)
     except LookupError:
         raise ActionRefused("No such account.")
     if priv in account.privileges:
-        account.privileges.remove(priv)
-        new_privs = ctx.driver.mud_accounts.update_privileges(name, account.privileges, player)
+        new_privs = ctx.driver.mud_accounts.update_privileges(name, account.privileges - {priv}, player)
         player.tell("Privileges of account %s updated to: %s." % (name, new_privs))
         other = ctx.driver.search_player(name)
         if other:
@@ -6,8 +6,9 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
 import collections
+import concurrent.futures
 import datetime
-import heapq
+import functools
 import importlib
 import inspect
 import os
@@ -17,14 +18,18 @@ import random
 import sys
 import threading
 import time
+import weakref
 from functools import total_ordering
-from types import ModuleType
-from typing import Sequence, Union, Tuple, Any, Dict, Callable, Iterable, Generator, Set, List, MutableSequence, Optional
+from types import ModuleType, MappingProxyType
+from typing import Sequence, Union, Tuple, Any, Dict, Callable, Iterable, Generator, Set, List, MutableSequence, Optional, \
+    Mapping, FrozenSet
 
 import appdirs
 
 from . import __version__ as tale_version_str, _check_required_libraries
-from . import mud_context, errors, util, cmds, player, pubsub, charbuilder, lang, verbdefs, vfs, base
+from . import mud_context, errors, util, cmds, player, pubsub, charbuilder, lang, verbdefs, vfs, base, persistence
+from .timerwheel import TimerWheel
+from .tickstats import TickStats
 from .story import TickMethod, GameMode, MoneyType, StoryBase
 from .tio import DEFAULT_SCREEN_WIDTH
 from .races import playable_races
@@ -43,6 +48,7 @@ class Commands:
     def __init__(self) -> None:
         self.commands_per_priv = {"": {}}    # type: Dict[str, Dict[str, Callable]]
         self.no_soul_parsing = set()   # type: Set[str]
+        self.compiled_tables = {}    # type: Dict[FrozenSet[str], Mapping[str, Callable]]
 
     def add(self, verb: str, func: Callable, privilege: str="") -> None:
         self.validatefunc(func)
@@ -50,12 +56,14 @@ class Commands:
             if verb in commands:
                 raise ValueError("command defined more than once: " + verb)
         self.commands_per_priv.setdefault(privilege, {})[verb] = func
+        self.compiled_tables.clear()
 
     def override(self, verb: str, func: Callable, privilege: str="") -> Callable:
         self.validatefunc(func)
         if verb in self.commands_per_priv[privilege]:
             existing = self.commands_per_priv[privilege][verb]
             self.commands_per_priv[privilege][verb] = func
+            self.compiled_tables.clear()
             return existing
         raise LookupError("command not defined: " + verb)
 
@@ -70,6 +78,17 @@ class Commands:
                 result.update(self.commands_per_priv[priv])
         return result
 
+    def get_table(self, privileges: Iterable[str]) -> Mapping[str, Callable]:
+        """
+        Like get, but returns a read-only verb table that is compiled only once per set of privileges.
+        It is recompiled when commands are added or changed.
+        """
+        key = frozenset(privileges)
+        table = self.compiled_tables.get(key)
+        if table is None:
+            table = self.compiled_tables[key] = MappingProxyType(self.get(key))
+        return table
+
     def adjust_available_commands(self, server_mode: GameMode) -> None:
         # disable commands flagged with the given game_mode
         # disable soul verbs flagged with override
@@ -83,6 +102,15 @@ class Commands:
                     del verbdefs.VERBS[cmd]
                 if getattr(func, "no_soul_parse", False):
                     self.no_soul_parsing.add(cmd)
+        self.compiled_tables.clear()
+
+
+_gametime_origin = datetime.datetime(2000, 1, 1)
+
+
+def gametime_seconds(gametime: datetime.datetime) -> float:
+    """The game time as a number of seconds (relative to a fixed origin), as used to schedule the deferreds."""
+    return (gametime - _gametime_origin).total_seconds()
 
 
 @total_ordering
@@ -126,6 +154,8 @@ class Deferred:
         self.vargs = vargs
         self.kwargs = kwargs
         self.periodical = periodical
+        self.cancelled = False
+        self._func = None       # type: Optional[Callable]  # the resolved action, cached on the first call
 
     def __eq__(self, other):
         if self.__class__ == other.__class__:
@@ -149,26 +179,42 @@ class Deferred:
             secs = int(secs / game_clock.times_realtime)
         return datetime.timedelta(seconds=secs)
 
+    @property
+    def action_name(self) -> str:
+        """Descriptive name of the action, such as 'module.function' or 'Class.method' (used in timing statistics)"""
+        if isinstance(self.owner, str):
+            return self.owner.partition(":")[2] + "." + self.action
+        return type(self.owner).__name__ + "." + self.action
+
+    def cancel(self) -> None:
+        """
+        Cancel this deferred: it will not be called anymore, and if it is periodical, it will not be rescheduled.
+        The scheduler simply skips it when it comes due.
+        """
+        self.cancelled = True
+
     def __call__(self, *args: Any, **kwargs: Any) -> None:
-        self.kwargs = self.kwargs or {}
-        if callable(self.action):
-            func = self.action
-        else:
+        if self.cancelled:
+            return
+        if self._func is None:
             # deferred action is stored as the name of the function to call,
-            # so we need to obtain the actual function from the owner object.
-            if isinstance(self.owner, str):
-                if self.owner.startswith("module:"):
+            # so we need to obtain the actual function from the owner object (only once).
+            owner = self.owner
+            if isinstance(owner, str):
+                if owner.startswith("module:"):
                     # the owner refers to a module
-                    self.owner = sys.modules[self.owner[7:]]
+                    owner = sys.modules[owner[7:]]
                 else:
-                    raise RuntimeError("invalid owner specifier: " + self.owner)
-            func = getattr(self.owner, self.action)
-        if self.periodical and hasattr(func, "_tale_periodically") and not func._tale_periodically:     # type: ignore
+                    raise RuntimeError("invalid owner specifier: " + owner)
+            self._func = getattr(owner, self.action)
+        func = self._func
+        if self.periodical and not getattr(func, "_tale_periodically", True):
             return  # no longer marked as periodical
-        if "ctx" in inspect.signature(func).parameters:
+        self.kwargs = self.kwargs or {}
+        if _accepts_ctx(getattr(func, "__func__", func)):
             self.kwargs["ctx"] = kwargs["ctx"]  # add a 'ctx' keyword argument to the call for convenience
         func(*self.vargs, **self.kwargs)
-        if self.periodical and (not hasattr(func, "_tale_periodically") or func._tale_periodically):    # type: ignore
+        if self.periodical and not self.cancelled and getattr(func, "_tale_periodically", True):
             # reschedule the same call!
             assert self.periodical[0] > 0 and self.periodical[1] > 0
             due = random.uniform(self.periodical[0], self.periodical[1])
@@ -183,6 +229,13 @@ class Deferred:
             del self.action
             del self.kwargs
             del self.vargs
+            self._func = None
+
+
+@functools.lru_cache(maxsize=None)
+def _accepts_ctx(func: Callable) -> bool:
+    """Does the function have a 'ctx' parameter? (cached, because inspecting the signature is slow)"""
+    return "ctx" in inspect.signature(func).parameters
 
 
 class Driver(pubsub.Listener):
@@ -193,10 +246,16 @@ class Driver(pubsub.Listener):
     """
     def __init__(self) -> None:
         self.unbound_exits = []    # type: List[base.Exit]
-        self.deferreds = []   # type: List[Deferred]  # heapq
+        self.deferreds = TimerWheel()   # the scheduled Deferreds, keyed on game time seconds and grouped by owner
+        self.deferreds_due = []   # type: List[Deferred]  # the deferreds being called in the current server tick
         self.deferreds_lock = threading.Lock()
         self.server_started = datetime.datetime.now().replace(microsecond=0)
         self.server_loop_durations = collections.deque(maxlen=10)    # type: MutableSequence[float]
+        self.tick_stats = TickStats()   # timings of the server ticks, deferred actions and commands
+        self.render_pool = None     # type: Optional[concurrent.futures.ThreadPoolExecutor]  # formats the players' output
+        self.world_store = None     # type: Optional[persistence.WorldStore]  # persistent world state (mud mode only)
+        # per living: the custom verbs of its surroundings, and the key that tells when they have to be collected again
+        self.custom_verbs_cache = weakref.WeakKeyDictionary()   # type: weakref.WeakKeyDictionary[base.Living, Tuple[Tuple, Mapping]]
         self.commands = Commands()
         self.all_players = {}   # type: Dict[str, player.PlayerConnection]  # maps playername to player connection object
         self.zones = None       # type: ModuleType
@@ -207,8 +266,11 @@ class Driver(pubsub.Listener):
         self.game_clock = None    # type: util.GameDateTime
         self.game_mode = None     # type: GameMode
         self._stop_mainloop = True
+        # signaled when the main loop has something to do before its next server tick (player input, new dialog...)
+        self.main_loop_wakeup = threading.Event()
         # playerconnections that wait for input; maps connection to tuple (dialog, validator, echo_input)
         self.waiting_for_input = {}   # type: Dict[player.PlayerConnection, Tuple[Generator, Any, Any]]
+        self.waiting_for_jobs = set()   # type: Set[player.PlayerConnection]  # connections whose dialog waits for a background job
         mud_context.driver = self
         for verb, func, privilege in cmds.all_registered_commands():
             self.commands.add(verb, func, privilege)
@@ -219,6 +281,14 @@ class Driver(pubsub.Listener):
     def is_running(self):
         return not self._stop_mainloop
 
+    def wakeup(self) -> None:
+        """
+        Signal the main loop that there's work to do, so that it doesn't
+        have to wait until the next server tick (for instance: player input arrived).
+        This is safe to call from other threads.
+        """
+        self.main_loop_wakeup.set()
+
     def start(self, game_file_or_path: str) -> None:
         """Start the driver from a parsed set of arguments"""
         _check_required_libraries()
@@ -247,6 +317,8 @@ class Driver(pubsub.Listener):
         self.story.config.server_mode = self.game_mode
         if self.game_mode != GameMode.IF and self.story.config.server_tick_method == TickMethod.COMMAND:
             raise ValueError("'command' tick method can only be used in 'if' game mode")
+        if self.game_mode != GameMode.IF and self.story.config.render_output_workers > 0:
+            self.render_pool = concurrent.futures.ThreadPoolExecutor(self.story.config.render_output_workers)
         # Register the driver and add some more stuff in the global context.
         self.resources = vfs.VirtualFileSystem(root_package="story")   # read-only story resources
         mud_context.config = self.story.config
@@ -268,6 +340,7 @@ class Driver(pubsub.Listener):
                 cmds.clear_registered_commands()
         self.commands.adjust_available_commands(self.story.config.server_mode)
         self.game_clock = util.GameDateTime(self.story.config.epoch or self.server_started, self.story.config.gametime_to_realtime)
+        self.deferreds.clear(gametime_seconds(self.game_clock.clock))   # the timer wheel runs on the game clock
         self.moneyfmt = None
         if self.story.config.money_type != MoneyType.NOTHING:
             self.moneyfmt = util.MoneyFormatter.create_for(self.story.config.money_type)
@@ -357,13 +430,17 @@ class Driver(pubsub.Listener):
         Flushes any pending output to the players, then closes down.
         """
         self._stop_mainloop = True
+        self.wakeup()
         for conn in self.all_players.values():
             conn.write_output()
             conn.destroy()
         self.all_players.clear()
+        if self.render_pool:
+            self.render_pool.shutdown()
+            self.render_pool = None
         time.sleep(0.1)
 
-    def _continue_dialog(self, conn: player.PlayerConnection, dialog: Generator, message: str) -> None:
+    def _continue_dialog(self, conn: player.PlayerConnection, dialog: Generator, message: Union[str, concurrent.futures.Future]) -> None:
         # Notice that the try...except structure is very similar to
         # the one in _server_loop_process_player_input
         # That's no surprise because also in this async case, we need
@@ -371,7 +448,12 @@ class Driver(pubsub.Listener):
         # generator. The reguar player input function has to deal with
         # them as well, caused by normal player commands.
         try:
-            why, what = dialog.send(message or None)
+            if isinstance(message, concurrent.futures.Future):
+                # the dialog waited for this job, it gets the result (or the exception) of it
+                error = message.exception()
+                why, what = dialog.throw(error) if error else dialog.send(message.result())
+            else:
+                why, what = dialog.send(message or None)
         except StopIteration:
             if conn.player:
                 conn.write_output()   # immediately give feedback (if any) once the dialog ends
@@ -396,9 +478,18 @@ class Driver(pubsub.Listener):
                 assert conn not in self.waiting_for_input, "can only run one async dialog at the same time"
                 conn.io.dont_echo_next_cmd = why == "input-noecho"  # this avoids echoing of the password
                 self.waiting_for_input[conn] = (dialog, validator, why != "input-noecho")
+            elif why == "wait":
+                # wait for a job running in another thread (a concurrent.futures.Future), input is held back meanwhile
+                self.waiting_for_jobs.add(conn)
+                what.add_done_callback(lambda future: self._job_done(conn, dialog, future))
             else:
                 raise ValueError("invalid generator wait reason: " + why)
 
+    def _job_done(self, conn: player.PlayerConnection, dialog: Generator, future: concurrent.futures.Future) -> None:
+        # called from the thread that ran the job: the driver continues the dialog
+        topic_async_dialogs.send((conn, dialog, future))
+        self.wakeup()
+
     def print_game_intro(self, conn: Optional[player.PlayerConnection]) -> None:
         try:
             # print game banner as supplied by the game
@@ -447,6 +538,11 @@ class Driver(pubsub.Listener):
         for cmd in p.get_pending_input():
             if not cmd:
                 continue
+            verb = cmd.split(None, 1)[0] if not cmd.isspace() else ""
+            if cmd[0] in cmds.abbreviations and not cmd[0].isalpha():
+                verb = cmd[0]
+            verb = cmds.abbreviations.get(verb, verb)
+            command_start = time.perf_counter()
             try:
                 p.tell("\n")
                 self._process_player_command(cmd, conn)
@@ -454,6 +550,7 @@ class Driver(pubsub.Listener):
                 # to avoid flooding/abuse, we stop the loop after processing one command.
                 break
             except errors.UnknownVerbException as x:
+                verb = "(unknown)"   # don't collect statistics for every typo
                 if x.verb in {"north", "east", "south", "west",
                               "northeast", "northwest", "southeast", "southwest",
                               "north east", "north west", "south east", "south west",
@@ -468,6 +565,10 @@ class Driver(pubsub.Listener):
                 p.tell(str(x))
             except errors.ParseError as x:
                 p.tell(str(x))
+            finally:
+                duration = time.perf_counter() - command_start
+                self.tick_stats.add_phase("commands", duration)
+                self.tick_stats.add_verb(verb, duration)
 
     def _server_tick(self) -> None:
         """
@@ -482,39 +583,63 @@ class Driver(pubsub.Listener):
         self.game_clock.add_realtime(datetime.timedelta(seconds=self.story.config.server_tick_time))
         ctx = util.Context(self, self.game_clock, self.story.config, None)
 
-        due_deferreds = []
+        stats = self.tick_stats
+        phase_start = time.perf_counter()
         with self.deferreds_lock:
-            while self.deferreds:
-                deferred = self.deferreds[0]
-                if deferred.due_gametime > self.game_clock.clock:
-                    break
-                due_deferreds.append(heapq.heappop(self.deferreds))
-        for deferred in due_deferreds:
-            try:
-                deferred(ctx=ctx)  # call the deferred and provide a context object
-            except StoryCompleted:
-                raise    # handled elsewhere (IF)
-            except Exception:
-                print("\n* Exception while executing deferred action {0}:".format(deferred), file=sys.stderr)
-                print("".join(util.format_traceback()), file=sys.stderr)
-                print("(Please report this problem)", file=sys.stderr)
+            due_deferreds = self.deferreds_due = self.deferreds.pop_due(gametime_seconds(self.game_clock.clock))
+        num_deferreds = len(due_deferreds)
+        try:
+            for deferred in due_deferreds:
+                action_name = deferred.action_name
+                call_start = time.perf_counter()
+                try:
+                    deferred(ctx=ctx)  # call the deferred and provide a context object
+                except StoryCompleted:
+                    raise    # handled elsewhere (IF)
+                except Exception:
+                    print("\n* Exception while executing deferred action {0}:".format(deferred), file=sys.stderr)
+                    print("".join(util.format_traceback()), file=sys.stderr)
+                    print("(Please report this problem)", file=sys.stderr)
+                stats.add_deferred(action_name, time.perf_counter() - call_start)
+        finally:
+            self.deferreds_due = []
         del due_deferreds
+        now = time.perf_counter()
+        stats.add_phase("deferreds", now - phase_start)
+        phase_start = now
 
         pubsub.sync()
+        now = time.perf_counter()
+        stats.add_phase("pubsub", now - phase_start)
+        phase_start = now
+
         for name, conn in list(self.all_players.items()):
             if conn.player and conn.io and conn.player.location:
                 self.disconnect_idling(conn)
-                conn.write_output()
             else:
                 # disconnect corrupt player connection
                 self.disconnect_player(conn)
+        self.write_players_output(self.all_players.values())
+        stats.add_phase("output", time.perf_counter() - phase_start)
+        stats.end_tick(self.story.config.server_tick_time, num_deferreds)
         # clean up idle wiretap topics
-        topicinfo = pubsub.pending()
-        for topicname in topicinfo:
-            if isinstance(topicname, tuple) and topicname[0].startswith("wiretap-"):
-                events, idle_time, subbers = topicinfo[topicname]
-                if events == 0 and not subbers and idle_time > 30:
-                    pubsub.topic(topicname).destroy()
+        pubsub.destroy_idle_topics()
+
+    def write_players_output(self, connections: Iterable[player.PlayerConnection]) -> None:
+        """
+        Output stage of the main loop: writes the buffered output of the player connections.
+        Connections without output are skipped. The others are first all formatted (by the render
+        worker threads, if configured), and then written to the players in one go.
+        """
+        pending = [conn for conn in connections if conn.io and conn.player and conn.has_output]
+        if not pending:
+            return
+        if self.render_pool and len(pending) > 1:
+            rendered = list(self.render_pool.map(player.PlayerConnection.render_output, pending))
+        else:
+            rendered = [conn.render_output() for conn in pending]
+        for conn, output in zip(pending, rendered):
+            conn.write_rendered_output(output)
 
     def disconnect_idling(self, conn: player.PlayerConnection) -> None:
         raise NotImplementedError
@@ -537,8 +662,8 @@ class Driver(pubsub.Listener):
         player = conn.player
         # We pass in all 'external verbs' (non-soul verbs) so it will do the
         # parsing for us even if it's a verb the soul doesn't recognise by itself.
-        command_verbs = self.commands.get(player.privileges)
-        custom_verbs = set(self.current_custom_verbs(player))
+        command_verbs = self.commands.get_table(player.privileges)
+        custom_verbs = self.current_custom_verbs(player)
         try:
             if _verb in self.commands.no_soul_parsing:
                 # don't use the soul to parse it further
@@ -546,7 +671,7 @@ class Driver(pubsub.Listener):
                 raise errors.NonSoulVerb(base.ParseResult(_verb, unparsed=_rest.strip()))
             else:
                 # Parse the command by using the soul.
-                all_verbs = set(command_verbs) | custom_verbs
+                all_verbs = collections.ChainMap(custom_verbs, command_verbs)
                 parsed = player.parse(cmd, external_verbs=all_verbs)
             # If parsing went without errors, it's a soul verb, handle it as a socialize action
             player.turns += 1
@@ -636,18 +761,26 @@ class Driver(pubsub.Listener):
                 module.init(self)       # type: ignore
         return importlib.import_module("zones")
 
-    def current_custom_verbs(self, player: player.Player) -> Dict[str, str]:
-        """returns dict of the currently recognised custom verbs (verb->helptext mapping)"""
-        verbs = player.verbs.copy()
-        verbs.update(player.location.verbs)
-        for living in player.location.livings:
-            verbs.update(living.verbs)
-        for item in player.inventory:
-            verbs.update(item.verbs)
-        for item in player.location.items:
-            verbs.update(item.verbs)
-        for exit in set(player.location.exits.values()):
-            verbs.update(exit.verbs)
+    def current_custom_verbs(self, player: base.Living) -> Mapping[str, str]:
+        """
+        returns a read-only mapping of the currently recognised custom verbs (verb->helptext mapping)
+        It is a view on the verbs of the player, its location and the things in there, and the player's inventory.
+        Which objects are looked at, is only determined again when the location or its contents, or the inventory, change.
+        """
+        location = player.location
+        key = (location, location.contents_version, player.inventory_version)
+        cached = self.custom_verbs_cache.get(player)
+        if cached and cached[0] == key:
+            return cached[1]
+        # the verbs of objects that come later take precedence, the ChainMap wants them first
+        verb_dicts = [exit.verbs for exit in set(location.exits.values())]
+        verb_dicts.extend(item.verbs for item in location.items)
+        verb_dicts.extend(item.verbs for item in player.inventory)
+        verb_dicts.extend(living.verbs for living in location.livings)
+        verb_dicts.append(location.verbs)
+        verb_dicts.append(player.verbs)
+        verbs = MappingProxyType(collections.ChainMap(*verb_dicts))
+        self.custom_verbs_cache[player] = (key, verbs)
         return verbs
 
     def current_verbs(self, player: player.Player) -> Dict[str, str]:
@@ -746,7 +879,7 @@ class Driver(pubsub.Listener):
         if "ctx" in deferred.kwargs:
             raise errors.TaleError("you cannot enqueue a Deferred that already has a 'ctx' kwarg (serialization issues)")
         with self.deferreds_lock:
-            heapq.heappush(self.deferreds, deferred)
+            self.deferreds.insert(deferred, gametime_seconds(deferred.due_gametime), id(deferred.owner))
 
     def pubsub_event(self, topicname: pubsub.TopicNameType, event: Union[Callable, Tuple[player.PlayerConnection, str]]) -> None:
         if topicname == "driver-pending-actions":
@@ -757,19 +890,27 @@ class Driver(pubsub.Listener):
             event()
         elif topicname == "driver-async-dialogs":
             if isinstance(event, tuple):
-                conn, dialog = event
+                conn, dialog, *job = event
             else:
                 raise TypeError("event must be tuple here")
             assert type(conn) is player.PlayerConnection
             assert inspect.isgenerator(dialog)
-            self._continue_dialog(conn, dialog, "")     # type: ignore
+            if job:
+                self.waiting_for_jobs.discard(conn)
+                self._continue_dialog(conn, dialog, job[0])     # type: ignore
+            else:
+                self._continue_dialog(conn, dialog, "")     # type: ignore
         else:
             raise ValueError("unknown topic: " + str(topicname))
 
-    def remove_deferreds(self, owner: str) -> None:
+    def remove_deferreds(self, owner: Any) -> None:
+        """Cancels all deferreds of the owner, including the ones that are due in the current server tick."""
         with self.deferreds_lock:
-            self.deferreds = [d for d in self.deferreds if d.owner is not owner]
-            heapq.heapify(self.deferreds)
+            for deferred in self.deferreds.remove_group(id(owner)):
+                deferred.cancel()
+            for deferred in self.deferreds_due:
+                if getattr(deferred, "owner", None) is owner:   # finished deferreds no longer have an owner
+                    deferred.cancel()
 
     def register_periodicals(self, obj: base.MudObject) -> None:
         for func, period in util.get_periodicals(obj).items():
@@ -5,10 +5,12 @@ Single user driver (for interactive fiction).
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import os
 import sys
 import time
 import threading
-from typing import Generator, Optional, Union
+import zlib
+from typing import Generator, Optional, Dict, Tuple, Any
 from .story import GameMode, TickMethod, StoryConfig
 from . import base
 from . import charbuilder
@@ -23,11 +25,17 @@ from .tio import DEFAULT_SCREEN_DELAY
 from .tio import iobase
 
 
+# events (player, savegame writer, exception or None) are sent when a savegame has been written
+topic_savegame = pubsub.topic("driver-savegame")
+
+
 class IFDriver(driver.Driver):
     """
     The Single user 'driver'.
     Used to control interactive fiction where there's only one 'player'.
     """
+    max_savegame_delta = 0.5    # a delta save that contains more than this fraction of the objects, is followed by a full save
+
     def __init__(self, *, screen_delay: int=DEFAULT_SCREEN_DELAY, gui: bool=False, web: bool=False, wizard_override: bool=False) -> None:
         super().__init__()
         self.game_mode = GameMode.IF
@@ -40,6 +48,10 @@ class IFDriver(driver.Driver):
         if web:
             self.io_type = "web"
         self.wizard_override = wizard_override
+        self.savegame_id = ""
+        self.savegame_digests = None    # type: Optional[Dict[Tuple[str, int], bytes]]  # of the last full save, to make delta saves
+        self.savegame_thread = None     # type: Optional[threading.Thread]
+        topic_savegame.subscribe(self)
 
     def start_main_loop(self):
         if self.io_type == "web":
@@ -77,20 +89,84 @@ class IFDriver(driver.Driver):
     def do_save(self, player: Player) -> None:
         if not self.story.config.savegames_enabled:
             raise errors.ActionRefused("It is not possible to save your progress.")
-        serializer = savegames.TaleSerializer()
+        self.wait_for_savegame()    # one save at a time
+        savegame_filename = util.storyname_to_filename(self.story.config.name) + ".savegame"
+        if self.savegame_digests is None:
+            writer = savegames.SavegameWriter()
+        else:
+            writer = savegames.SavegameWriter(self.savegame_id, self.savegame_digests)
         all_locations = [loc for loc in base.MudObjRegistry.all_locations.values()]
         all_items = [i for i in base.MudObjRegistry.all_items.values() if i.contained_in]
         all_livings = [l for l in base.MudObjRegistry.all_livings.values() if l.location]
         all_exits = list(base.MudObjRegistry.all_exits.values())
-        savedata = serializer.serialize(self.story.config, player, all_items, all_livings, all_locations, all_exits,
-                                        self.deferreds, self.game_clock)
+        snapshot = savegames.SavegameSnapshot(self.story.config, player, all_items, all_livings, all_locations, all_exits,
+                                              [d for d in self.deferreds if not d.cancelled], self.game_clock)
         del all_locations, all_exits, all_items, all_livings
-        self.user_resources[util.storyname_to_filename(self.story.config.name) + ".savegame"] = savedata
+        # serializing, compressing and writing the savegame is done in the background, the game continues meanwhile.
+        self.savegame_thread = threading.Thread(name="savegame", target=self._write_savegame,
+                                                args=(player, writer, snapshot, savegame_filename))
+        self.savegame_thread.daemon = True
+        self.savegame_thread.start()
+        if self.story.config.server_tick_method == TickMethod.COMMAND:
+            # the game doesn't continue until the next command anyway, so we can just as well show the result right away
+            self.wait_for_savegame()
+
+    def _write_savegame(self, player: Player, writer: savegames.SavegameWriter,
+                        snapshot: savegames.SavegameSnapshot, savegame_filename: str) -> None:
+        # runs in the savegame thread. The outcome is reported via the savegame topic.
+        try:
+            filename = savegame_filename + ".delta" if writer.is_delta else savegame_filename
+            # write a temporary file first, so that the previous savegame stays intact if something goes wrong
+            stream = self.user_resources.open_write(filename + ".tmp")
+            try:
+                with stream:
+                    writer.write_snapshot(stream, snapshot)
+                    stream.flush()
+                    os.fsync(stream.fileno())
+                self.user_resources.replace(filename + ".tmp", filename)
+            except Exception:
+                del self.user_resources[filename + ".tmp"]
+                raise
+            if not writer.is_delta:
+                del self.user_resources[savegame_filename + ".delta"]     # the old delta belongs to the previous full save
+        except Exception as x:
+            topic_savegame.send((player, writer, x))
+        else:
+            topic_savegame.send((player, writer, None))
+
+    def wait_for_savegame(self) -> None:
+        """Waits until the savegame that is being written in the background (if any) is done, and reports the outcome."""
+        if self.savegame_thread:
+            self.savegame_thread.join()
+            self.savegame_thread = None
+            pubsub.sync("driver-savegame")
+
+    def _savegame_done(self, player: Player, writer: savegames.SavegameWriter, error: Optional[Exception]) -> None:
+        if error:
+            self.savegame_digests = None    # make a full save next time
+            player.tell("<it>Saving the game failed:</> " + str(error), end=True)
+            return
+        if writer.is_delta:
+            if writer.num_written > writer.num_objects * self.max_savegame_delta:
+                self.savegame_digests = None    # the delta has grown too large, make a full save next time
+        else:
+            self.savegame_id = writer.save_id
+            self.savegame_digests = writer.digests
         player.tell("Game saved.")
         if self.story.config.display_gametime:
             player.tell("Game time: %s" % self.game_clock)
         player.tell("\n")
 
+    def pubsub_event(self, topicname: pubsub.TopicNameType, event: Any) -> None:
+        if topicname == "driver-savegame":
+            self._savegame_done(*event)
+        else:
+            super().pubsub_event(topicname, event)
+
+    def _stop_driver(self) -> None:
+        self.wait_for_savegame()
+        super()._stop_driver()
+
     def connect_player(self, player_io_type: str, line_delay: int) -> PlayerConnection:
         connection = PlayerConnection()
         connect_name = "<connecting_%d>" % id(connection)  # unique temporary name
@@ -295,16 +371,18 @@ class IFDriver(driver.Driver):
         # at this time, game loading/saving is only supported in single player IF mode.
         assert len(self.all_players) == 1
         conn = list(self.all_players.values())[0]
+        savegame_filename = util.storyname_to_filename(self.story.config.name) + ".savegame"
         try:
-            savegame = self.user_resources[util.storyname_to_filename(self.story.config.name) + ".savegame"].data
-            deserializer = savegames.TaleDeserializer()
-            state = deserializer.deserialize(savegame)
-            del savegame
-        except (ValueError, TypeError) as x:
-            print("There was a problem loading the saved game data:")
-            print(type(x).__name__, x)
-            self._stop_driver()
-            raise SystemExit(10)
+            savegame = self.user_resources[savegame_filename].data
+            try:
+                delta = self.user_resources[savegame_filename + ".delta"].data
+            except FileNotFoundError:
+                delta = None
+            reader = savegames.SavegameReader(savegame, delta)
+            del savegame, delta
+            reader.validate()   # a damaged savegame is detected before anything in the world is changed
+        except (ValueError, TypeError, EOFError, zlib.error) as x:
+            self._savegame_load_failed(x)
         except FileNotFoundError:
             existing_player.tell("No saved game data found.", end=True)
             return None
@@ -312,93 +390,24 @@ class IFDriver(driver.Driver):
             existing_player.tell("Failed to load save game data: " + str(x), end=True)
             return None
         else:
-            savegame_version = state["story_config"]["version"]
+            loader = savegames.SavegameLoader()
+            try:
+                saved_player = loader.load(reader.records())    # the records are decoded one at a time while loading
+            except (ValueError, TypeError, SyntaxError, LookupError, errors.TaleError) as x:
+                self._savegame_load_failed(x)   # the world is already partly replaced, so we can't continue
+            savegame_version = loader.story_config.version
             if savegame_version != self.story.config.version:
                 existing_player.tell("\n")
-                existing_player.tell("<it>Note: the saved game data is from a different version of the game and may cause problems.</>")
+                existing_player.tell("<it>Note: the saved game data is from a different version of the game "
+                                     "and may cause problems.</>")
                 existing_player.tell("We'll attempt to load it anyway. (Current game version: %s / Saved game data version: %s). "
                                      % (self.story.config.version, savegame_version), end=True)
-            objects_finder = SavegameExistingObjectsFinder()
-
-            clock = deserializer.recreate_classes(state.pop("clock"), None)
-            assert isinstance(clock, util.GameDateTime)
-            self.game_clock = clock
-
-            story_config = deserializer.recreate_classes(state.pop("story_config"), None)
-            assert isinstance(story_config, StoryConfig)
-            self.story.config = story_config
-
-            exits_data = list(sorted(state.pop("exits"), key=lambda d: d.get("vnum")))
-            saved_exits = deserializer.recreate_classes(exits_data, objects_finder)
-            assert all(isinstance(e, base.Exit) for e in saved_exits)
-
-            items_data = list(sorted(state.pop("items"), key=lambda d: d.get("vnum")))
-            saved_items_info = deserializer.recreate_classes(items_data, objects_finder)
-            # link items contained in other items
-            for item_info in saved_items_info:
-                item = item_info["item"]
-                assert isinstance(item, base.Item)
-                if item_info["contains"]:
-                    if isinstance(item, base.Container):
-                        contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in item_info["contains"]}
-                        item.init_inventory(contained)
-                    else:
-                        raise errors.TaleError("can't put stuff in an item that isn't a Container")
-
-            loc_data = list(sorted(state.pop("locations"), key=lambda d: d.get("vnum")))
-            saved_locs = deserializer.recreate_classes(loc_data, objects_finder)
-            assert all(isinstance(l, base.Location) for l in saved_locs)
-
-            livings_data = list(sorted(state.pop("livings"), key=lambda d: d.get("vnum")))
-            saved_livings_info = deserializer.recreate_classes(livings_data, objects_finder)
-            for living_info in saved_livings_info:
-                living = living_info["living"]
-                assert isinstance(living, base.Living)
-                if living_info["inventory"]:
-                    contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in living_info["inventory"]}
-                    living.init_inventory(contained)
-                loc = objects_finder.resolve_location_ref(*living_info["location"])
-                if living.location and living.location is not loc:
-                    living.location.remove(living, living)
-                # we can't yet set following because it might still point to a non-existing player object. Do that later.
-                loc.insert(living, living)
-
-            saved_player_info = deserializer.recreate_classes(state.pop("player"), None)
-            saved_player = saved_player_info["player"]
-            assert isinstance(saved_player, Player)
-            base.MudObjRegistry.all_livings[saved_player.vnum] = saved_player   # overwrite intermediate player object
-            contained = {objects_finder.resolve_item_ref(*i_ref) for i_ref in saved_player_info["inventory"]}
-            for thing in contained:
-                if thing.contained_in and thing.contained_in is not saved_player:
-                    # remove the item from its original location, the player now has it in its pocketses
-                    thing.contained_in.remove(thing, None)
-            saved_player.init_inventory(contained)
-            loc = objects_finder.resolve_location_ref(*saved_player_info["location"])
-            if saved_player.location and saved_player.location is not loc:
-                saved_player.location.remove(saved_player, saved_player)
-            loc.insert(saved_player, saved_player)
-            saved_player.known_locations = {objects_finder.resolve_location_ref(*loc_info) for loc_info in saved_player_info["known_locs"]}
-            if saved_player_info["following"]:
-                saved_player.following = objects_finder.resolve_living_ref(*saved_player_info["following"])
+            self.story.config = loader.story_config
+            self.game_clock = loader.clock
+            self.deferreds.clear(driver.gametime_seconds(self.game_clock.clock))
+            for deferred in loader.deferreds:
+                self._enqueue_deferred(deferred)
             self.all_players = {saved_player.name: conn}
-
-            # creatures that follow other creatures (or the player).
-            # hook this up here at the end otherwise it may point to a non-existing player object.
-            for living_info in saved_livings_info:
-                if living_info["following"]:
-                    living = living_info["living"]
-                    assert isinstance(living, base.Living)
-                    living.following = objects_finder.resolve_living_ref(*living_info["following"])
-
-            saved_deferreds = deserializer.recreate_classes(state.pop("deferreds"), objects_finder)
-            assert all(isinstance(d, driver.Deferred) for d in saved_deferreds)
-            self.deferreds = []
-            for d in saved_deferreds:
-                self._enqueue_deferred(d)
-
-            # done, check
-            assert len(state) == 0, "everything must have been converted"
-
             self.waiting_for_input = {}   # can't keep the old waiters around
             saved_player.tell("\n")
             saved_player.tell("Game loaded.")
@@ -409,48 +418,8 @@ class IFDriver(driver.Driver):
                 saved_player.privileges.add("wizard")
             return saved_player
 
-
-class SavegameExistingObjectsFinder:
-    def resolve_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.MudObject:
-        if baseclassname == "tale.base.Item":
-            return self.resolve_item_ref(vnum, name, classname, baseclassname)
-        elif baseclassname == "tale.base.Location":
-            return self.resolve_location_ref(vnum, name, classname, baseclassname)
-        elif baseclassname == "tale.base.Living":
-            return self.resolve_living_ref(vnum, name, classname, baseclassname)
-        else:
-            raise errors.TaleError("invalid base class for resolve_ref: " + baseclassname)
-
-    def resolve_location_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Location:
-        loc = base.MudObjRegistry.all_locations.get(vnum, None)
-        if not loc:
-            raise LookupError("location vnum not found: " + str(vnum))
-        if loc.name != name or savegames.qual_baseclassname(loc) != baseclassname:
-            raise errors.TaleError("location inconsistency for vnum " + str(vnum))
-        return loc
-
-    def resolve_living_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Living:
-        liv = base.MudObjRegistry.all_livings.get(vnum, None)
-        if not liv:
-            raise LookupError("living vnum not found: " + str(vnum))
-        if liv.name != name:
-            if savegames.qual_baseclassname(liv) != baseclassname:
-                if baseclassname == "tale.player.Player":
-                    return liv  # special case when the living is the Player
-                raise errors.TaleError("living inconsistency for vnum " + str(vnum))
-        return liv
-
-    def resolve_item_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> base.Item:
-        item = base.MudObjRegistry.all_items.get(vnum, None)
-        if not item:
-            raise LookupError("item vnum not found: " + str(vnum))
-        if item.name != name or savegames.qual_baseclassname(item) != baseclassname:
-            raise errors.TaleError("item inconsistency for vnum " + str(vnum))
-        return item
-
-    def resolve_exit(self, vnum: int, name: str, classname: str, baseclassname: str) -> Union[base.Exit, base.Door]:
-        assert baseclassname == "tale.base.Exit"
-        exit = base.MudObjRegistry.all_exits[vnum]
-        if exit.name != name or savegames.qual_baseclassname(exit) != baseclassname:
-            raise errors.TaleError("exit/door inconsistency for vnum " + str(vnum))
-        return exit
+    def _savegame_load_failed(self, x: Exception) -> None:
+        print("There was a problem loading the saved game data:")
+        print(type(x).__name__, x)
+        self._stop_driver()
+        raise SystemExit(10)
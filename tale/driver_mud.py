@@ -5,10 +5,12 @@ Mud driver (multi user server).
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import concurrent.futures
 import time
 import socket
+import sys
 import threading
-from typing import Union, Generator, Dict, Tuple, Optional, Any
+from typing import Union, Generator, Dict, Tuple, Optional, Any, Callable
 
 from .story import GameMode
 from . import accounts
@@ -17,9 +19,11 @@ from . import charbuilder
 from . import driver
 from . import errors
 from . import lang
+from . import persistence
 from . import pubsub
 from . import util
 from .player import PlayerConnection, Player
+from .tio.iobase import IoAdapterBase
 from .tio.mud_browser_io import TaleMudWsgiApp
 
 
@@ -33,12 +37,11 @@ class MudDriver(driver.Driver):
         self.game_mode = GameMode.MUD
         self.restricted = restricted   # restricted mud mode? (no new players allowed)
         self.mud_accounts = None   # type: accounts.MudAccounts
+        self.world_store = persistence.WorldStore()
 
     def start_main_loop(self):
         # Driver runs as main thread, wsgi webserver runs in background thread
-        accounts_db_file = self.user_resources.validate_path("useraccounts.sqlite")
-        self.mud_accounts = accounts.MudAccounts(accounts_db_file)
-        base._limbo.init_inventory([LimboReaper()])  # add the grim reaper to Limbo
+        self._init_mud_world()
         wsgi_server = TaleMudWsgiApp.create_app_server(self, use_ssl=False, ssl_certs=None)    # you can enable SSL here
         wsgi_thread = threading.Thread(name="wsgi", target=wsgi_server.serve_forever)
         wsgi_thread.daemon = True
@@ -47,17 +50,35 @@ class MudDriver(driver.Driver):
         if self.restricted:
             print("\n* Restricted mode: no new players allowed *\n")
         protocol = "https" if wsgi_server.use_ssl else "http"
-        if wsgi_server.address_family == socket.AF_INET6:
-            hostname, port, _, _ = wsgi_server.server_address
+        self._print_web_server_url(protocol, wsgi_server.address_family, wsgi_server.server_address)
+        self._main_loop_wrapper(None)   # this doesn't return!
+
+    def _init_mud_world(self) -> None:
+        """Opens the user accounts database and the world store, and puts the mud-specific objects in the world."""
+        accounts_db_file = self.user_resources.validate_path("useraccounts.sqlite")
+        self.mud_accounts = accounts.MudAccounts(accounts_db_file, self.story.config.mud_password_hashing,
+                                                 self.story.config.mud_password_workers)
+        world_db_file = self.user_resources.validate_path("world.sqlite")
+        self.world_store.open(world_db_file)    # restores the state of the persistent objects
+        base._limbo.init_inventory([LimboReaper()])  # add the grim reaper to Limbo
+
+    def _stop_driver(self) -> None:
+        super()._stop_driver()
+        self.world_store.close()
+        if self.mud_accounts:
+            self.mud_accounts.close()
+
+    def _print_web_server_url(self, protocol: str, address_family: int, server_address: Tuple) -> None:
+        if address_family == socket.AF_INET6:
+            hostname, port = server_address[:2]
             if hostname[0] != '[':
                 hostname = '[' + hostname + ']'
             print("Access the game on this web server url (ipv6):   %s://%s:%d/tale/" % (protocol, hostname, port), end="\n\n")
         else:
-            hostname, port = wsgi_server.server_address
+            hostname, port = server_address[:2]
             if hostname.startswith("127.0"):
                 hostname = "localhost"
             print("Access the game on this web server url (ipv4):   %s://%s:%d/tale/" % (protocol, hostname, port), end="\n\n")
-        self._main_loop_wrapper(None)   # this doesn't return!
 
     def show_motd(self, player: Player, notify_no_motd: bool=False) -> None:
         """Prints the Message-Of-The-Day file, if present."""
@@ -84,12 +105,16 @@ class MudDriver(driver.Driver):
     def connect_player(self, player_io_type: str, line_delay: int) -> PlayerConnection:
         if player_io_type != "web":
             raise ValueError("mud connections can only be done via web interface")
+        from .tio.mud_browser_io import MudHttpIo
+        return self._connect_player(MudHttpIo)
+
+    def _connect_player(self, io_factory: Callable[[PlayerConnection], IoAdapterBase]) -> PlayerConnection:
+        """Creates a new player connection using the I/O adapter made by the factory, and starts the login dialog on it."""
         connection = PlayerConnection()
         connect_name = "<connecting_%d>" % id(connection)  # unique temporary name
         new_player = Player(connect_name, "n", race="elemental", descr="This player is still connecting to the game.")
         connection.player = new_player
-        from .tio.mud_browser_io import MudHttpIo
-        connection.io = MudHttpIo(connection)
+        connection.io = io_factory(connection)
         self.all_players[new_player.name] = connection
         connection.clear_screen()
         self.print_game_intro(connection)
@@ -98,9 +123,11 @@ class MudDriver(driver.Driver):
         if len(self.mud_accounts.all_accounts(having_privilege="wizard")) == 0:
             # there is no wizard, create a dialog to construct the initial admin user
             driver.topic_async_dialogs.send((connection, self._login_dialog_mud_create_admin(connection)))
+            self.wakeup()
             return connection
         # create the login dialog
         driver.topic_async_dialogs.send((connection, self._login_dialog_mud(connection)))
+        self.wakeup()   # connecting happens in the web server's thread, make sure the driver starts the dialog asap
         return connection
 
     def disconnect_idling(self, conn: PlayerConnection) -> None:
@@ -163,7 +190,7 @@ class MudDriver(driver.Driver):
             else:
                 break
         stats = base.Stats.from_race(race, gender=gender[0])
-        self.mud_accounts.create(name, password, email, stats, privileges={"wizard"})
+        yield "wait", self.mud_accounts.submit(self.mud_accounts.create, name, password, email, stats, {"wizard"})
         conn.output("<it>Okay, your admin account is ready. You can try logging in.</it>\n")
         conn.output("\n")
         yield from self._login_dialog_mud(conn)  # continue with the normal login dialog
@@ -205,24 +232,28 @@ class MudDriver(driver.Driver):
                     conn.player.tell("\n<bright>Your account has not been created!</>", end=True)
                     conn.player.tell("-- -- -- --", end=True)
                     continue
-                self.mud_accounts.create(name_info.name, name_info.password, name_info.email, name_info.stats)
+                yield "wait", self.mud_accounts.submit(self.mud_accounts.create, name_info.name, name_info.password,
+                                                       name_info.email, name_info.stats)
                 self.mud_accounts.save_story_data(name_info.name, name_info.story_data)
                 del name_info
                 conn.player.tell("\n<bright>Your new account has been created!</>  Go ahead and log in with it.", end=True)
                 conn.player.tell("-- -- -- --", end=True)
                 continue
 
-            # ask and validate the password.
+            # ask and validate the password (against the account we already have, no need to ask the database again).
+            # hashing takes a while, so it is done by a worker thread. Old style hashes are upgraded meanwhile.
             try:
                 password = yield "input-noecho", "Please type in your password."
-                self.mud_accounts.valid_password(name, password)
+                yield "wait", self.mud_accounts.submit(self.mud_accounts.check_password, account, password)
+                if self.mud_accounts.needs_rehash(account):
+                    rehash = self.mud_accounts.submit(self.mud_accounts.rehash_password, account.name, password)
+                    rehash.add_done_callback(self._rehash_password_done)
                 del password
             except ValueError as x:
                 conn.output("<it>%s</it>" % x)
                 continue
 
-            # try to get the account and see if it is banned or not.
-            account = self.mud_accounts.get(name)
+            # see if the account is banned or not.
             if account.banned:
                 conn.player.tell("\n<bright>You have been banned by an admin!</>  Try logging in later or get in touch.", end=True)
                 conn.player.tell("\n")
@@ -282,7 +313,7 @@ class MudDriver(driver.Driver):
             name_info.gender = account.stats.gender
             name_info.stats = account.stats
             self._rename_player(conn.player, name_info)
-            conn.player.privileges = account.privileges
+            conn.player.privileges = set(account.privileges)
             conn.player.story_data = account.story_data
             conn.output("\n")
             if "wizard" in conn.player.privileges:
@@ -328,72 +359,107 @@ class MudDriver(driver.Driver):
         """
         The game loop, for the multiplayer MUD mode.
         Until the server is shut down, it processes player input, and prints the resulting output.
+        Rather than polling, the loop sleeps until it is woken up (see Driver.wakeup) because
+        player input arrived or a new async dialog was started, or until the next server tick is due.
         """
-        loop_duration = 0.0
-        previous_server_tick = 0.0
+        next_server_tick = time.time()
         while not self._stop_mainloop:
-            pubsub.sync("driver-async-dialogs")
-            for conn in self.all_players.values():
-                conn.write_output()
-                if conn not in self.waiting_for_input:
-                    conn.write_input_prompt()
-
-            # server tick goes on a timer
-            wait_time = max(0.01, self.story.config.server_tick_time - loop_duration)
-            while wait_time > 0:
-                if any(conn.player.input_is_available.is_set() for conn in self.all_players.values()):
-                    # there was player input, abort the wait loop and deal with it
-                    break
-                sub_wait = min(0.1, wait_time)  # keep things responsive
-                time.sleep(sub_wait)
-                wait_time -= sub_wait
-
+            self._main_loop_write_output()
+            # wait for player input, but no longer than until the next server tick is due.
+            # the wakeup flag is cleared *before* looking at the input so that no signal can get lost.
+            wait_time = next_server_tick - time.time()
+            if wait_time > 0:
+                self.main_loop_wakeup.wait(wait_time)
+            self.main_loop_wakeup.clear()
             loop_start = time.time()
-            for conn in list(self.all_players.values()):
-                if conn.player.input_is_available.is_set():
-                    conn.need_new_input_prompt = True
-                    try:
-                        if conn in self.waiting_for_input:
-                            # this connection is processing direct input, rather than regular commands
-                            dialog, validator, echo_input = self.waiting_for_input.pop(conn)
-                            response = conn.player.get_pending_input()[0]
-                            if validator:
-                                try:
-                                    response = validator(response)
-                                except ValueError as x:
-                                    prompt = conn.last_output_line
-                                    conn.io.dont_echo_next_cmd = not echo_input
-                                    conn.output(str(x) or "That is not a valid answer.")
-                                    conn.output_no_newline(prompt)   # print the input prompt again
-                                    self.waiting_for_input[conn] = (dialog, validator, echo_input)   # reschedule
-                                    continue
-                            self._continue_dialog(conn, dialog, response)
-                        else:
-                            # normal command processing
-                            self._server_loop_process_player_input(conn)
-                    except (KeyboardInterrupt, EOFError):
-                        continue
-                    except errors.SessionExit:
-                        self.story.goodbye(conn.player)
-                        driver.topic_pending_tells.send(lambda conn=conn: self.disconnect_player(conn))
-                    except Exception:
-                        tb = "".join(util.format_traceback())
-                        txt = "\n<bright><rev>* internal error (please report this):</>\n" + tb
-                        conn.player.tell(txt, format=False)
-                        conn.player.tell("<rev><it>Please report this problem.</>")
-            try:
-                pubsub.sync("driver-pending-tells")
-                # server TICK
-                now = time.time()
-                if now - previous_server_tick >= self.story.config.server_tick_time:
-                    self._server_tick()
-                    previous_server_tick = now
-                loop_duration = time.time() - loop_start
-                self.server_loop_durations.append(loop_duration)
-            except errors.StoryCompleted:
-                print("StoryCompleted raised! But that should never happen in a MUD!")
+            self._main_loop_process_input()
+            next_server_tick = self._main_loop_server_tick(next_server_tick, loop_start)
+
+    def _main_loop_write_output(self) -> None:
+        """Starts new async dialogs, and writes pending output and input prompts to all connections."""
+        pubsub.sync("driver-async-dialogs")
+        output_start = time.perf_counter()
+        self.write_players_output(self.all_players.values())
+        for conn in self.all_players.values():
+            if conn not in self.waiting_for_input:
+                conn.write_input_prompt()
+        self.tick_stats.add_phase("output", time.perf_counter() - output_start)
+
+    def _main_loop_process_input(self) -> None:
+        """Processes the input of every connection that has some available (commands, or answers to a dialog)."""
+        for conn in list(self.all_players.values()):
+            if conn.player.input_is_available.is_set() and conn not in self.waiting_for_jobs:
+                conn.need_new_input_prompt = True
+                try:
+                    if conn in self.waiting_for_input:
+                        # this connection is processing direct input, rather than regular commands
+                        dialog, validator, echo_input = self.waiting_for_input.pop(conn)
+                        response = conn.player.get_pending_input()[0]
+                        if validator:
+                            try:
+                                response = validator(response)
+                            except ValueError as x:
+                                prompt = conn.last_output_line
+                                conn.io.dont_echo_next_cmd = not echo_input
+                                conn.output(str(x) or "That is not a valid answer.")
+                                conn.output_no_newline(prompt)   # print the input prompt again
+                                self.waiting_for_input[conn] = (dialog, validator, echo_input)   # reschedule
+                                continue
+                        self._continue_dialog(conn, dialog, response)
+                    else:
+                        # normal command processing
+                        self._server_loop_process_player_input(conn)
+                except (KeyboardInterrupt, EOFError):
+                    continue
+                except errors.SessionExit:
+                    self.story.goodbye(conn.player)
+                    driver.topic_pending_tells.send(lambda conn=conn: self.disconnect_player(conn))
+                except Exception:
+                    tb = "".join(util.format_traceback())
+                    txt = "\n<bright><rev>* internal error (please report this):</>\n" + tb
+                    conn.player.tell(txt, format=False)
+                    conn.player.tell("<rev><it>Please report this problem.</>")
+
+    def _main_loop_server_tick(self, next_server_tick: float, loop_start: float) -> float:
+        """
+        Processes the pending tells, and runs the server tick if it is due.
+        Returns the time the next server tick is due.
+        """
+        try:
+            pubsub.sync("driver-pending-tells")
+            # server TICK, on a fixed schedule regardless of how often player input woke us up
+            now = time.time()
+            if now >= next_server_tick:
+                self._server_tick()
+                next_server_tick += self.story.config.server_tick_time
+                if next_server_tick < now:
+                    # we fell behind (slow tick, or system suspend), don't try to catch up with a burst of ticks
+                    next_server_tick = now + self.story.config.server_tick_time
+            if self.world_store.checkpoint_due(now, self.story.config.checkpoint_time):
+                self._checkpoint_world()
+            loop_duration = time.time() - loop_start
+            self.server_loop_durations.append(loop_duration)
+            return next_server_tick
+        except errors.StoryCompleted:
+            print("StoryCompleted raised! But that should never happen in a MUD!")
+            for conn in self.all_players.values():
                 conn.player.tell("<rev>StoryCompleted event in MUD mode - should NOT happen</> - Please report this error")
-                raise
+            raise
+
+    def _checkpoint_world(self) -> None:
+        """Writes the changed state of the persistent objects to the world store."""
+        try:
+            self.world_store.checkpoint()
+        except Exception:
+            print("\n* Error while writing the world state checkpoint:", file=sys.stderr)
+            print("".join(util.format_traceback()), file=sys.stderr)
+
+    def _rehash_password_done(self, future: concurrent.futures.Future) -> None:
+        # nobody waits for the upgrade of an old style password hash, so report it if it failed
+        x = future.exception()
+        if x:
+            print("\n* Error while rehashing a password:", file=sys.stderr)
+            print("".join(util.format_traceback(type(x), x, x.__traceback__, detailed=False)), file=sys.stderr)
 
 
 class LimboReaper(base.Living):
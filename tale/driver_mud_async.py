@@ -0,0 +1,93 @@
+"""
+Mud driver (multi user server) that runs on a single asyncio event loop.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+from .driver_mud import MudDriver
+from .player import PlayerConnection
+from .tio.mud_async_io import AsyncMudHttpIo, AsyncTaleMudWsgiApp, TelnetIo, TelnetServer
+
+
+class AsyncMudDriver(MudDriver):
+    """
+    Variant of the Mud driver that runs the game loop, the web server (including the
+    event streams to the browsers) and the optional telnet server all on one asyncio event loop.
+    Connected players don't need a thread each this way. The server tick, the command processing
+    and the login dialogs are the same as those of the regular Mud driver.
+    """
+    def __init__(self, restricted=False, telnet_port=0) -> None:
+        super().__init__(restricted)
+        self.telnet_port = telnet_port      # port number of the telnet server (0 = no telnet server)
+        self.event_loop = None              # type: asyncio.AbstractEventLoop
+        self.async_wakeup = None            # type: asyncio.Event
+
+    def start_main_loop(self):
+        self._init_mud_world()
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+        self.async_wakeup = asyncio.Event()
+        web_server = AsyncTaleMudWsgiApp.create_app_server(self)
+        self.event_loop.run_until_complete(web_server.start())
+        telnet_server = None
+        if self.telnet_port:
+            telnet_server = TelnetServer(self, self.story.config.mud_host, self.telnet_port)
+            self.event_loop.run_until_complete(telnet_server.start())
+        self.print_game_intro(None)
+        if self.restricted:
+            print("\n* Restricted mode: no new players allowed *\n")
+        self._print_web_server_url("http", web_server.address_family, web_server.server_address)
+        if telnet_server:
+            hostname, port = telnet_server.server_address[:2]
+            print("Access the game via telnet on:   %s port %d" % (hostname, port), end="\n\n")
+        try:
+            self._main_loop_wrapper(None)
+        finally:
+            # give the connections a moment to write their last output, then close everything down
+            self.event_loop.run_until_complete(asyncio.sleep(0.1))
+            web_server.close()
+            if telnet_server:
+                telnet_server.close()
+
+    def wakeup(self) -> None:
+        super().wakeup()
+        if self.event_loop and not self.event_loop.is_closed():
+            self.event_loop.call_soon_threadsafe(self.async_wakeup.set)
+
+    def connect_player(self, player_io_type: str, line_delay: int) -> PlayerConnection:
+        if player_io_type != "web":
+            raise ValueError("use connect_telnet_player for telnet connections")
+        return self._connect_player(AsyncMudHttpIo)
+
+    def connect_telnet_player(self, writer: asyncio.StreamWriter) -> PlayerConnection:
+        return self._connect_player(lambda conn: TelnetIo(conn, writer))
+
+    def main_loop(self, conn: Optional[PlayerConnection]) -> None:
+        self.event_loop.run_until_complete(self._async_main_loop())
+
+    async def _async_main_loop(self) -> None:
+        """
+        The game loop, for the asyncio MUD mode. It is the same loop as the regular Mud driver's,
+        but it awaits the wakeup signal so that the servers on the event loop keep running meanwhile.
+        """
+        next_server_tick = time.time()
+        while not self._stop_mainloop:
+            self._main_loop_write_output()
+            wait_time = next_server_tick - time.time()
+            if wait_time > 0:
+                try:
+                    await asyncio.wait_for(self.async_wakeup.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(0)    # always give the servers a chance to run
+            self.async_wakeup.clear()
+            self.main_loop_wakeup.clear()
+            loop_start = time.time()
+            self._main_loop_process_input()
+            next_server_tick = self._main_loop_server_tick(next_server_tick, loop_start)
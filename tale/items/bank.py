@@ -8,17 +8,18 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 import datetime
 from collections import defaultdict, deque
 import json
-from typing import Dict, MutableSequence, Optional
+from typing import Dict, MutableSequence, Optional, Any
 
 from .. import mud_context
 from ..base import Item, Living, ParseResult
 from ..errors import ActionRefused
+from ..persistence import Persistent
 
 
 __all__ = ["Bank"]
 
 
-class Bank(Item):
+class Bank(Item, Persistent):
     max_num_transactions = 1000
     """An item (such as ATM or cash card) that you can deposit and withdraw money from. The money is then safe when you log out."""
     def init(self) -> None:
@@ -67,7 +68,7 @@ class Bank(Item):
             self.log_transaction(actor, parsed.verb, amount, self.accounts[actor.name])
             try:
                 assert actor.money >= 0.0 and self.accounts[actor.name] >= 0.0
-                self.save()
+                self.save_transaction(actor.name)
             except Exception:
                 self.accounts[actor.name] = old_balance
                 raise
@@ -85,7 +86,7 @@ class Bank(Item):
             self.log_transaction(actor, parsed.verb, amount, self.accounts[actor.name])
             try:
                 assert actor.money >= 0.0 and self.accounts[actor.name] >= 0.0
-                self.save()
+                self.save_transaction(actor.name)
             except Exception:
                 self.accounts[actor.name] = old_balance
                 raise
@@ -102,27 +103,68 @@ class Bank(Item):
                                             amount_str=amount_str, balance=balance))
 
     def load(self) -> None:
-        """Load persisted bank account data from the datafile."""
+        """
+        Load persisted bank account data. In mud mode the data is kept in the driver's world store
+        (the old data file is converted once), otherwise it is read from the data file.
+        """
         if not self.storage_file:
             return
-        try:
-            data = json.loads(mud_context.driver.user_resources[self.storage_file].text)
-            self.accounts = data["accounts"]
-            self.transaction_log = deque(data["transactions"], maxlen=self.max_num_transactions)
-        except FileNotFoundError:
-            pass
-        except (ValueError, IOError) as x:
-            print("Bank '%s' load error: %s" % (self.name, x))
+        if mud_context.driver.world_store:
+            mud_context.driver.world_store.register(self.storage_file, self)
+        else:
+            state = self._read_datafile()
+            if state:
+                self.restore_state(state)
 
     def save(self) -> None:
-        """Save the bank account data to the data file."""
+        """Save the bank account data (at the next checkpoint of the world store in mud mode, otherwise directly to the data file)."""
         if not self.storage_file:
             return
-        data = {
-            "accounts": self.accounts,
-            "transactions": list(self.transaction_log)
-        }
+        if mud_context.driver.world_store:
+            mud_context.driver.world_store.mark_dirty(self.storage_file, self)
+            return
         try:
-            mud_context.driver.user_resources[self.storage_file] = json.dumps(data, indent=4, sort_keys=True)
+            mud_context.driver.user_resources[self.storage_file] = json.dumps(self.persistent_state(), indent=4, sort_keys=True)
         except IOError as x:
             print("Bank '%s' save error: %s" % (self.name, x))
+
+    def save_transaction(self, account: str) -> None:
+        """
+        Save the last transaction, of the given account. In mud mode it is appended to the journal of the bank
+        in the world store (rather than writing all accounts and the whole transaction log), otherwise the data file is written.
+        """
+        if self.storage_file and mud_context.driver.world_store:
+            entry = {
+                "account": account,
+                "balance": self.accounts[account],
+                "transaction": self.transaction_log[-1]
+            }
+            mud_context.driver.world_store.append(self.storage_file, self, entry)
+        else:
+            self.save()
+
+    def persistent_state(self) -> Dict[str, Any]:
+        return {
+            "accounts": dict(self.accounts),
+            "transactions": list(self.transaction_log)
+        }
+
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        self.accounts = defaultdict(float, state["accounts"])
+        self.transaction_log = deque(state["transactions"], maxlen=self.max_num_transactions)
+
+    def apply_journal_entry(self, entry: Dict[str, Any]) -> None:
+        self.accounts[entry["account"]] = entry["balance"]
+        self.transaction_log.append(entry["transaction"])
+
+    def initial_state(self) -> Optional[Dict[str, Any]]:
+        return self._read_datafile()
+
+    def _read_datafile(self) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(mud_context.driver.user_resources[self.storage_file].text)
+        except FileNotFoundError:
+            return None
+        except (ValueError, IOError) as x:
+            print("Bank '%s' load error: %s" % (self.name, x))
+            return None
@@ -8,11 +8,12 @@ Copyright by Irmen de Jong (irmen@razorvine.net)
 import datetime
 import json
 from collections import deque
-from typing import Tuple, Dict, Any, Generator, List, Sequence, MutableSequence
+from typing import Tuple, Dict, Any, Generator, List, Sequence, MutableSequence, Optional
 
 from .. import lang, mud_context
 from ..base import Item, Living, ParseResult
 from ..errors import ActionRefused, ParseError, AsyncDialog, TaleError
+from ..persistence import Persistent
 
 __all__ = ["BulletinBoard", "bulletinboard"]
 
@@ -20,7 +21,7 @@ __all__ = ["BulletinBoard", "bulletinboard"]
 PostType = Dict[str, str]
 
 
-class BulletinBoard(Item):
+class BulletinBoard(Item, Persistent):
     """A bulletin board that stores messages. You can read, post, and remove messages, and reply to them."""
     max_num_posts = 20
 
@@ -177,7 +178,7 @@ class BulletinBoard(Item):
                     "text": text
                 }
                 self.__posts.appendleft(post)       # type: ignore
-                self.save()
+                self.save_change({"post": post})
                 actor.tell("\n")
                 actor.tell("You've added the message on top of the list on the %s." % self.name)
                 return
@@ -204,7 +205,7 @@ class BulletinBoard(Item):
             del self.__posts[num - 1]
             actor.tell("You've removed message #%d (`%s') from the board." % (num, post["subject"]))
             actor.tell_others("{Actor} took a message off the %s." % self.title)
-            self.save()
+            self.save_change({"remove": num - 1})
         else:
             raise ActionRefused("You cannot remove that message.")
 
@@ -217,31 +218,68 @@ class BulletinBoard(Item):
         return None
 
     def load(self) -> None:
-        """Load persisted messages from the datafile. Note: only the posts are loaded from the datafile, not the descriptive texts"""
+        """
+        Load persisted messages. In mud mode they are kept in the driver's world store (the old data file is converted once),
+        otherwise they are read from the datafile. Note: only the posts are loaded, not the descriptive texts
+        """
         if not self.storage_file:
             return
-        try:
-            data = json.loads(mud_context.driver.user_resources[self.storage_file].text)
-            self.posts = data["posts"]
-        except FileNotFoundError:
-            pass
-        except (ValueError, IOError) as x:
-            print("Bulletin board '%s' load error: %s" % (self.name, x))
+        if mud_context.driver.world_store:
+            mud_context.driver.world_store.register(self.storage_file, self)
+        else:
+            state = self._read_datafile()
+            if state:
+                self.restore_state(state)
 
     def save(self) -> None:
-        """save the messages to persistent data file"""
+        """save the messages (at the next checkpoint of the world store in mud mode, otherwise directly to the data file)"""
         if not self.storage_file:
             return
-        data = {
+        if mud_context.driver.world_store:
+            mud_context.driver.world_store.mark_dirty(self.storage_file, self)
+            return
+        try:
+            mud_context.driver.user_resources[self.storage_file] = json.dumps(self.persistent_state(), indent=4, sort_keys=True)
+        except IOError as x:
+            print("Bulletin board '%s' save error: %s" % (self.name, x))
+
+    def save_change(self, entry: Dict[str, Any]) -> None:
+        """
+        Save a change to the messages: a new post, or the index of a removed one. In mud mode it is appended
+        to the journal of the board in the world store, otherwise the whole data file is written.
+        """
+        if self.storage_file and mud_context.driver.world_store:
+            mud_context.driver.world_store.append(self.storage_file, self, entry)
+        else:
+            self.save()
+
+    def persistent_state(self) -> Dict[str, Any]:
+        return {
             "board-name": self.name,
             "board-title": self.title,
             "posts": self.posts
         }
-        try:
-            mud_context.driver.user_resources[self.storage_file] = json.dumps(data, indent=4, sort_keys=True)
-        except IOError as x:
-            print("Bulletin board '%s' save error: %s" % (self.name, x))
 
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        self.posts = state["posts"]
+
+    def apply_journal_entry(self, entry: Dict[str, Any]) -> None:
+        if "post" in entry:
+            self.__posts.appendleft(entry["post"])      # type: ignore
+        else:
+            del self.__posts[entry["remove"]]
+
+    def initial_state(self) -> Optional[Dict[str, Any]]:
+        return self._read_datafile()
+
+    def _read_datafile(self) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(mud_context.driver.user_resources[self.storage_file].text)
+        except FileNotFoundError:
+            return None
+        except (ValueError, IOError) as x:
+            print("Bulletin board '%s' load error: %s" % (self.name, x))
+            return None
 
 bulletinboard = BulletinBoard("board", title="wooden bulletin board",
                               descr="The board contains a little plaque: \"important announcements\".",
@@ -29,6 +29,9 @@ def run_from_cmdline(cmdline: Sequence[str]) -> None:
     parser.add_argument('-i', '--gui', help='gui interface', action='store_true')
     parser.add_argument('-w', '--web', help='web browser interface', action='store_true')
     parser.add_argument('-r', '--restricted', help='restricted mud mode; do not allow new players', action='store_true')
+    parser.add_argument('-a', '--async', dest='use_async', help='mud mode: run the server on a single asyncio event loop',
+                        action='store_true')
+    parser.add_argument('-t', '--telnet', type=int, help='async mud mode: also serve telnet clients on this port', default=0)
     parser.add_argument('-z', '--wizard', help='force wizard mode on if story character (for debug purposes)', action='store_true')
     args = parser.parse_args(cmdline)
     try:
@@ -38,8 +41,12 @@ def run_from_cmdline(cmdline: Sequence[str]) -> None:
             from .driver_if import IFDriver
             driver = IFDriver(screen_delay=args.delay, gui=args.gui, web=args.web, wizard_override=args.wizard)   # type: Driver
         elif game_mode == GameMode.MUD:
-            from .driver_mud import MudDriver
-            driver = MudDriver(args.restricted)
+            if args.use_async:
+                from .driver_mud_async import AsyncMudDriver
+                driver = AsyncMudDriver(args.restricted, args.telnet)
+            else:
+                from .driver_mud import MudDriver
+                driver = MudDriver(args.restricted)
         else:
             raise ValueError("invalid game mode")
         driver.start(args.game)
@@ -0,0 +1,100 @@
+"""
+Index of mud objects by their names and aliases, used by the soul parser.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+from collections.abc import Mapping
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple, Optional
+
+__all__ = ["NameIndex"]
+
+
+class NameIndex(Mapping):
+    """
+    Read-only mapping from name (and alias) to object, that is kept up to date by adding
+    and removing the objects as they come and go (a location does this for its livings and items).
+    If multiple objects have the same name, the one added last is returned.
+    The names are also stored in a trie of words, to quickly match names that consist of several words.
+    The names of an object are taken at the time it is added; add it again if its name or aliases change.
+    """
+    def __init__(self, objects: Iterable[Any]=()) -> None:
+        self.objects = {}       # type: Dict[str, List[Any]]  # name -> objects known by that name
+        self.registered = {}    # type: Dict[Any, Tuple[str, ...]]  # object -> the names it was added with
+        self.trie = {}          # type: Dict[Optional[str], Any]  # word -> sub trie, the key None marks the end of a name
+        for obj in objects:
+            self.add(obj)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.objects[name][-1]
+
+    def __contains__(self, name: Any) -> bool:
+        return name in self.objects
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.objects)
+
+    def __len__(self) -> int:
+        return len(self.objects)
+
+    def add(self, obj: Any) -> None:
+        """Add the object under its name and aliases (replacing the names it had before, if it was already added)."""
+        if obj in self.registered:
+            self.remove(obj)
+        names = tuple({obj.name} | set(obj.aliases))
+        self.registered[obj] = names
+        for name in names:
+            objects = self.objects.get(name)
+            if objects:
+                objects.append(obj)
+            else:
+                self.objects[name] = [obj]
+                node = self.trie
+                for word in name.split(" "):
+                    node = node.setdefault(word, {})
+                node[None] = name
+
+    def remove(self, obj: Any) -> None:
+        """Remove the object. Objects that aren't in the index are ignored."""
+        names = self.registered.pop(obj, None)
+        if names is None:
+            return
+        for name in names:
+            objects = self.objects[name]
+            objects.remove(obj)
+            if not objects:
+                del self.objects[name]
+                self._remove_from_trie(name)
+
+    def clear(self) -> None:
+        self.objects.clear()
+        self.registered.clear()
+        self.trie.clear()
+
+    def match(self, words: Sequence[str], startindex: int, max_words: int=5) -> Tuple[Optional[Any], str, int]:
+        """
+        Find the shortest name that is formed by the words starting at the startindex (at most max_words of them).
+        Returns (object, name, number of words used), or (None, "", 0) if there is no such name.
+        """
+        node = self.trie
+        for wordcount, word in enumerate(words[startindex:startindex + max_words], start=1):
+            node = node.get(word)
+            if node is None:
+                break
+            name = node.get(None)
+            if name is not None:
+                return self.objects[name][-1], name, wordcount
+        return None, "", 0
+
+    def _remove_from_trie(self, name: str) -> None:
+        path = [self.trie]
+        words = name.split(" ")
+        for word in words:
+            path.append(path[-1][word])
+        del path[-1][None]
+        # prune the nodes that became empty
+        for word, node, parent in zip(reversed(words), reversed(path[1:]), reversed(path[:-1])):
+            if node:
+                break
+            del parent[word]
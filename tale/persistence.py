@@ -0,0 +1,255 @@
+"""
+Persistence of (parts of) the world state in MUD mode, so that it survives a restart of the server.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+__all__ = ["Persistent", "WorldStore"]
+
+
+class Persistent:
+    """
+    Mixin for objects that keep (part of) their state in the world store.
+    The object is registered in the store under a key, the store then restores its state.
+    Tell the store when the state has changed: either mark it dirty (the whole state is written at the next checkpoint),
+    or append a journal entry that describes the change (written right away, the whole state only when the journal is compacted).
+    Multiple objects can share the same key, they will then all get the state that was stored last.
+    """
+    def persistent_state(self) -> Dict[str, Any]:
+        """The state to be stored. It must be serializable to json."""
+        raise NotImplementedError
+
+    def restore_state(self, state: Dict[str, Any]) -> None:
+        """Restore the state that was stored earlier."""
+        raise NotImplementedError
+
+    def apply_journal_entry(self, entry: Dict[str, Any]) -> None:
+        """Replay a change that was appended to the journal, on top of the restored state."""
+        raise NotImplementedError
+
+    def initial_state(self) -> Optional[Dict[str, Any]]:
+        """
+        The state to start with when the store doesn't have one yet, for instance converted from an
+        older data file of the object. None means the object simply keeps its current state.
+        """
+        return None
+
+
+class WorldStore:
+    """
+    Keeps the state of the registered Persistent objects in a sqlite database.
+    Changes are recorded in two ways. Objects marked dirty get their whole state written at the
+    next checkpoint (see checkpoint_time in the story config), and when the server shuts down.
+    Small changes can instead be appended to the journal of the object, which only costs an insert of the entry.
+    When a journal grows longer than compact_journal entries, it is compacted: the whole state is written
+    at the next checkpoint and the journal is cleared.
+    The database writes happen in a write-behind thread that commits whatever was queued in one transaction,
+    so the game loop never waits for the disk. Journal entries are queued immediately (not at the checkpoint)
+    so they are on disk within moments. Because the thread processes the queue in order, a compacted state
+    never deletes journal entries that it doesn't contain yet.
+    Sqlite's journal makes every commit atomic: after a crash the store contains the states and journal entries
+    of the last commit, which are read and replayed with two queries at startup.
+    Objects can register before the store is opened (while the zones are loaded), their state is restored
+    as soon as it is opened.
+
+    Database:
+        state(key, data, version, saved)
+        journal(seq, key, entry)
+    """
+    compact_journal = 200
+
+    def __init__(self) -> None:
+        self.sqlite_dbpath = ""
+        self.conn = None          # type: Optional[sqlite3.Connection]
+        self.objects = {}         # type: Dict[str, weakref.WeakSet]  # key -> the objects registered under that key
+        self.stored = {}          # type: Dict[str, Dict[str, Any]]   # key -> the last stored state
+        self.journals = {}        # type: Dict[str, List[Dict[str, Any]]]  # key -> journal entries on top of the stored state
+        self.versions = {}        # type: Dict[str, int]
+        self.dirty = {}           # type: Dict[str, Persistent]      # key -> the object that changed the state last
+        self.writes = queue.Queue()     # type: queue.Queue[Optional[Tuple[str, str, Tuple]]]  # (key, sql, parameters)
+        self.writer = None        # type: Optional[threading.Thread]
+        self.failed_lock = threading.Lock()
+        self.failed_keys = set()  # type: Set[str]  # keys whose writes failed, their whole state is written again
+        self.last_checkpoint = 0.0
+        self.num_checkpoints = 0
+        self.num_written = 0
+        self.num_journaled = 0
+        self.num_compacted = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.conn is not None
+
+    def open(self, databasefile: str) -> None:
+        """Opens (or creates) the database, reads the stored states and restores the objects that are already registered."""
+        self.sqlite_dbpath = databasefile
+        urimode = databasefile.startswith("file:")
+        self.conn = sqlite3.connect(databasefile, timeout=5, uri=urimode, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS State(key varchar PRIMARY KEY, data varchar NOT NULL, "
+                              "version integer NOT NULL, saved timestamp NOT NULL);")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS Journal(seq integer PRIMARY KEY AUTOINCREMENT, "
+                              "key varchar NOT NULL, entry varchar NOT NULL);")
+        for key, data, version in self.conn.execute("SELECT key, data, version FROM State"):
+            self.stored[key] = json.loads(data)
+            self.versions[key] = version
+        for key, entry in self.conn.execute("SELECT key, entry FROM Journal ORDER BY seq"):
+            self.journals.setdefault(key, []).append(json.loads(entry))
+        for key in self.objects:
+            self._restore(key)
+        for key, journal in self.journals.items():
+            if len(journal) >= self.compact_journal:
+                self._compact(key)
+        self.last_checkpoint = time.time()
+        self.writer = threading.Thread(name="worldstore", target=self._write_behind)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def close(self) -> None:
+        """Writes the final checkpoint, waits until everything is written, and closes the database."""
+        if self.conn:
+            self.checkpoint()
+            self.writes.put(None)
+            self.writer.join()
+            self.writer = None
+            self.conn.close()
+            self.conn = None
+
+    def flush(self) -> None:
+        """Waits until everything that was queued so far has been written."""
+        if self.writer:
+            self.writes.join()
+
+    def register(self, key: str, obj: Persistent) -> bool:
+        """
+        Registers the object under the given key, and restores its stored state.
+        Returns True if a state was restored, False otherwise (the object keeps its current state then).
+        If the store isn't opened yet, the state is restored later when it is.
+        """
+        if not key:
+            raise ValueError("persistent objects need a key")
+        self.objects.setdefault(key, weakref.WeakSet()).add(obj)
+        if self.conn is None:
+            return False    # restored when the store is opened
+        return self._restore(key, [obj])
+
+    def _restore(self, key: str, objects: List[Persistent]=None) -> bool:
+        objects = objects or list(self.objects[key])
+        state = self.stored.get(key)
+        journal = self.journals.get(key, [])
+        if state is None:
+            for obj in objects:
+                state = obj.initial_state()
+                if state is not None:
+                    self.mark_dirty(key, obj)
+                    break
+            else:
+                if not journal:
+                    return False
+        for obj in objects:
+            if state is not None:
+                obj.restore_state(state)
+            for entry in journal:
+                obj.apply_journal_entry(entry)
+        return True
+
+    def unregister(self, obj: Persistent) -> None:
+        """Removes the object from the store (its last changes are still written)."""
+        for objects in self.objects.values():
+            objects.discard(obj)
+
+    def mark_dirty(self, key: str, obj: Persistent) -> None:
+        """Marks the state under the key as changed by the object. It will be written at the next checkpoint."""
+        self.dirty[key] = obj
+
+    def append(self, key: str, obj: Persistent, entry: Dict[str, Any]) -> None:
+        """
+        Appends an entry that describes a change of the object's state to the journal of the key.
+        It is written right away (by the write-behind thread). Without an open store, the object is marked dirty instead.
+        """
+        if self.conn is None:
+            self.mark_dirty(key, obj)
+            return
+        journal = self.journals.setdefault(key, [])
+        journal.append(entry)
+        self.writes.put((key, "INSERT INTO Journal(key, entry) VALUES (?,?)", (key, json.dumps(entry, sort_keys=True))))
+        self.num_journaled += 1
+        if len(journal) >= self.compact_journal:
+            self.mark_dirty(key, obj)
+
+    def _compact(self, key: str) -> None:
+        objects = list(self.objects.get(key, ()))
+        if objects:
+            self.mark_dirty(key, objects[0])
+
+    def checkpoint_due(self, now: float, interval: float) -> bool:
+        return bool(self.dirty or self.failed_keys) and self.conn is not None and now - self.last_checkpoint >= interval
+
+    def checkpoint(self) -> int:
+        """
+        Queues the whole state of all dirty objects to be written in one transaction, which also clears their journals.
+        Returns the number of states queued.
+        """
+        self.last_checkpoint = time.time()
+        if self.conn is None:
+            return 0
+        if self.failed_keys:
+            with self.failed_lock:
+                failed, self.failed_keys = self.failed_keys, set()
+            for key in failed:
+                if key not in self.dirty:
+                    self._compact(key)
+        if not self.dirty:
+            return 0
+        dirty, self.dirty = self.dirty, {}
+        for key, obj in dirty.items():
+            state = obj.persistent_state()
+            self.stored[key] = state
+            version = self.versions.get(key, 0) + 1
+            self.versions[key] = version
+            if self.journals.pop(key, None):
+                self.num_compacted += 1
+            data = json.dumps(state, sort_keys=True)
+            self.writes.put((key, "INSERT OR REPLACE INTO State(key, data, version, saved) VALUES (?,?,?,?)",
+                             (key, data, version, self.last_checkpoint)))
+            self.writes.put((key, "DELETE FROM Journal WHERE key=?", (key,)))
+        self.num_checkpoints += 1
+        self.num_written += len(dirty)
+        return len(dirty)
+
+    def _write_behind(self) -> None:
+        # runs in the background thread: commits whatever is queued, in a single transaction
+        stop = False
+        while not stop:
+            batch = [self.writes.get()]
+            while True:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            writes = [write for write in batch if write is not None]
+            stop = len(writes) < len(batch)
+            try:
+                with self.conn:
+                    for key, sql, parameters in writes:
+                        self.conn.execute(sql, parameters)
+            except sqlite3.Error as x:
+                # the whole state of these keys will be written again at the next checkpoint
+                print("\n* Error while writing the world state: %s" % x, file=sys.stderr)
+                with self.failed_lock:
+                    self.failed_keys.update(key for key, sql, parameters in writes)
+            finally:
+                for _ in batch:
+                    self.writes.task_done()
@@ -161,6 +161,8 @@ class Player(base.Living, pubsub.Listener):
             self.transcript.write("\n\n>> %s\n" % cmd)
         self.input_is_available.set()
         self.last_input_time = time.time()
+        if mud_context.driver:
+            mud_context.driver.wakeup()   # the driver can process the input right away
 
     @property
     def idle_time(self) -> float:
@@ -319,6 +321,9 @@ class TextBuffer:
         if end:
             self.in_paragraph = False
 
+    def __bool__(self) -> bool:
+        return bool(self.paragraphs)
+
     def get_paragraphs(self, clear: bool=True) -> Sequence[Tuple[str, bool]]:
         paragraphs = [(p.text(), p.format) for p in self.paragraphs]
         if clear:
@@ -346,13 +351,25 @@ class PlayerConnection:
         Gets the accumulated output lines, formats them nicely, and clears the buffer.
         If there is nothing to be outputted, empty string is returned.
         """
+        formatted = self.render_output()
+        if formatted and self.player.transcript:
+            self.player.transcript.write(formatted)
+        return formatted
+
+    @property
+    def has_output(self) -> bool:
+        """is there any buffered output that still needs to be written?"""
+        return bool(self.player._output)
+
+    def render_output(self) -> str:
+        """
+        Formats the accumulated output lines and clears the buffer, but doesn't write anything yet.
+        This doesn't touch the game state so the driver may do this for many connections at once, in worker threads.
+        """
+        if not self.player._output:
+            return ""
         paragraphs = self.player._output.get_paragraphs()
-        if paragraphs:
-            formatted = self.io.render_output(paragraphs, width=self.player.screen_width, indent=self.player.screen_indent)
-            if formatted and self.player.transcript:
-                self.player.transcript.write(formatted)
-            return formatted or ""
-        return ""
+        return self.io.render_output(paragraphs, width=self.player.screen_width, indent=self.player.screen_indent) or ""
 
     @property
     def last_output_line(self) -> str:
@@ -364,25 +381,31 @@ class PlayerConnection:
 
     def write_output(self) -> None:
         """print any buffered output to the player's screen"""
-        if not self.io:
+        if not self.io or not self.player._output:
             return
-        output = self.get_output()
-        if output:
-            # (re)set a few io parameters because they can be changed dynamically
-            self.io.do_styles = self.player.screen_styles_enabled
-            self.io.do_smartquotes = self.player.smartquotes_enabled
-            self.io.do_prompt_toolkit = self.player.prompt_toolkit_enabled
-            if mud_context.config.server_mode == GameMode.IF and self.player.output_line_delay > 0:
-                if os.name == "nt" and self.io.do_prompt_toolkit:
-                    line_delay = 0.0    # on windows, when using prompt_toolkit, printing individual lines is already very slow
-                else:
-                    line_delay = self.player.output_line_delay / 1000.0
-                for line in output.rstrip().splitlines():
-                    self.io.output(line)
-                    if line_delay > 0:
-                        time.sleep(line_delay)  # delay the output for a short period
+        self.write_rendered_output(self.render_output())
+
+    def write_rendered_output(self, output: str) -> None:
+        """writes output that was formatted earlier by render_output, to the transcript and the player's screen"""
+        if not output:
+            return
+        if self.player.transcript:
+            self.player.transcript.write(output)
+        # (re)set a few io parameters because they can be changed dynamically
+        self.io.do_styles = self.player.screen_styles_enabled
+        self.io.do_smartquotes = self.player.smartquotes_enabled
+        self.io.do_prompt_toolkit = self.player.prompt_toolkit_enabled
+        if mud_context.config.server_mode == GameMode.IF and self.player.output_line_delay > 0:
+            if os.name == "nt" and self.io.do_prompt_toolkit:
+                line_delay = 0.0    # on windows, when using prompt_toolkit, printing individual lines is already very slow
             else:
-                self.io.output(output.rstrip())
+                line_delay = self.player.output_line_delay / 1000.0
+            for line in output.rstrip().splitlines():
+                self.io.output(line)
+                if line_delay > 0:
+                    time.sleep(line_delay)  # delay the output for a short period
+        else:
+            self.io.output(output.rstrip())
 
     def output(self, *lines: str) -> None:
         """directly writes the given text to the player's screen, without buffering and formatting/wrapping"""
@@ -30,6 +30,8 @@ Currently defined pubsub topics used by the Tale driver:
 
 """
 
+import heapq
+import itertools
 import threading
 import time
 import weakref
@@ -37,10 +39,13 @@ from typing import Dict, List, Tuple, Union, Optional, Set, Any
 
 TopicNameType = Union[str, Tuple]
 
-__all__ = ["topic", "unsubscribe_all", "Listener"]
+__all__ = ["topic", "unsubscribe_all", "Listener", "destroy_idle_topics"]
 
 all_topics = {}  # type: Dict[TopicNameType, Topic]
 __topic_lock = threading.Lock()
+_topic_sequence = itertools.count()
+__dirty_topics = []     # type: List[Tuple[int, Topic]]  # heapq (by creation order) of the topics that have pending events
+__expiring_topics = []  # type: List[Tuple[float, int, Topic]]  # heapq (by deadline) of the topics that expire when idle
 
 
 class Listener:
@@ -57,12 +62,17 @@ class Listener:
 class Topic:
     """
     A pubsub topic to send/receive events. You get these from the topic function.
+    Events sent to a topic that has no subscribers are discarded right away.
     """
-    def __init__(self, name: TopicNameType) -> None:
+    def __init__(self, name: TopicNameType, idle_expiry: float=None) -> None:
         self.name = name
         self.subscribers = set()  # type: Set[weakref.ReferenceType[Listener]]
         self.events = []  # type: List[Any]
         self.last_event = time.time()  # type: float
+        self.idle_expiry = idle_expiry
+        self.order = next(_topic_sequence)
+        self.dirty = False      # is it in the dirty topics queue?
+        self.destroyed = False
 
     @property
     def idle_time(self) -> float:
@@ -72,20 +82,26 @@ class Topic:
         self.sync()
         del all_topics[self.name]
         self.name = "<defunct>"
+        self.destroyed = True
         del self.subscribers
         del self.events
 
     def subscribe(self, subscriber: Listener) -> None:
         if not isinstance(subscriber, Listener):
             raise TypeError("subscriber must be a Listener")
-        self.subscribers.add(weakref.ref(subscriber))
+        # the callback removes the reference once the subscriber is garbage collected
+        self.subscribers.add(weakref.ref(subscriber, self.subscribers.discard))
 
     def unsubscribe(self, subscriber: Listener) -> None:
         self.subscribers.discard(weakref.ref(subscriber))
 
     def send(self, event: Any, synchronous: bool=False) -> Optional[List[Any]]:
-        self.events.append(event)
         self.last_event = time.time()
+        if not self.subscribers:
+            return [] if synchronous else None
+        self.events.append(event)
+        if not self.dirty:
+            _mark_dirty(self)
         if synchronous:
             return self.sync()
         return None
@@ -110,23 +126,53 @@ class Topic:
         return results
 
 
-def topic(name: TopicNameType) -> Topic:
-    """Create a topic object (singleton). Name can be a string or a tuple."""
+def topic(name: TopicNameType, idle_expiry: float=None) -> Topic:
+    """
+    Create a topic object (singleton). Name can be a string or a tuple.
+    If idle_expiry is given (seconds), the topic is destroyed by destroy_idle_topics once it has
+    no subscribers and no events were sent to it for that long.
+    """
     with __topic_lock:
         if name in all_topics:
             return all_topics[name]
-        instance = all_topics[name] = Topic(name)
+        instance = all_topics[name] = Topic(name, idle_expiry)
+        if idle_expiry is not None:
+            heapq.heappush(__expiring_topics, (instance.last_event + idle_expiry, instance.order, instance))
         return instance
 
 
+def _mark_dirty(topic: Topic) -> None:
+    with __topic_lock:
+        if not topic.dirty:
+            topic.dirty = True
+            heapq.heappush(__dirty_topics, (topic.order, topic))
+
+
 def sync(topic: TopicNameType=None) -> List:
     """Sync all pending events (i.e. push them to the subscribers)"""
     if topic:
         return all_topics[topic].sync()
-    else:
-        for t in list(all_topics.values()):
+    # Only the topics that have pending events are visited, in the order in which the topics were created.
+    # A topic that gets new events after it has been synced in this round, is synced again in the next round.
+    next_round = []
+    last_order = -1
+    while True:
+        with __topic_lock:
+            if not __dirty_topics:
+                break
+            order, t = heapq.heappop(__dirty_topics)
+            if order <= last_order:
+                next_round.append((order, t))
+                continue
+            t.dirty = False
+        last_order = order
+        if not t.destroyed:
             t.sync()
-        return []
+    if next_round:
+        with __topic_lock:
+            for entry in next_round:
+                heapq.heappush(__dirty_topics, entry)
+    return []
 
 
 def pending(topicname: TopicNameType=None) -> Dict[TopicNameType, Tuple[int, float, int]]:
@@ -136,6 +182,31 @@ def pending(topicname: TopicNameType=None) -> Dict[TopicNameType, Tuple[int, flo
         return {t.name: (len(t.events), t.idle_time, len(t.subscribers)) for t in topics}
 
 
+def destroy_idle_topics() -> int:
+    """
+    Destroy the topics with an idle expiry time that have no subscribers and were idle for longer than that.
+    Only the topics whose deadline has passed are checked. Returns the number of destroyed topics.
+    """
+    destroyed = 0
+    now = time.time()
+    while True:
+        with __topic_lock:
+            if not __expiring_topics or __expiring_topics[0][0] > now:
+                break
+            _, order, t = heapq.heappop(__expiring_topics)
+            if t.destroyed:
+                continue
+            if t.subscribers or t.events:
+                heapq.heappush(__expiring_topics, (now + t.idle_expiry, order, t))
+                continue
+            if t.last_event + t.idle_expiry > now:
+                heapq.heappush(__expiring_topics, (t.last_event + t.idle_expiry, order, t))
+                continue
+        t.destroy()
+        destroyed += 1
+    return destroyed
+
+
 def unsubscribe_all(subscriber: Listener) -> None:
     """unsubscribe the given subscriber object from all topics that it may have been subscribed to."""
     for topic in list(all_topics.values()):
@@ -1,9 +1,15 @@
+import collections
+import copy
 import datetime
 import importlib
 import gzip
-from typing import Any, Tuple, List, Optional, Dict, Type, Sequence, Union
+import hashlib
+import io
+import struct
+import uuid
+from typing import Any, Tuple, List, Optional, Dict, Type, Sequence, Union, Iterator, Iterable, BinaryIO, Callable
 
-from .base import Item, Location, Living, Exit, Door, MudObject, MudObjRegistry, Stats, _limbo
+from .base import Item, Location, Living, Exit, Door, Container, MudObject, MudObjRegistry, Stats, _limbo
 from .story import StoryConfig, MoneyType, GameMode, TickMethod
 from .player import Player, PlayerConnection
 from .errors import TaleError, ActionRefused
@@ -42,42 +48,73 @@ def qual_baseclassname(obj: MudObject) -> str:
         raise ValueError("cannot determine Tale base class", obj)
 
 
+def find_missing_references(items: Iterable[Item], livings: Iterable[Living], locations: Iterable[Location],
+                            exits: Iterable[Exit], player: Player=None) -> List[str]:
+    """
+    Checks that all objects that are referenced by the given objects (the inventories of livings, the items,
+    livings and exits in locations, and the location of livings) are among the given objects as well.
+    The player, if given, doesn't have to be among the livings. Returns a description of every missing reference,
+    so an empty list means that the objects are consistent. This is a single pass over indexes by vnum,
+    so it is also usable to check all objects in the MudObjRegistry (for the consistency of the whole world).
+    """
+    item_index = {i.vnum: i for i in items if isinstance(i, Item)}
+    living_index = {l.vnum: l for l in livings if isinstance(l, Living)}
+    location_index = {loc.vnum: loc for loc in locations if isinstance(loc, Location)}
+    exit_index = {e.vnum: e for e in exits if isinstance(e, Exit)}
+    problems = []   # type: List[str]
+
+    def check(index: Dict[int, MudObject], obj: MudObject, kind: str, source: str, referrer: MudObject) -> None:
+        if index.get(obj.vnum) is not obj:
+            problems.append("missing {} (from {}): {} in {}".format(kind, source, obj, referrer))
+
+    if player is not None:
+        for thing in player.inventory:
+            check(item_index, thing, "item", "player inventory", player)
+        if player.location is not None:
+            check(location_index, player.location, "location", "player", player)
+    for living in living_index.values():
+        for thing in living.inventory:
+            check(item_index, thing, "item", "living inventory", living)
+        if living.location is not None:
+            check(location_index, living.location, "location", "livings", living)
+    for loc in location_index.values():
+        for thing in loc.items:
+            check(item_index, thing, "item", "locations", loc)
+        for living in loc.livings:
+            if living is not player:
+                check(living_index, living, "living", "locations", loc)
+        for exit in loc.exits.values():
+            check(exit_index, exit, "exit", "location", loc)
+    return problems
+
+
+_atomic_types = {int, float, bool, complex, str, bytes, type(None)}
+
+
 class TaleSerializer:
     xor_key = 0x5c    # please do not hack the save files
 
     def __init__(self):
-        serpent.register_class(Player, self.serialize_player)
-        serpent.register_class(ShopBehavior, self.serialize_shopbehavior)
-        serpent.register_class(Location, self.serialize_location)
-        serpent.register_class(Stats, self.serialize_stats)
-        serpent.register_class(Item, self.serialize_item)
-        serpent.register_class(Living, self.serialize_living)
-        serpent.register_class(Exit, self.serialize_exit)
-        serpent.register_class(Deferred, self.serialize_deferred)
+        # the order is important: the first class that matches the object is used
+        self.state_functions = [
+            (Player, self.player_state),
+            (ShopBehavior, self.shopbehavior_state),
+            (Location, self.location_state),
+            (Stats, self.stats_state),
+            (Item, self.item_state),
+            (Living, self.living_state),
+            (Exit, self.exit_state),
+            (Deferred, self.deferred_state)
+        ]   # type: List[Tuple[Type, Callable[[Any], Dict[str, Any]]]]
+        for clazz, _ in self.state_functions:
+            serpent.register_class(clazz, self.serialize_object)
         self.serializer = serpent.Serializer(indent=True, module_in_classname=True)
+        self.record_serializer = serpent.Serializer(indent=False, module_in_classname=True)
 
     def serialize(self, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
                   locations: Sequence[Location], exits: Sequence[Exit],
                   deferreds: Sequence[Deferred], clock: GameDateTime):
-        # only serialize livings that are not the current player, and also not the dummy player used for new connections
-        livings = [l for l in livings if l is not player and l.name != PlayerConnection.dummy_player_name]
-        if _limbo not in locations:
-            locations = list(locations)
-            locations.append(_limbo)
-        if any(i not in items for i in player.inventory):
-            raise ValueError("missing item (from player inventory)")
-        if any(i not in items for living in livings for i in living.inventory):
-            raise ValueError("missing item (from living inventory)")
-        if any(i not in items for loc in locations for i in loc.items):
-            raise ValueError("missing item (from locations)")
-        if any(l is not player and l not in livings for loc in locations for l in loc.livings):
-            raise ValueError("missing living (from locations)")
-        if any(living.location is not None and living.location not in locations for living in livings):
-            raise ValueError("missing location (from livings)")
-        if player.location is not None and player.location not in locations:
-            raise ValueError("missing location (from player)")
-        if any(e not in exits for loc in locations for e in loc.exits.values()):
-            raise ValueError("missing exit (from location)")
+        livings, locations = self.prepare(player, items, livings, locations, exits)
         data = {
             # "story_version": story.version,
             # "tale_version_required": story.requires_tale,
@@ -93,9 +130,59 @@ class TaleSerializer:
         serialized = self.serializer.serialize(data)
         return self.obfuscate(serialized)
 
+    def prepare(self, player: Player, items: Sequence[Item], livings: Sequence[Living],
+                locations: Sequence[Location], exits: Sequence[Exit]) -> Tuple[List[Living], List[Location]]:
+        """
+        Checks that all objects that are referenced, are also saved. Returns the livings and locations to save:
+        the player isn't among the livings (it is saved separately) and limbo is always among the locations.
+        """
+        # only serialize livings that are not the current player, and also not the dummy player used for new connections
+        livings = [l for l in livings if l is not player and l.name != PlayerConnection.dummy_player_name]
+        locations = list(locations)
+        if all(loc is not _limbo for loc in locations):
+            locations.append(_limbo)
+        problems = find_missing_references(items, livings, locations, exits, player)
+        if problems:
+            raise ValueError("savegame integrity check failed: " + "; ".join(problems))
+        return livings, locations
+
     def obfuscate(self, data: bytes) -> bytes:
         data = gzip.compress(data)
-        return b"TALESAVE1" + bytes(b ^ self.xor_key for b in data)
+        return b"TALESAVE1" + data.translate(xor_table)
+
+    def serialize_record(self, obj: Any) -> bytes:
+        """Serializes a single object (for a record of the streaming savegame format)."""
+        return self.record_serializer.serialize(obj)
+
+    def serialize_object(self, obj: Any, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+        ser._serialize(self.object_state(obj), out, indentlevel)
+
+    def object_state(self, obj: Any) -> Dict[str, Any]:
+        """The state of the object as it is saved: a dict with the attributes of the object."""
+        for clazz, state_function in self.state_functions:
+            if isinstance(obj, clazz):
+                return state_function(obj)
+        raise TypeError("cannot serialize object of type " + qual_classname(obj))
+
+    def detached_state(self, obj: Any) -> Dict[str, Any]:
+        """
+        The state of the object, that stays the same when the object itself changes afterwards:
+        the containers in it are copied all the way down, and the stats and shop behavior are already
+        converted to their state as well. References to other mud objects are not copied.
+        """
+        return self.detached_value(self.object_state(obj))
+
+    def detached_value(self, value: Any) -> Any:
+        vtype = type(value)
+        if vtype in _atomic_types or isinstance(value, MudObject):
+            return value
+        if vtype in (dict, collections.OrderedDict):
+            return vtype((key, self.detached_value(v)) for key, v in value.items())
+        if vtype in (list, tuple, set, frozenset):
+            return vtype(self.detached_value(v) for v in value)
+        if isinstance(value, (Stats, ShopBehavior)):
+            return self.detached_value(self.object_state(value))
+        return copy.deepcopy(value)
 
     def add_basic_properties(self, state: Dict[str, Any], obj: MudObject) -> None:
         state["__class__"] = qual_classname(obj)
@@ -113,24 +200,31 @@ class TaleSerializer:
         else:
             state["inventory"] = {mudobj_ref(m) for m in inv}
 
-    def serialize_shopbehavior(self, obj: ShopBehavior, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def shopbehavior_state(self, obj: ShopBehavior) -> Dict[str, Any]:
         state = dict(vars(obj))
         state["__class__"] = qual_classname(obj)
         state["forsale"] = {mudobj_ref(i) for i in state["forsale"]}
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_deferred(self, obj: Deferred, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
-        state = dict(vars(obj))
-        state["__class__"] = qual_classname(obj)
+    def deferred_state(self, obj: Deferred) -> Dict[str, Any]:
+        state = {
+            "__class__": qual_classname(obj),
+            "due_gametime": obj.due_gametime,
+            "owner": obj.owner,
+            "action": obj.action,
+            "vargs": obj.vargs,
+            "kwargs": obj.kwargs,
+            "periodical": obj.periodical
+        }
         if not isinstance(state["owner"], str):
             try:
                 state["owner"] = mudobj_ref(state["owner"])
             except Exception:
                 # owner is not a regular mudobj
                 state["owner"] = "class:" + qual_classname(state["owner"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_stats(self, obj: Stats, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def stats_state(self, obj: Stats) -> Dict[str, Any]:
         state = {
             "__class__": qual_classname(obj),
             "race": obj.race,
@@ -144,9 +238,9 @@ class TaleSerializer:
             "alignment": obj.alignment
             # the other attributes are re-initialized from the races table
         }
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_player(self, obj: Player, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def player_state(self, obj: Player) -> Dict[str, Any]:
         state = dict(vars(obj))
         # remove stuff we don't want to serialize at all
         unserialized_attrs = {"subjective", "possessive", "objective", "teleported_from", "soul",
@@ -169,9 +263,9 @@ class TaleSerializer:
         state["location"] = mudobj_ref(state["location"])
         state["inventory"] = {mudobj_ref(thing) for thing in obj.inventory}
         state["following"] = mudobj_ref(state["following"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_item(self, obj: Item, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def item_state(self, obj: Item) -> Dict[str, Any]:
         if obj.contained_in and obj not in obj.contained_in:
             raise TaleError("item {} containment inconsistency".format(obj))
         state = dict(vars(obj))
@@ -183,9 +277,9 @@ class TaleSerializer:
                 del state[name]
         self.add_basic_properties(state, obj)  # basic properties
         self.add_inventory_property(state, obj)  # inventory (of Container subtype)
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_living(self, obj: Living, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def living_state(self, obj: Living) -> Dict[str, Any]:
         if obj.location and obj.location is not _limbo and obj not in obj.location:
             raise TaleError("living {} location inconsistency".format(obj))
         state = dict(vars(obj))
@@ -206,9 +300,9 @@ class TaleSerializer:
         state["location"] = mudobj_ref(state["location"])
         state["inventory"] = {mudobj_ref(thing) for thing in obj.inventory}
         state["following"] = mudobj_ref(state["following"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_exit(self, obj: Exit, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def exit_state(self, obj: Exit) -> Dict[str, Any]:
         state = dict(vars(obj))
         # remove stuff we don't want to serialize at all
         for name in list(state):
@@ -219,9 +313,9 @@ class TaleSerializer:
         if "linked_door" in state:
             # it's probably a Door, and linked_door referes to another door (cyclic)
             state["linked_door"] = mudobj_ref(state["linked_door"])
-        ser._serialize(state, out, indentlevel)
+        return state
 
-    def serialize_location(self, obj: Location, ser: serpent.Serializer, out: List[str], indentlevel: int) -> None:
+    def location_state(self, obj: Location) -> Dict[str, Any]:
         state = dict(vars(obj))
         # remove stuff we don't want to serialize at all
         for name in list(state):
@@ -232,17 +326,23 @@ class TaleSerializer:
         state["livings"] = {mudobj_ref(l) for l in state["livings"]}
         state["items"] = {mudobj_ref(i) for i in state["items"]}
         state["exits"] = {mudobj_ref(e) for e in state["exits"].values()}
-        ser._serialize(state, out, indentlevel)
+        return state
+
+
+xor_table = bytes(b ^ TaleSerializer.xor_key for b in range(256))
 
 
 class TaleDeserializer:
+    def __init__(self) -> None:
+        self.wizard = None   # type: Optional[Living]
+
     def deserialize(self, data):
         return serpent.loads(self.deobfuscate(data))
 
     def deobfuscate(self, data: bytes) -> bytes:
         if not data.startswith(b"TALESAVE1"):
             return data
-        return gzip.decompress(bytes(b ^ TaleSerializer.xor_key for b in data[9:]))
+        return gzip.decompress(data[9:].translate(xor_table))
 
     def recreate_classes(self, literal, existing_object_lookup):
         t = type(literal)
@@ -297,6 +397,18 @@ class TaleDeserializer:
             else:
                 return False, None
 
+    def detach_item(self, item: Item) -> None:
+        """Removes the item from the container, living or location that it is in."""
+        if self.wizard is None:
+            self.wizard = Living("wizard", "m")
+            self.wizard.privileges.add("wizard")
+        container = item.contained_in
+        if isinstance(container, Container):
+            Container.remove(container, item, self.wizard)    # skip the checks of subclasses, such as a box that is closed
+        else:
+            container.remove(item, self.wizard)
+        assert item.contained_in is None
+
     def lookup_class(self, classname: str) -> Type:
         modulename, classname = classname.rsplit(".", 1)
         clazz = getattr(importlib.import_module(modulename), classname)
@@ -327,10 +439,7 @@ class TaleDeserializer:
         try:
             item = existing_object_lookup.resolve_item_ref(data["vnum"], data["name"], data["__class__"], data["__base_class__"])
             if item.contained_in:
-                wizard = Living("wizard", "m")
-                wizard.privileges.add("wizard")
-                item.contained_in.remove(item, wizard)   # will be hooked up later again
-                assert item.contained_in is None
+                self.detach_item(item)   # will be hooked up later again
         except LookupError:
             # create new item
             itemclass = self.lookup_class(data["__class__"])
@@ -353,10 +462,7 @@ class TaleDeserializer:
         try:
             money = existing_object_lookup.resolve_item_ref(data["vnum"], data["name"], data["__class__"], data["__base_class__"])
             if money.contained_in:
-                wizard = Living("wizard", "m")
-                wizard.privileges.add("wizard")
-                money.contained_in.remove(money, wizard)   # will be hooked up later again
-                assert money.contained_in is None
+                self.detach_item(money)   # will be hooked up later again
         except LookupError:
             # create new money item
             itemclass = self.lookup_class(data["__class__"])
@@ -397,7 +503,7 @@ class TaleDeserializer:
         living.stats = self.recreate_classes(data.pop("stats"), None)
         if isinstance(living, Shopkeeper):
             # special handling of Shopkeepers
-            self.shop = self.make_ShopBehavior(data.pop("shop"))
+            living.shop = self.make_ShopBehavior(data.pop("shop"), existing_object_lookup, living.shop)
         self.apply_attributes(living, data)
         return {
             "living": living,
@@ -420,10 +526,12 @@ class TaleDeserializer:
     def make_GameDateTime(self, data: Dict) -> GameDateTime:
         return GameDateTime(self.parse_datestr(data["clock"]), data["times_realtime"])
 
-    def make_ShopBehavior(self, data: Dict) -> ShopBehavior:
-        shop = ShopBehavior()
+    def make_ShopBehavior(self, data: Dict, existing_object_lookup=None, shop: ShopBehavior=None) -> ShopBehavior:
+        shop = shop or ShopBehavior()
         shop.willbuy = set(data.pop("willbuy"))
         shop.wontdealwith = set(data.pop("wontdealwith"))
+        if existing_object_lookup:
+            shop.forsale = {existing_object_lookup.resolve_item_ref(*ref) for ref in data.pop("forsale")}
         self.apply_attributes(shop, data)
         return shop
 
@@ -483,6 +591,7 @@ class TaleDeserializer:
                 # remove the item from its original location, it was moved here
                 thing.contained_in.remove(thing, None)
             thing.contained_in = loc
+        loc.contents_changed()
         # livings are moved in the correct location when they're created elsewhere.
         return loc
 
@@ -497,11 +606,376 @@ class TaleDeserializer:
                 continue
             if not hasattr(obj, name):
                 raise AttributeError("{}.{} doesn't exist".format(obj.__class__, name))
-            atype = type(getattr(obj, name))
+            current = getattr(obj, name)
+            atype = type(current)
             if type(value) is not atype:
                 if type(value) is int and atype is float:
                     # special case for int vs float (accept ints if type is float)
                     value = float(value)
+                elif atype in (set, frozenset) and (type(value) is set or value == ()):
+                    # special case for sets: serpent writes frozensets as sets, and empty sets as an empty tuple
+                    value = atype(value)
+                elif isinstance(current, dict) and type(value) is dict:
+                    # special dict types such as defaultdict are written as a normal dict, update the existing one instead
+                    current.clear()
+                    current.update(value)
+                    continue
+                elif isinstance(current, collections.deque) and type(value) in (list, tuple):
+                    current.clear()
+                    current.extend(value)
+                    continue
                 else:
                     raise TypeError("{}.{} has different type".format(obj.__class__, name))
             setattr(obj, name, value)
+
+
+class _XorStream:
+    """Binary stream wrapper that (de)obfuscates the data that passes through it."""
+    def __init__(self, stream: BinaryIO) -> None:
+        self.stream = stream
+
+    def write(self, data: bytes) -> int:
+        return self.stream.write(bytes(data).translate(xor_table))
+
+    def read(self, size: int=-1) -> bytes:
+        return self.stream.read(size).translate(xor_table)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+class SavegameSnapshot:
+    """
+    The state of all objects to save, captured at a moment in time (take it in between server ticks).
+    Capturing only copies the attributes of the objects, so it is quick. The snapshot can then be written
+    as a savegame by a SavegameWriter in another thread, while the game continues and changes the objects.
+    The object states are ordered by vnum per section.
+    """
+    def __init__(self, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
+                 locations: Sequence[Location], exits: Sequence[Exit], deferreds: Sequence[Deferred], clock: GameDateTime) -> None:
+        serializer = TaleSerializer()
+        livings, locations = serializer.prepare(player, items, livings, locations, exits)
+        self.story_config = copy.copy(story)
+        self.clock = copy.copy(clock)
+        self.sections = {}     # type: Dict[str, List[Dict[str, Any]]]
+        for section, objects in zip(SavegameWriter.sections, (exits, items, locations, livings)):
+            self.sections[section] = [serializer.detached_state(obj) for obj in sorted(objects, key=lambda o: o.vnum)]
+        self.player = serializer.detached_state(player)
+        self.deferreds = [serializer.detached_state(d) for d in deferreds]
+
+
+class SavegameWriter:
+    """
+    Writes a savegame in the streaming format: after the magic bytes, a gzip compressed stream of records follows,
+    one record per object (a serpent literal, prefixed by its kind and length) written as soon as it is visited.
+    The save data is never in memory as a whole.
+    A full save remembers a digest of every object record. A writer that gets these digests makes a delta save,
+    that only contains the objects that changed since that full save, and the vnums of all objects so that the
+    loader knows which objects have gone. Deltas are always relative to the full save, so only the last one is needed.
+    """
+    magic = b"TALESAVE2"
+    record_kinds = ("header", "story_config", "clock", "exits", "items", "locations", "livings",
+                    "player", "deferreds", "present", "end")
+    sections = ("exits", "items", "locations", "livings")
+
+    def __init__(self, base_id: str="", base_digests: Dict[Tuple[str, int], bytes]=None) -> None:
+        self.serializer = TaleSerializer()
+        self.save_id = uuid.uuid4().hex
+        self.base_id = base_id
+        self.base_digests = base_digests
+        self.digests = {}    # type: Dict[Tuple[str, int], bytes]  # digests of the object records of a full save
+        self.num_objects = 0
+        self.num_written = 0
+
+    @property
+    def is_delta(self) -> bool:
+        return self.base_digests is not None
+
+    def write(self, stream: BinaryIO, story: StoryConfig, player: Player, items: Sequence[Item], livings: Sequence[Living],
+              locations: Sequence[Location], exits: Sequence[Exit], deferreds: Sequence[Deferred], clock: GameDateTime) -> None:
+        """Writes the savegame to the binary stream. Afterwards, num_objects and num_written tell how many objects were saved."""
+        self.write_snapshot(stream, SavegameSnapshot(story, player, items, livings, locations, exits, deferreds, clock))
+
+    def write_snapshot(self, stream: BinaryIO, snapshot: 'SavegameSnapshot') -> None:
+        """Writes the savegame of the snapshot to the binary stream. This can be done in another thread than the game's."""
+        stream.write(self.magic)
+        with gzip.GzipFile(fileobj=_XorStream(stream), mode="wb") as out:
+            self.write_record(out, "header", {"format": 2, "save_id": self.save_id, "base_id": self.base_id if self.is_delta else ""})
+            self.write_record(out, "story_config", snapshot.story_config)
+            self.write_record(out, "clock", snapshot.clock)
+            for section in self.sections:
+                self.write_section(out, section, snapshot.sections[section])
+            self.write_record(out, "player", snapshot.player)
+            for deferred in snapshot.deferreds:
+                self.write_record(out, "deferreds", deferred)
+            self.write_record(out, "end", None)
+
+    def write_section(self, out: BinaryIO, section: str, states: Sequence[Dict[str, Any]]) -> None:
+        present = []
+        for state in states:
+            vnum = state["vnum"]
+            payload = self.serializer.serialize_record(state)
+            digest = hashlib.sha1(payload).digest()
+            key = (section, vnum)
+            self.num_objects += 1
+            present.append(vnum)
+            if self.is_delta:
+                if self.base_digests.get(key) == digest:
+                    continue
+            else:
+                self.digests[key] = digest
+            self._write_payload(out, section, payload)
+            self.num_written += 1
+        if self.is_delta:
+            self.write_record(out, "present", {"section": section, "vnums": present})
+
+    def write_record(self, out: BinaryIO, kind: str, obj: Any) -> None:
+        self._write_payload(out, kind, self.serializer.serialize_record(obj))
+
+    def _write_payload(self, out: BinaryIO, kind: str, payload: bytes) -> None:
+        out.write(struct.pack(">BI", self.record_kinds.index(kind), len(payload)))
+        out.write(payload)
+
+
+class SavegameReader:
+    """
+    Reads a savegame one record at a time, as (kind, literal) tuples. The literals are the same as those that
+    the TaleDeserializer gives for the individual objects, so they can be recreated with its recreate_classes.
+    If a delta savegame is given as well, its records replace those of the full savegame that it belongs to.
+    Old style savegames (that were made with TaleSerializer.serialize) are read as well.
+    """
+    def __init__(self, data: bytes, delta_data: bytes=None) -> None:
+        self.data = data
+        self.delta_data = delta_data
+        if data.startswith(SavegameWriter.magic):
+            self.header = self._read_header(data)
+            if delta_data is not None:
+                delta_header = self._read_header(delta_data)
+                if delta_header["base_id"] != self.header["save_id"]:
+                    raise ValueError("delta savegame doesn't belong to this savegame")
+        else:
+            self.header = {"format": 1, "save_id": "", "base_id": ""}
+            if delta_data is not None:
+                raise ValueError("old style savegames can't have a delta")
+
+    def records(self) -> Iterator[Tuple[str, Any]]:
+        if self.header["format"] == 1:
+            yield from self._records_oldformat()
+        elif self.delta_data is None:
+            for kind, literal in self._read_records(self.data):
+                if kind not in ("header", "end"):
+                    yield kind, literal
+        else:
+            yield from self._records_with_delta()
+
+    def _records_with_delta(self) -> Iterator[Tuple[str, Any]]:
+        # the delta is small, keep its records in memory while streaming through the full savegame.
+        replaced = {}      # type: Dict[str, Any]
+        changed = {section: {} for section in SavegameWriter.sections}    # type: Dict[str, Dict[int, Any]]
+        present = {}       # type: Dict[str, set]
+        deferreds = []     # type: List[Any]
+        for kind, literal in self._read_records(self.delta_data):
+            if kind in changed:
+                changed[kind][literal["vnum"]] = literal
+            elif kind == "present":
+                present[literal["section"]] = set(literal["vnums"])
+            elif kind == "deferreds":
+                deferreds.append(literal)
+            elif kind not in ("header", "end"):
+                replaced[kind] = literal
+        sections = iter(SavegameWriter.sections)
+        current_section = next(sections)
+        for kind, literal in self._read_records(self.data):
+            while current_section and kind != current_section and kind not in ("header", "story_config", "clock"):
+                # the section is done, add the objects in the delta that are new since the full save
+                new_objects = changed[current_section]
+                for vnum in sorted(new_objects):
+                    yield current_section, new_objects[vnum]
+                current_section = next(sections, None)
+            if kind in changed:
+                vnum = literal["vnum"]
+                if vnum in present[kind]:
+                    yield kind, changed[kind].pop(vnum, literal)
+            elif kind in replaced:
+                yield kind, replaced[kind]
+                if kind == "player":
+                    for deferred in deferreds:
+                        yield "deferreds", deferred
+            elif kind not in ("header", "deferreds", "end"):
+                yield kind, literal
+
+    def _records_oldformat(self) -> Iterator[Tuple[str, Any]]:
+        state = TaleDeserializer().deserialize(self.data)
+        yield "story_config", state.pop("story_config")
+        yield "clock", state.pop("clock")
+        for section in SavegameWriter.sections:
+            for literal in sorted(state.pop(section), key=lambda d: d.get("vnum")):
+                yield section, literal
+        yield "player", state.pop("player")
+        for literal in state.pop("deferreds"):
+            yield "deferreds", literal
+        assert len(state) == 0, "everything must have been converted"
+
+    def _read_header(self, data: bytes) -> Dict[str, Any]:
+        for kind, literal in self._read_records(data):
+            if kind != "header":
+                break
+            return literal
+        raise ValueError("savegame has no header")
+
+    def validate(self) -> None:
+        """
+        Checks the framing of all records and the checksum of the compressed data, without decoding the records.
+        This is a cheap first pass that detects a damaged savegame before anything is loaded from it, after which
+        the records can be streamed into the loader. Raises ValueError, EOFError or OSError if the data is damaged.
+        """
+        if self.header["format"] == 1:
+            return      # the old format is decoded as a whole before the first record is returned
+        for data in (self.data, self.delta_data):
+            if data is not None:
+                for _ in self._read_records(data, decode=False):
+                    pass
+
+    def _read_records(self, data: bytes, decode: bool=True) -> Iterator[Tuple[str, Any]]:
+        if not data.startswith(SavegameWriter.magic):
+            raise ValueError("not a savegame in the streaming format")
+        stream = io.BytesIO(data)
+        stream.seek(len(SavegameWriter.magic))
+        header_size = struct.calcsize(">BI")
+        with gzip.GzipFile(fileobj=_XorStream(stream), mode="rb") as infile:
+            while True:
+                header = infile.read(header_size)
+                if len(header) < header_size:
+                    raise ValueError("savegame is truncated")
+                kind_index, length = struct.unpack(">BI", header)
+                if kind_index >= len(SavegameWriter.record_kinds):
+                    raise ValueError("invalid savegame record")
+                kind = SavegameWriter.record_kinds[kind_index]
+                payload = infile.read(length)
+                if len(payload) < length:
+                    raise ValueError("savegame is truncated")
+                yield kind, serpent.loads(payload) if decode else payload
+                if kind == "end":
+                    if not decode and infile.read():     # reading up to the end also verifies the checksum
+                        raise ValueError("savegame has data after the end record")
+                    return
+
+
+class SavegameLoader:
+    """
+    Restores the world from the records of a savegame (see SavegameReader) in a single pass, as they come in.
+    The references to other objects are resolved directly via the vnum dictionaries of the MudObjRegistry
+    (the one that belongs to the base class of the reference). Existing objects are updated, objects that don't
+    exist yet are only created when their record is loaded. Only the few references that can point forward
+    (the contents of containers and whom livings are following) are linked up later.
+    The story config, clock, player and deferreds that were loaded are available as attributes afterwards.
+    """
+    def __init__(self) -> None:
+        self.deserializer = TaleDeserializer()
+        self.indexes = {
+            qual_classname(Item, cls=True): MudObjRegistry.all_items,
+            qual_classname(Living, cls=True): MudObjRegistry.all_livings,
+            qual_classname(Player, cls=True): MudObjRegistry.all_livings,
+            qual_classname(Location, cls=True): MudObjRegistry.all_locations,
+            qual_classname(Exit, cls=True): MudObjRegistry.all_exits
+        }   # type: Dict[str, Dict[int, Any]]
+        self.story_config = None    # type: StoryConfig
+        self.clock = None           # type: GameDateTime
+        self.player = None          # type: Player
+        self.deferreds = []         # type: List[Deferred]
+        self.containers = []        # type: List[Tuple[Item, Any]]
+        self.followers = []         # type: List[Tuple[Living, Any]]
+        self.previous_kind = ""
+
+    def resolve_ref(self, vnum: int, name: str, classname: str, baseclassname: str) -> Any:
+        try:
+            obj = self.indexes[baseclassname].get(vnum, None)
+        except KeyError:
+            raise TaleError("invalid base class for resolve_ref: " + baseclassname)
+        if obj is None:
+            raise LookupError("vnum not found: " + str(vnum))
+        if obj.name != name and baseclassname not in ("tale.base.Living", "tale.player.Player"):
+            # livings (the player) can change their name, other objects can't
+            raise TaleError("object inconsistency for vnum " + str(vnum))
+        return obj
+
+    resolve_item_ref = resolve_location_ref = resolve_living_ref = resolve_exit = resolve_ref
+
+    def load(self, records: Iterable[Tuple[str, Any]]) -> Player:
+        """Load all records, returns the player."""
+        for kind, literal in records:
+            self.load_record(kind, literal)
+        return self.finish()
+
+    def load_record(self, kind: str, literal: Any) -> None:
+        # the records come in order: story config, clock, exits, items, locations, livings, player, deferreds.
+        if self.previous_kind == "items" and kind != "items":
+            # link items contained in other items, now that all items exist
+            for item, contains in self.containers:
+                item.init_inventory({self.resolve_ref(*ref) for ref in contains})
+            self.containers = []
+        self.previous_kind = kind
+        if kind == "story_config":
+            self.story_config = self.deserializer.make_StoryConfig(literal)
+        elif kind == "clock":
+            self.clock = self.deserializer.make_GameDateTime(literal)
+        elif kind == "exits":
+            self.deserializer.make_Exit(literal, self)
+        elif kind == "items":
+            if literal.get("__class__") == "tale.items.basic.Money":
+                item_info = self.deserializer.make_Money(literal, self)
+            else:
+                item_info = self.deserializer.make_Item(literal, self)
+            if item_info["contains"]:
+                if not isinstance(item_info["item"], Container):
+                    raise TaleError("can't put stuff in an item that isn't a Container")
+                self.containers.append((item_info["item"], item_info["contains"]))
+        elif kind == "locations":
+            self.deserializer.make_Location(literal, self)
+        elif kind == "livings":
+            self.load_living(self.deserializer.make_Living(literal, self))
+        elif kind == "player":
+            self.load_player(self.deserializer.make_Player(literal))
+        elif kind == "deferreds":
+            self.deferreds.append(self.deserializer.make_Deferred(literal, self))
+        else:
+            raise TaleError("invalid savegame record: " + kind)
+
+    def load_living(self, living_info: Dict[str, Any]) -> None:
+        living = living_info["living"]
+        if living_info["inventory"]:
+            living.init_inventory({self.resolve_ref(*ref) for ref in living_info["inventory"]})
+        loc = self.resolve_ref(*living_info["location"])
+        if living.location and living.location is not loc:
+            living.location.remove(living, living)
+        # we can't yet set following because it might still point to a non-existing player object. Do that later.
+        loc.insert(living, living)
+        if living_info["following"]:
+            self.followers.append((living, living_info["following"]))
+
+    def load_player(self, player_info: Dict[str, Any]) -> None:
+        player = player_info["player"]
+        MudObjRegistry.all_livings[player.vnum] = player   # overwrite intermediate player object
+        contained = {self.resolve_ref(*ref) for ref in player_info["inventory"]}
+        for thing in contained:
+            if thing.contained_in and thing.contained_in is not player:
+                # remove the item from its original location, the player now has it in its pocketses
+                thing.contained_in.remove(thing, None)
+        player.init_inventory(contained)
+        loc = self.resolve_ref(*player_info["location"])
+        if player.location and player.location is not loc:
+            player.location.remove(player, player)
+        loc.insert(player, player)
+        player.known_locations = {self.resolve_ref(*ref) for ref in player_info["known_locs"]}
+        if player_info["following"]:
+            player.following = self.resolve_ref(*player_info["following"])
+        self.player = player
+
+    def finish(self) -> Player:
+        """Links up the creatures that follow other creatures (or the player), and returns the player."""
+        if self.player is None:
+            raise TaleError("savegame contains no player")
+        for living, following in self.followers:
+            living.following = self.resolve_ref(*following)
+        self.followers = []
+        return self.player
@@ -68,6 +68,10 @@ class StoryConfig:
         self.license_file = ""               # game license file, if applicable
         self.mud_host = ""                   # for mud mode: hostname to bind the server on. Use "[...]" for IPV6 connectivity.
         self.mud_port = 0                    # for mud mode: port number to bind the server on
+        self.render_output_workers = 0       # for mud mode: number of threads that format the players' output (0 = do it in the main loop)
+        self.checkpoint_time = 60.0          # for mud mode: seconds between the checkpoints that write the persistent world state
+        self.mud_password_hashing = "pbkdf2"   # for mud mode: password hashing function, pbkdf2 or scrypt
+        self.mud_password_workers = 2        # for mud mode: number of threads that hash the passwords (0 = do it in the main loop)
         self.zones = []                      # type: List[str]  # names of zone modules to load, in this order
         self.server_mode = GameMode.IF       # the actual game mode the server is operating in (will be set at startup time)
 
@@ -0,0 +1,137 @@
+"""
+Timing statistics of the driver's main loop, to find out what makes the server ticks slow.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import bisect
+import collections
+import time
+from typing import Dict, Any, List, Tuple, MutableSequence
+
+__all__ = ["LatencyHistogram", "TickStats"]
+
+
+class LatencyHistogram:
+    """
+    Counts durations (in seconds) in exponentially growing buckets, and keeps track of the total and the maximum.
+    """
+    bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.bounds) + 1)   # the last bucket counts everything above the largest bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket that holds the given fraction (0..1) of the durations (the maximum for the last bucket)."""
+        threshold = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= threshold and seen:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        buckets = collections.OrderedDict()     # type: Dict[str, int]
+        for bound, count in zip(self.bounds, self.counts):
+            buckets["<=%g" % bound] = count
+        buckets[">%g" % self.bounds[-1]] = self.counts[-1]
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "buckets": buckets
+        }
+
+
+class TickStats:
+    """
+    Collects the timings of the driver's main loop: how long the phases of every server tick took
+    (calling the deferreds, the pubsub sync, writing the output, and processing the player commands),
+    and latency histograms per deferred action and per command verb.
+    A tick is late when it took longer than the server tick time.
+    """
+    phases = ("deferreds", "pubsub", "output", "commands")
+
+    def __init__(self, history: int=100) -> None:
+        self.history = history
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.time()
+        self.num_ticks = 0
+        self.late_ticks = 0
+        self.recent_ticks = collections.deque(maxlen=self.history)   # type: MutableSequence[Dict[str, float]]
+        self.tick_durations = LatencyHistogram()
+        self.phase_durations = {phase: LatencyHistogram() for phase in self.phases}
+        self.deferred_actions = {}      # type: Dict[str, LatencyHistogram]
+        self.verbs = {}                 # type: Dict[str, LatencyHistogram]
+        self.current_tick = dict.fromkeys(self.phases, 0.0)
+
+    def add_phase(self, phase: str, duration: float) -> None:
+        """Record the duration of a phase. Phases that run outside of the server tick are added to the next tick."""
+        self.current_tick[phase] += duration
+        self.phase_durations[phase].add(duration)
+
+    def add_deferred(self, action: str, duration: float) -> None:
+        histogram = self.deferred_actions.get(action)
+        if histogram is None:
+            histogram = self.deferred_actions[action] = LatencyHistogram()
+        histogram.add(duration)
+
+    def add_verb(self, verb: str, duration: float) -> None:
+        histogram = self.verbs.get(verb)
+        if histogram is None:
+            histogram = self.verbs[verb] = LatencyHistogram()
+        histogram.add(duration)
+
+    def end_tick(self, tick_time: float, num_deferreds: int) -> None:
+        """Completes the record of the current server tick."""
+        record = self.current_tick
+        duration = sum(record.values())
+        record["duration"] = duration
+        record["num_deferreds"] = num_deferreds
+        record["timestamp"] = time.time()
+        self.recent_ticks.append(record)
+        self.tick_durations.add(duration)
+        self.num_ticks += 1
+        if duration > tick_time:
+            self.late_ticks += 1
+        self.current_tick = dict.fromkeys(self.phases, 0.0)
+
+    @staticmethod
+    def slowest(histograms: Dict[str, LatencyHistogram], amount: int=10, by: str="total") -> List[Tuple[str, LatencyHistogram]]:
+        """The histograms with the largest total (or max or mean) duration, as (name, histogram) tuples."""
+        return sorted(histograms.items(), key=lambda item: getattr(item[1], by), reverse=True)[:amount]
+
+    def dump(self) -> Dict[str, Any]:
+        """All statistics as a dict that can be serialized to json."""
+        return {
+            "started": self.started,
+            "timestamp": time.time(),
+            "num_ticks": self.num_ticks,
+            "late_ticks": self.late_ticks,
+            "tick_durations": self.tick_durations.as_dict(),
+            "phases": {phase: histogram.as_dict() for phase, histogram in self.phase_durations.items()},
+            "recent_ticks": list(self.recent_ticks),
+            "deferred_actions": {name: histogram.as_dict() for name, histogram in self.deferred_actions.items()},
+            "verbs": {verb: histogram.as_dict() for verb, histogram in self.verbs.items()}
+        }
@@ -0,0 +1,169 @@
+"""
+Hierarchical timing wheel, used by the driver to schedule the deferreds.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import heapq
+import itertools
+import math
+from typing import Any, Dict, Hashable, Iterator, List
+
+__all__ = ["TimerWheel"]
+
+
+class TimerWheel:
+    """
+    Holds items ordered by their due time (a float, for instance seconds of game time).
+    The time is divided in ticks of the given resolution. Level 0 of the wheel has a bucket per tick,
+    every next level has buckets that span a whole turn of the level below it. Items that are further
+    in the future than the highest level can hold, wait in an overflow bucket.
+    Inserting and removing an item are O(1). Advancing the time only visits the buckets that were passed;
+    items cascade down to the finer levels as their due time approaches.
+    Items that are due within the current tick wait in a small heap, to hand them out in the exact order of their due time.
+    Items can be inserted with a group key (such as the owner of the item) to be able to remove a whole group at once.
+    Items are tracked by identity, an item can only be in the wheel once.
+    The wheel starts at the given time 'now'; it should be the current time of the items' clock,
+    because the buckets of the wheel are laid out relative to it.
+    """
+    slot_bits = 6
+    num_levels = 4
+
+    def __init__(self, resolution: float=1.0, now: float=0.0) -> None:
+        assert resolution > 0
+        self.resolution = resolution
+        self.num_slots = 1 << self.slot_bits
+        self.clear(now)
+
+    def clear(self, now: float=None) -> None:
+        """Remove all items from the wheel. If a time is given, the wheel restarts at that time."""
+        self.levels = [[{} for _ in range(self.num_slots)] for _ in range(self.num_levels)]   # type: List[List[Dict[int, List[Any]]]]
+        self.overflow = {}          # type: Dict[int, List[Any]]
+        self.near = []              # type: List[List[Any]]  # heapq of the entries due within the current tick
+        self.entries = {}           # type: Dict[int, List[Any]]  # id(item) -> entry
+        self.groups = {}            # type: Dict[Hashable, Dict[int, Any]]  # group key -> {id(item): item}
+        self.num_in_buckets = 0
+        self.level_counts = [0] * (self.num_levels + 1)   # number of entries per level (the last one is the overflow)
+        self.sequence = itertools.count()
+        if now is not None:
+            self.current_tick = math.floor(now / self.resolution) - 1    # all ticks up to and including this one have been processed
+
+    # an entry is a list: [due, sequence number, item, bucket (None when in the near heap), group key, level]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[Any]:
+        return (entry[2] for entry in list(self.entries.values()))
+
+    def __contains__(self, item: Any) -> bool:
+        return id(item) in self.entries
+
+    def insert(self, item: Any, due: float, group: Hashable=None) -> None:
+        """Insert an item that is due at the given time. Optionally it becomes part of a group."""
+        if id(item) in self.entries:
+            raise ValueError("item is already in the timer wheel")
+        entry = [due, next(self.sequence), item, None, group, 0]
+        self.entries[id(item)] = entry
+        if group is not None:
+            self.groups.setdefault(group, {})[id(item)] = item
+        self._place(entry, math.floor(due / self.resolution))
+
+    def remove(self, item: Any) -> bool:
+        """Remove the item from the wheel. Returns False if it wasn't in the wheel."""
+        entry = self.entries.pop(id(item), None)
+        if entry is None:
+            return False
+        self._unlink(entry)
+        group = entry[4]
+        if group is not None:
+            members = self.groups[group]
+            del members[id(item)]
+            if not members:
+                del self.groups[group]
+        return True
+
+    def remove_group(self, group: Hashable) -> List[Any]:
+        """Remove all items of the given group from the wheel, and returns them."""
+        members = self.groups.pop(group, {})
+        for item in members.values():
+            self._unlink(self.entries.pop(id(item)))
+        return list(members.values())
+
+    def pop_due(self, now: float) -> List[Any]:
+        """Advance the wheel to the given time and remove and return all items that are due, in order of their due time."""
+        target = math.floor(now / self.resolution)
+        while self.current_tick < target:
+            if not self.num_in_buckets:
+                self.current_tick = target    # nothing in the wheel: skip ahead at once
+                break
+            # the levels below the lowest one that holds entries are empty, so we can skip ahead
+            # to the next tick where a bucket of that level is cascaded.
+            level = 0
+            while not self.level_counts[level]:
+                level += 1
+            span = 1 << (self.slot_bits * level)
+            next_tick = (self.current_tick // span + 1) * span
+            if next_tick > target:
+                self.current_tick = target
+                break
+            self.current_tick = next_tick
+            self._process_tick(next_tick)
+        result = []
+        near = self.near
+        while near and near[0][0] <= now:
+            entry = heapq.heappop(near)
+            item = entry[2]
+            if item is None:
+                continue    # removed while waiting in the heap
+            self.remove(item)
+            result.append(item)
+        return result
+
+    def _process_tick(self, tick: int) -> None:
+        # cascade the buckets of the higher levels that start at this tick, the highest level first.
+        if tick & ((1 << (self.slot_bits * self.num_levels)) - 1) == 0:
+            self._cascade(self.overflow)
+        for level in range(self.num_levels - 1, 0, -1):
+            if tick & ((1 << (self.slot_bits * level)) - 1) == 0:
+                self._cascade(self.levels[level][(tick >> (self.slot_bits * level)) & (self.num_slots - 1)])
+        # the entries in the level 0 bucket of this tick are due now (or within this tick)
+        self._cascade(self.levels[0][tick & (self.num_slots - 1)])
+
+    def _cascade(self, bucket: Dict[int, List[Any]]) -> None:
+        entries = list(bucket.values())
+        bucket.clear()
+        for entry in entries:
+            self.level_counts[entry[5]] -= 1
+        self.num_in_buckets -= len(entries)
+        for entry in entries:
+            self._place(entry, math.floor(entry[0] / self.resolution))
+
+    def _place(self, entry: List[Any], tick: int) -> None:
+        delta = tick - self.current_tick
+        if delta <= 0:
+            entry[3] = None
+            heapq.heappush(self.near, entry)
+            return
+        for level in range(self.num_levels):
+            if delta < 1 << (self.slot_bits * (level + 1)):
+                bucket = self.levels[level][(tick >> (self.slot_bits * level)) & (self.num_slots - 1)]
+                break
+        else:
+            level = self.num_levels
+            bucket = self.overflow
+        bucket[entry[1]] = entry
+        entry[3] = bucket
+        entry[5] = level
+        self.level_counts[level] += 1
+        self.num_in_buckets += 1
+
+    def _unlink(self, entry: List[Any]) -> None:
+        bucket = entry[3]
+        if bucket is None:
+            entry[2] = None     # in the near heap; it is skipped when it comes up
+        else:
+            del bucket[entry[1]]
+            self.level_counts[entry[5]] -= 1
+            self.num_in_buckets -= 1
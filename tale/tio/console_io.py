@@ -157,8 +157,7 @@ class ConsoleIo(iobase.IoAdapterBase):
         if not paragraphs:
             return ""
         indent = " " * params["indent"]
-        wrapper = styleaware_wrapper.StyleTagsAwareTextWrapper(width=params["width"], fix_sentence_endings=True,
-                                                               initial_indent=indent, subsequent_indent=indent)
+        wrapper = styleaware_wrapper.get_wrapper(params["width"], params["indent"])
         output = []
         for txt, formatted in paragraphs:
             if formatted:
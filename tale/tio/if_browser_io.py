@@ -68,17 +68,17 @@ class HttpIo(iobase.IoAdapterBase):
         self.__new_html_available = Event()
 
     def destroy(self) -> None:
-        self.__new_html_available.set()
+        self.notify_html_available()
 
     def append_html_to_browser(self, text: str) -> None:
         with self.__html_to_browser_lock:
             self.__html_to_browser.append(text)
-            self.__new_html_available.set()
+            self.notify_html_available()
 
     def append_html_special(self, text: str) -> None:
         with self.__html_to_browser_lock:
             self.__html_special.append(text)
-            self.__new_html_available.set()
+            self.notify_html_available()
 
     def get_html_to_browser(self) -> List[str]:
         with self.__html_to_browser_lock:
@@ -90,6 +90,10 @@ class HttpIo(iobase.IoAdapterBase):
             special, self.__html_special = self.__html_special, []
             return special
 
+    def notify_html_available(self) -> None:
+        """Signals that new html is available for the browser (wakes up whoever waits for it)"""
+        self.__new_html_available.set()
+
     def wait_html_available(self, timeout: float=None) -> None:
         self.__new_html_available.wait(timeout=timeout)
         self.__new_html_available.clear()
@@ -142,7 +146,7 @@ class HttpIo(iobase.IoAdapterBase):
                     self.__html_to_browser.append("<p>" + text + "</p>\n")
                 else:
                     self.__html_to_browser.append("<pre>" + text + "</pre>\n")
-            self.__new_html_available.set()
+            self.notify_html_available()
         return ""    # the output is pushed to the browser via a buffer, rather than printed to a screen
 
     def output(self, *lines: str) -> None:
@@ -150,7 +154,7 @@ class HttpIo(iobase.IoAdapterBase):
         with self.__html_to_browser_lock:
             for line in lines:
                 self.output_no_newline(line)
-            self.__new_html_available.set()
+            self.notify_html_available()
 
     def output_no_newline(self, text: str) -> None:
         super().output_no_newline(text)
@@ -158,7 +162,7 @@ class HttpIo(iobase.IoAdapterBase):
         if text == "\n":
             text = "<br>"
         self.__html_to_browser.append("<p>" + text + "</p>\n")
-        self.__new_html_available.set()
+        self.notify_html_available()
 
     def convert_to_html(self, line: str) -> str:
         """Convert style tags to html"""
@@ -338,22 +342,25 @@ class TaleWsgiAppBase:
                 conn.io.wait_html_available(timeout=15)   # keepalives every 15 sec
             if not conn.io or not conn.player:
                 break
-            html = conn.io.get_html_to_browser()
-            special = conn.io.get_html_special()
-            if html or special:
-                if conn.io.dont_echo_next_cmd:
-                    special.append("noecho")
-                response = {
-                    "text": "\n".join(html),
-                    "special": special,
-                    "turns": conn.player.turns,
-                    "location": conn.player.location.title if conn.player.location else "???"
-                }
-                result = "event: text\nid: {event_id}\ndata: {data}\n\n"\
-                    .format(event_id=str(time.time()), data=json.dumps(response))
-                yield result.encode("utf-8")
-            else:
-                yield "data: keepalive\n\n".encode("utf-8")
+            yield self.eventsource_message(conn)
+
+    def eventsource_message(self, conn: PlayerConnection) -> bytes:
+        """The next message on the event stream of the connection: the new html if there is any, else a keepalive."""
+        html = conn.io.get_html_to_browser()
+        special = conn.io.get_html_special()
+        if html or special:
+            if conn.io.dont_echo_next_cmd:
+                special.append("noecho")
+            response = {
+                "text": "\n".join(html),
+                "special": special,
+                "turns": conn.player.turns,
+                "location": conn.player.location.title if conn.player.location else "???"
+            }
+            result = "event: text\nid: {event_id}\ndata: {data}\n\n"\
+                .format(event_id=str(time.time()), data=json.dumps(response))
+            return result.encode("utf-8")
+        return "data: keepalive\n\n".encode("utf-8")
 
     def wsgi_handle_tabcomplete(self, environ: Dict[str, Any], parameters: Dict[str, str],
                                 start_response: WsgiStartResponseType) -> Iterable[bytes]:
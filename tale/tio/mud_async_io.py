@@ -0,0 +1,427 @@
+"""
+Asyncio based I/O for a multi player ('mud') server:
+a small web server that serves the regular mud wsgi app, and a raw telnet server.
+Both run on the same event loop as the game loop of the AsyncMudDriver.
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+
+import asyncio
+import io
+import socket
+import sys
+import traceback
+from typing import Dict, Iterable, Any, List, Tuple, Optional, Sequence
+from urllib.parse import unquote
+
+from . import iobase
+from . import styleaware_wrapper
+from .if_browser_io import WsgiStartResponseType
+from .mud_browser_io import MudHttpIo, TaleMudWsgiApp, SessionMiddleware, MemorySessionFactory
+from ..driver import Driver
+from ..player import PlayerConnection
+
+__all__ = ["AsyncMudHttpIo", "AsyncTaleMudWsgiApp", "AsyncWsgiServer", "TelnetIo", "TelnetServer"]
+
+
+# ansi escape sequences for the text styles, for telnet clients
+telnet_style_words = {
+    "dim": "\033[2m",
+    "normal": "\033[22m",
+    "bright": "\033[1m",
+    "ul": "\033[4m",
+    "it": "\033[3m",
+    "rev": "\033[7m",
+    "/": "\033[0m",
+    "location": "\033[1m",
+    "clear": "\033[1;1H\033[2J",
+    "monospaced": "",  # telnet clients are monospaced already
+    "/monospaced": ""
+}
+assert len(set(telnet_style_words.keys()) ^ iobase.ALL_STYLE_TAGS) == 0, "mismatch in list of style tags"
+
+IAC = 255
+DONT, DO, WONT, WILL = 254, 253, 252, 251
+SB, SE = 250, 240
+OPTION_ECHO = 1
+
+
+def strip_telnet_commands(data: bytes) -> bytes:
+    """remove telnet command sequences (option negotiation etc.) from the received data"""
+    if IAC not in data:
+        return data
+    result = bytearray()
+    i = 0
+    while i < len(data):
+        byte = data[i]
+        if byte != IAC:
+            result.append(byte)
+            i += 1
+            continue
+        command = data[i + 1] if i + 1 < len(data) else None
+        if command == IAC:
+            result.append(IAC)   # escaped 255 data byte
+            i += 2
+        elif command in (DONT, DO, WONT, WILL):
+            i += 3
+        elif command == SB:
+            end = data.find(bytes([IAC, SE]), i + 2)
+            i = len(data) if end < 0 else end + 2
+        else:
+            i += 2
+    return bytes(result)
+
+
+class AsyncMudHttpIo(MudHttpIo):
+    """
+    I/O adapter for a http/browser based interface, for the asyncio web server.
+    Besides the regular threading event, it signals new html via an asyncio event that the eventsource stream can await.
+    """
+    def __init__(self, player_connection: PlayerConnection) -> None:
+        self.event_loop = asyncio.get_event_loop()
+        self.html_available_async = asyncio.Event()
+        super().__init__(player_connection)
+
+    def notify_html_available(self) -> None:
+        super().notify_html_available()
+        # this is also called from the render worker threads, and asyncio events are not thread safe
+        if not self.event_loop.is_closed():
+            self.event_loop.call_soon_threadsafe(self.html_available_async.set)
+
+    async def wait_html_available_async(self, timeout: float=None) -> None:
+        try:
+            await asyncio.wait_for(self.html_available_async.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.html_available_async.clear()
+
+
+class EventStream:
+    """
+    Returned by the wsgi app instead of a regular response body, for the eventsource request.
+    The server writes the events to the browser asynchronously, whenever new html becomes available for the player.
+    """
+    def __init__(self, app: 'AsyncTaleMudWsgiApp', conn: PlayerConnection) -> None:
+        self.app = app
+        self.conn = conn
+
+    async def write_to(self, writer: asyncio.StreamWriter) -> None:
+        conn = self.conn
+        writer.write((":" + ' ' * 2050 + "\n\n").encode("utf-8"))   # padding for older browsers
+        await writer.drain()
+        while self.app.driver.is_running():
+            if conn.io and conn.player:
+                await conn.io.wait_html_available_async(timeout=15)   # keepalives every 15 sec
+            if not conn.io or not conn.player:
+                break
+            writer.write(self.app.eventsource_message(conn))
+            await writer.drain()
+
+
+class AsyncTaleMudWsgiApp(TaleMudWsgiApp):
+    """
+    The mud wsgi app, served by the asyncio web server.
+    The only difference is the eventsource request: it doesn't block a thread but is streamed asynchronously.
+    """
+    @classmethod
+    def create_app_server(cls, driver: Driver, *,
+                          use_ssl: bool=False, ssl_certs: Tuple[str, str, str]=None) -> 'AsyncWsgiServer':
+        if use_ssl:
+            raise ValueError("the asyncio web server doesn't support ssl")
+        wsgi_app = SessionMiddleware(cls(driver, False, None), MemorySessionFactory())    # type: ignore
+        return AsyncWsgiServer(wsgi_app, driver.story.config.mud_host, driver.story.config.mud_port)
+
+    def wsgi_handle_eventsource(self, environ: Dict[str, Any], parameters: Dict[str, str],
+                                start_response: WsgiStartResponseType) -> Iterable[bytes]:
+        session = environ["wsgi.session"]
+        conn = session.get("player_connection")
+        if not conn:
+            return self.wsgi_internal_server_error_json(start_response, "not logged in")
+        if not conn.player or not conn.io:
+            raise SessionMiddleware.CloseSession("{\"error\": \"no longer a valid connection\"}", "application/json")
+        start_response('200 OK', [('Content-Type', 'text/event-stream; charset=utf-8'),
+                                  ('Cache-Control', 'no-cache'),
+                                  ('X-Accel-Buffering', 'no')   # nginx
+                                  ])
+        return EventStream(self, conn)     # type: ignore
+
+
+class AsyncWsgiServer:
+    """
+    A minimal HTTP/1.1 server on the asyncio event loop, that serves a wsgi app.
+    Requests are handled one at a time in the thread of the event loop, the same thread the game loop runs in.
+    Eventsource streams don't occupy a thread each but are written asynchronously (see EventStream).
+    """
+    use_ssl = False
+    max_request_line = 8192
+    max_headers = 100
+    max_content_length = 1000000
+
+    def __init__(self, app: Any, host: str, port: int) -> None:
+        self.app = app
+        self.address_family = socket.AF_INET
+        if host and host[0] == '[' and host[-1] == ']':
+            self.address_family = socket.AF_INET6
+            host = host[1:-1]
+        self.host = host
+        self.port = port
+        self.server = None     # type: asyncio.AbstractServer
+
+    async def start(self) -> None:
+        family = socket.AF_INET6 if self.address_family == socket.AF_INET6 else socket.AF_INET
+        self.server = await asyncio.start_server(self.handle_client, self.host or None, self.port, family=family)
+
+    def close(self) -> None:
+        if self.server:
+            self.server.close()
+
+    @property
+    def server_address(self) -> Tuple:
+        return self.server.sockets[0].getsockname()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if not request:
+                    break
+                environ = self.make_environ(writer, *request)
+                status, headers, body = self.run_app(environ)
+                if isinstance(body, EventStream):
+                    self.write_head(writer, status, headers + [("Connection", "close")])
+                    await body.write_to(writer)
+                    break
+                keep_alive = environ["SERVER_PROTOCOL"] == "HTTP/1.1" and environ.get("HTTP_CONNECTION", "").lower() != "close"
+                headers.append(("Content-Length", str(len(body))))
+                headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+                self.write_head(writer, status, headers)
+                writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass    # client went away, or sent garbage
+        finally:
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, List[Tuple[str, str]], bytes]]:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        if len(request_line) > self.max_request_line:
+            raise ValueError("request line too long")
+        method, target, version = request_line.decode("iso-8859-1").rstrip("\r\n").split(" ", 2)
+        headers = []    # type: List[Tuple[str, str]]
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= self.max_headers:
+                raise ValueError("too many headers")
+            name, _, value = line.decode("iso-8859-1").partition(":")
+            headers.append((name.strip(), value.strip()))
+        body = b""
+        content_length = int(dict((name.lower(), value) for name, value in headers).get("content-length", 0))
+        if content_length > self.max_content_length:
+            raise ValueError("maximum content length exceeded")
+        if content_length:
+            body = await reader.readexactly(content_length)
+        return method, target, version, headers, body
+
+    def make_environ(self, writer: asyncio.StreamWriter, method: str, target: str, version: str,
+                     headers: List[Tuple[str, str]], body: bytes) -> Dict[str, Any]:
+        path, _, query = target.partition("?")
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": self.host or "localhost",
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }   # type: Dict[str, Any]
+        for name, value in headers:
+            name = name.upper().replace("-", "_")
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+            elif name != "CONTENT_LENGTH":
+                environ["HTTP_" + name] = value
+        return environ
+
+    def run_app(self, environ: Dict[str, Any]) -> Tuple[str, List[Tuple[str, str]], Any]:
+        response = []   # type: List[Any]
+
+        def start_response(status: str, response_headers: List[Tuple[str, str]], exc_info: Any=None) -> None:
+            response[:] = [status, list(response_headers)]
+
+        try:
+            result = self.app(environ, start_response)
+            if isinstance(result, EventStream):
+                return response[0], response[1], result
+            try:
+                body = b"".join(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+            return response[0], response[1], body
+        except Exception:
+            traceback.print_exc()
+            return "500 Internal Server Error", [("Content-Type", "text/plain")], b"Error 500: Internal Server Error"
+
+    def write_head(self, writer: asyncio.StreamWriter, status: str, headers: List[Tuple[str, str]]) -> None:
+        head = ["HTTP/1.1 " + status]
+        head.extend("%s: %s" % header for header in headers)
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("iso-8859-1"))
+
+
+class TelnetIo(iobase.IoAdapterBase):
+    """
+    I/O adapter for a raw telnet connection. Text styles are converted to ansi escape sequences.
+    """
+    def __init__(self, player_connection: PlayerConnection, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.closed = False
+        self.__echo_suppressed = False
+        super().__init__(player_connection)
+        self.supports_blocking_input = False
+
+    def __repr__(self):
+        peer = self.writer.get_extra_info("peername") or ("?", 0)
+        return "<TelnetIo @ 0x%x, telnet from %s:%d>" % (id(self), peer[0], peer[1])
+
+    @property
+    def dont_echo_next_cmd(self) -> bool:
+        return self.__echo_suppressed
+
+    @dont_echo_next_cmd.setter
+    def dont_echo_next_cmd(self, value: bool) -> None:
+        # the server announcing it will do the echoing (but doesn't), keeps the client from echoing the password
+        if value != self.__echo_suppressed:
+            self.__echo_suppressed = value
+            self._write(bytes([IAC, WILL if value else WONT, OPTION_ECHO]))
+
+    @property
+    def is_closing(self) -> bool:
+        # StreamWriter.is_closing() only exists since Python 3.7, the transport has it
+        return self.closed or self.writer.transport.is_closing()
+
+    def destroy(self) -> None:
+        if not self.is_closing:
+            self.writer.close()
+        self.closed = True
+
+    def singleplayer_mainloop(self, player_connection: PlayerConnection) -> None:
+        raise RuntimeError("this I/O adapter is for multiplayer (mud) mode")
+
+    def pause(self, unpause: bool=False) -> None:
+        # we'll never pause a mud server.
+        pass
+
+    def received_line(self, line: str) -> None:
+        """Called by the telnet server with a line of text that the player entered."""
+        if self.dont_echo_next_cmd:
+            self.dont_echo_next_cmd = False
+            self._write(b"\r\n")    # the client didn't echo the newline either
+        self.player_connection.player.store_input_line(line)
+
+    def clear_screen(self) -> None:
+        if self.do_styles:
+            self._write(telnet_style_words["clear"])
+
+    def render_output(self, paragraphs: Sequence[Tuple[str, bool]], **params: Any) -> str:
+        if not paragraphs:
+            return ""
+        indent = " " * params["indent"]
+        wrapper = styleaware_wrapper.get_wrapper(params["width"], params["indent"])
+        output = []
+        for txt, formatted in paragraphs:
+            if formatted:
+                txt = wrapper.fill(txt) + "\n"
+            else:
+                # unformatted output, prepend every line with the indent but otherwise leave them alone
+                txt = indent + ("\n" + indent).join(txt.splitlines()) + "\n"
+            output.append(txt)
+        return self.smartquotes("".join(output))
+
+    def output(self, *lines: str) -> None:
+        super().output(*lines)
+        for line in lines:
+            self._write(self._apply_style(line) + "\n")
+
+    def output_no_newline(self, text: str) -> None:
+        super().output_no_newline(text)
+        self._write(self._apply_style(text))
+
+    def write_input_prompt(self) -> None:
+        self._write(self._apply_style("\n<dim>>></> "))
+
+    def _apply_style(self, line: str) -> str:
+        if "<" not in line:
+            return line
+        elif self.do_styles:
+            for tag, replacement in telnet_style_words.items():
+                line = line.replace("<%s>" % tag, replacement)
+            return line
+        return iobase.strip_text_styles(line)       # type: ignore
+
+    def _write(self, data: Any) -> None:
+        if isinstance(data, str):
+            data = data.replace("\n", "\r\n").encode("utf-8")
+        if not self.is_closing:
+            self.writer.write(data)
+
+
+class TelnetServer:
+    """
+    Raw telnet server on the asyncio event loop. Every client gets a regular player connection
+    with a TelnetIo adapter, and goes through the same login dialog as the players in the browser.
+    """
+    max_line_length = 4096
+
+    def __init__(self, driver: Driver, host: str, port: int) -> None:
+        self.driver = driver
+        self.address_family = socket.AF_INET
+        if host and host[0] == '[' and host[-1] == ']':
+            self.address_family = socket.AF_INET6
+            host = host[1:-1]
+        self.host = host
+        self.port = port
+        self.server = None     # type: asyncio.AbstractServer
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle_client, self.host or None, self.port,
+                                                 family=self.address_family, limit=self.max_line_length)
+
+    def close(self) -> None:
+        if self.server:
+            self.server.close()
+
+    @property
+    def server_address(self) -> Tuple:
+        return self.server.sockets[0].getsockname()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = self.driver.connect_telnet_player(writer)    # type: ignore
+        try:
+            while conn.io and conn.player:
+                data = await reader.readline()
+                if not data:
+                    break   # client closed the connection
+                line = strip_telnet_commands(data).decode("utf-8", errors="replace").strip()
+                if conn.io:
+                    conn.io.received_line(line)
+        except (ConnectionError, ValueError):
+            pass    # client went away, or sent a line that is too long
+        finally:
+            if conn.player and self.driver.all_players.get(conn.player.name) is conn:
+                self.driver.disconnect_player(conn)
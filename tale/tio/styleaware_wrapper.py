@@ -4,6 +4,7 @@ Textwrapper that doesn't count the length of the embedded formatting tags.
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import functools
 import re
 import textwrap
 from typing import List
@@ -65,6 +66,16 @@ class StyleTagsAwareTextWrapper(textwrap.TextWrapper):
         return lines
 
 
+@functools.lru_cache(maxsize=64)
+def get_wrapper(width: int, indent: int) -> StyleTagsAwareTextWrapper:
+    """
+    Shared text wrapper for the given screen width and indent, used to format the output paragraphs.
+    The wrappers don't change state while filling text so they can be reused (also by multiple threads).
+    """
+    indent_str = " " * indent
+    return StyleTagsAwareTextWrapper(width=width, fix_sentence_endings=True, initial_indent=indent_str, subsequent_indent=indent_str)
+
+
 if __name__ == "__main__":
     w = StyleTagsAwareTextWrapper(width=20)
     print(w.fill("this is some normal text, without any style tags"))
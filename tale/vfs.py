@@ -221,6 +221,12 @@ class VirtualFileSystem:
         except IOError:
             pass
 
+    def replace(self, source: str, target: str) -> None:
+        """Renames the source resource to the target, replacing the target if it exists (atomically)."""
+        if self.readonly:
+            raise VfsError("attempt to write a read-only vfs")
+        os.replace(self.validate_path(source), self.validate_path(target))
+
     def open_write(self, name: str, mimetype: str="", append: bool=False) -> IO[Any]:
         """returns a writable file io stream"""
         if self.readonly:
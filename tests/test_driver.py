@@ -5,18 +5,37 @@ Unittests for the driver
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import concurrent.futures
 import datetime
 import heapq
+import io
+import json
 import os
+import random
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 import tale.base
 import tale.demo
 import tale.driver
 import tale.driver_if
 import tale.driver_mud
+import tale.driver_mud_async
+import tale.persistence
+import tale.player
+import tale.savegames
+import tale.story
 import tale.util
+from tale.activity import ActivityScheduler
+from tale.tickstats import LatencyHistogram, TickStats
+from tale.tio.iobase import IoAdapterBase
+from tale.timerwheel import TimerWheel
+from tale.vfs import VirtualFileSystem
 from tale.cmds import cmd, wizcmd, disabled_in_gamemode
+from tale.items.bank import Bank
+from tale.items.board import BulletinBoard
 from tale.story import GameMode
 from tests.supportstuff import Thing, FakeDriver
 
@@ -61,6 +80,541 @@ class TestDriverCreation(unittest.TestCase):
         self.assertIsNone(d.resources)
         self.assertIsNone(d.user_resources)
 
+    def testMudAsync(self):
+        d = tale.driver_mud_async.AsyncMudDriver(False, 8201)
+        self.assertEqual(GameMode.MUD, d.game_mode)
+        self.assertFalse(d.restricted)
+        self.assertEqual(8201, d.telnet_port)
+        self.assertIsNone(d.event_loop)
+        d.wakeup()
+        self.assertTrue(d.main_loop_wakeup.is_set())
+
+    def testWakeup(self):
+        d = tale.driver_mud.MudDriver()
+        self.assertFalse(d.main_loop_wakeup.is_set())
+        p = tale.player.Player("julie", "f")
+        p.store_input_line("look")
+        self.assertTrue(d.main_loop_wakeup.is_set(), "player input should wake up the driver loop")
+        d.main_loop_wakeup.clear()
+        d._stop_driver()
+        self.assertTrue(d.main_loop_wakeup.is_set())
+
+    def test_rehash_failure_is_reported(self):
+        d = tale.driver_mud.MudDriver()
+        future = concurrent.futures.Future()
+        future.set_exception(ValueError("database is locked"))
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            d._rehash_password_done(future)
+            future = concurrent.futures.Future()
+            future.set_result(None)
+            d._rehash_password_done(future)
+        self.assertIn("Error while rehashing a password", stderr.getvalue())
+        self.assertIn("database is locked", stderr.getvalue())
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_order(self):
+        wheel = TimerWheel(resolution=1.0)
+        rnd = random.Random(42)
+        items = [(rnd.uniform(0, 20000000), i) for i in range(3000)]    # spans all levels and the overflow
+        items += [(1000.5, "a"), (1000.25, "b"), (1000.75, "c")]
+        for due, item in items:
+            wheel.insert(item, due)
+        self.assertEqual(len(items), len(wheel))
+        dues = dict((item, due) for due, item in items)
+        popped = []
+        now = 0.0
+        while now < 20000000:
+            now += rnd.uniform(0.1, 30000)
+            due = wheel.pop_due(now)
+            self.assertTrue(all(dues[item] <= now for item in due))
+            popped.extend(due)
+            self.assertTrue(all(dues[item] > now for item in wheel))
+        popped.extend(wheel.pop_due(now))
+        self.assertEqual([item for due, item in sorted(items)], popped)
+        self.assertEqual(0, len(wheel))
+
+    def test_within_tick(self):
+        wheel = TimerWheel(resolution=1.0)
+        wheel.insert("x", 10.8)
+        wheel.insert("y", 10.2)
+        self.assertEqual([], wheel.pop_due(10.1))
+        self.assertEqual(["y"], wheel.pop_due(10.5))
+        wheel.insert("z", 9.0)    # already due
+        self.assertEqual(["z"], wheel.pop_due(10.5))
+        self.assertEqual(["x"], wheel.pop_due(11))
+        self.assertEqual([], wheel.pop_due(100))
+
+    def test_far_item_first(self):
+        wheel = TimerWheel(resolution=1.0, now=1000000.0)
+        wheel.insert("far", 1003601.0)
+        for i in range(1, 60):
+            wheel.insert(i, 1000000.0 + i)
+        self.assertEqual([], wheel.near)
+        self.assertEqual(59, wheel.level_counts[0])
+        self.assertEqual(59, sum(len(bucket) for bucket in wheel.levels[0]))
+        self.assertEqual(list(range(1, 60)), wheel.pop_due(1000059.5))
+        self.assertEqual(["far"], wheel.pop_due(1003601.0))
+        wheel.clear(5000000.0)
+        wheel.insert("x", 5000010.0)
+        self.assertEqual(1, wheel.level_counts[0])
+        self.assertEqual(["x"], wheel.pop_due(5000010.0))
+
+    def test_remove(self):
+        wheel = TimerWheel(resolution=1.0)
+        owner1 = object()
+        owner2 = object()
+        for i in range(100):
+            wheel.insert(i, i * 100.0, id(owner1) if i % 2 else id(owner2))
+        wheel.insert("near", 0.5)
+        self.assertTrue(wheel.remove("near"))
+        self.assertFalse(wheel.remove("near"))
+        self.assertTrue(wheel.remove(50))
+        self.assertNotIn(50, wheel)
+        with self.assertRaises(ValueError):
+            wheel.insert(51, 5.0)
+        removed = wheel.remove_group(id(owner1))
+        self.assertEqual(50, len(removed))
+        self.assertEqual([], wheel.remove_group(id(owner1)))
+        self.assertEqual(49, len(wheel))
+        self.assertEqual([i for i in range(0, 100, 2) if i != 50], wheel.pop_due(99999))
+        self.assertEqual(0, len(wheel))
+        wheel.insert("again", 5.0)
+        wheel.clear()
+        self.assertEqual(0, len(wheel))
+
+
+class RecordingIo(IoAdapterBase):
+    def __init__(self, conn):
+        super().__init__(conn)
+        self.rendered = 0
+        self.lines = []
+
+    def render_output(self, paragraphs, **params):
+        self.rendered += 1
+        return "".join(text for text, formatted in paragraphs)
+
+    def output(self, *lines):
+        super().output(*lines)
+        self.lines.extend(lines)
+
+
+class TestOutputStage(unittest.TestCase):
+    def setUp(self):
+        tale.mud_context.config = tale.story.StoryConfig()
+
+    def tearDown(self):
+        tale.mud_context.driver = None
+
+    def make_connections(self, amount):
+        connections = []
+        for i in range(amount):
+            conn = tale.player.PlayerConnection()
+            conn.player = tale.player.Player("player%d" % i, "n")
+            conn.io = RecordingIo(conn)
+            connections.append(conn)
+        return connections
+
+    def test_write_players_output(self):
+        driver = tale.driver.Driver()
+        connections = self.make_connections(3)
+        connections[0].player.tell("hello", end=True)
+        connections[2].player.tell("world", end=True)
+        self.assertFalse(connections[1].has_output)
+        driver.write_players_output(connections)
+        self.assertEqual(["hello"], connections[0].io.lines)
+        self.assertEqual([], connections[1].io.lines)
+        self.assertEqual(0, connections[1].io.rendered, "connections without output should not be rendered")
+        self.assertEqual(["world"], connections[2].io.lines)
+        self.assertFalse(connections[0].has_output)
+
+    def test_render_pool(self):
+        driver = tale.driver.Driver()
+        driver.render_pool = concurrent.futures.ThreadPoolExecutor(2)
+        try:
+            connections = self.make_connections(10)
+            for conn in connections:
+                conn.player.tell("message for " + conn.player.name, end=True)
+            driver.write_players_output(connections)
+        finally:
+            driver.render_pool.shutdown()
+        for conn in connections:
+            self.assertEqual(["message for " + conn.player.name], conn.io.lines)
+            self.assertEqual(1, conn.io.rendered)
+
+
+class TestDialogJobs(unittest.TestCase):
+    def setUp(self):
+        tale.mud_context.config = tale.story.StoryConfig()
+
+    def tearDown(self):
+        tale.mud_context.driver = None
+
+    def test_wait_for_job(self):
+        driver = tale.driver.Driver()
+        finished = []
+        driver._job_done = lambda conn, dialog, future: finished.append((conn, dialog, future))
+        conn = tale.player.PlayerConnection()
+        conn.player = tale.player.Player("julie", "f")
+        conn.io = RecordingIo(conn)
+        results = []
+        job = concurrent.futures.Future()
+        failing_job = concurrent.futures.Future()
+        failing_job.set_exception(ValueError("wrong password"))
+
+        def dialog():
+            results.append((yield "wait", job))
+            try:
+                yield "wait", failing_job
+            except ValueError as x:
+                results.append(str(x))
+        driver._continue_dialog(conn, dialog(), "")
+        self.assertIn(conn, driver.waiting_for_jobs)
+        self.assertEqual([], finished)
+        job.set_result(42)
+        self.assertEqual(1, len(finished))
+        driver.pubsub_event("driver-async-dialogs", finished.pop())
+        self.assertEqual([42], results)
+        driver.pubsub_event("driver-async-dialogs", finished.pop())
+        self.assertEqual([42, "wrong password"], results)
+        self.assertNotIn(conn, driver.waiting_for_jobs)
+
+
+class TestBackgroundSavegame(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.driver = tale.driver_if.IFDriver()
+        self.driver.story = tale.story.StoryBase()
+        self.driver.story.config = tale.story.StoryConfig()
+        self.driver.story.config.name = "Savegame Test"
+        self.driver.story.config.playable_races = {"human"}
+        self.driver.story.config.server_tick_method = tale.story.TickMethod.TIMER
+        self.driver.game_clock = tale.util.GameDateTime(datetime.datetime(2020, 1, 1))
+        self.driver.user_resources = VirtualFileSystem(root_path=self.tempdir.name, readonly=False)
+        tale.mud_context.driver = self.driver
+        tale.mud_context.config = self.driver.story.config
+        self.player = tale.player.Player("julie", "f")
+        self.room = tale.base.Location("room")
+        self.room.insert(self.player, None)
+
+    def tearDown(self):
+        tale.mud_context.driver = None
+        self.tempdir.cleanup()
+
+    def test_save_in_background(self):
+        self.driver.do_save(self.player)
+        self.assertIsNotNone(self.driver.savegame_thread, "timer driven games save in the background")
+        self.driver.wait_for_savegame()
+        self.assertIsNone(self.driver.savegame_thread)
+        self.assertIsNotNone(self.driver.savegame_digests)
+        self.assertTrue(self.player.test_get_output_paragraphs()[0].startswith("Game saved."))
+        self.assertEqual(["savegame_test.savegame"], list(self.driver.user_resources.contents()))
+        # the next save is a delta, it doesn't see changes that happen after the snapshot was taken
+        self.room.name = "hall"
+        self.driver.do_save(self.player)
+        self.room.name = "room"
+        self.driver.wait_for_savegame()
+        records = tale.savegames.SavegameReader(self.driver.user_resources["savegame_test.savegame"].data,
+                                                self.driver.user_resources["savegame_test.savegame.delta"].data).records()
+        locations = [literal["name"] for kind, literal in records if kind == "locations"]
+        self.assertIn("hall", locations)
+
+    def test_save_failure(self):
+        self.driver.user_resources = VirtualFileSystem(root_path=self.tempdir.name, readonly=True)
+        self.driver.do_save(self.player)
+        self.driver.wait_for_savegame()
+        self.assertIsNone(self.driver.savegame_digests)
+        output = self.player.test_get_output_paragraphs()
+        self.assertTrue(output[0].startswith("Saving the game failed"))
+
+    def test_failed_save_keeps_previous_savegame(self):
+        self.driver.do_save(self.player)
+        self.driver.wait_for_savegame()
+        data = self.driver.user_resources["savegame_test.savegame"].data
+        self.driver.savegame_digests = None
+
+        def broken_write(stream, snapshot):
+            stream.write(b"TALESAVE2 partial")
+            raise IOError("disk full")
+
+        with mock.patch.object(tale.savegames.SavegameWriter, "write_snapshot", side_effect=broken_write):
+            self.driver.do_save(self.player)
+            self.driver.wait_for_savegame()
+        self.assertEqual(data, self.driver.user_resources["savegame_test.savegame"].data)
+        self.assertEqual(["savegame_test.savegame"], list(self.driver.user_resources.contents()))
+
+    def test_load_damaged_savegame(self):
+        key = tale.base.Item("key")
+        self.room.insert(key, None)
+        self.driver.do_save(self.player)
+        self.driver.wait_for_savegame()
+        data = self.driver.user_resources["savegame_test.savegame"].data
+        self.driver.user_resources["savegame_test.savegame"] = data[:len(data) // 2]
+        other_room = tale.base.Location("other room")
+        key.move(other_room)
+        self.player.test_get_output_paragraphs()
+        self.driver.all_players = {"julie": tale.player.PlayerConnection(self.player)}
+        with self.assertRaises(SystemExit) as x:
+            self.driver._load_saved_game(self.player)
+        self.assertEqual(10, x.exception.code)
+        self.assertIs(other_room, key.location, "nothing is loaded from a damaged savegame")
+
+
+class TestWorldStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.tempdir.name, "world.sqlite")
+        self.driver = FakeDriver()
+        self.driver.user_resources = VirtualFileSystem(root_path=self.tempdir.name, readonly=False)
+        self.driver.world_store = tale.persistence.WorldStore()
+        tale.mud_context.driver = self.driver
+        self.actor = tale.player.Player("julie", "f")
+
+    def tearDown(self):
+        self.driver.world_store.close()
+        tale.mud_context.driver = None
+        self.tempdir.cleanup()
+
+    def restart(self):
+        self.driver.world_store.close()
+        self.driver.world_store = tale.persistence.WorldStore()
+
+    def test_checkpoint_and_restore(self):
+        bank = Bank("atm")
+        bank.storage_file = "bank.json"
+        bank.load()     # the store isn't open yet (zones are loaded first)
+        board = BulletinBoard("board")
+        board.storage_file = "board.json"
+        board.load()
+        self.driver.world_store.open(self.dbfile)
+        self.assertFalse(self.driver.world_store.dirty)
+        bank.accounts["julie"] = 42.0
+        bank.save()
+        bank.accounts["julie"] = 43.0
+        bank.save()
+        board.posts = [{"author": "julie", "date": "2017-01-01", "subject": "hello", "text": "world"}]
+        board.save()
+        self.assertNotIn("bank.json", list(self.driver.user_resources.contents()), "no more data files")
+        self.assertEqual({"bank.json", "board.json"}, set(self.driver.world_store.dirty))
+        self.assertFalse(self.driver.world_store.checkpoint_due(time.time(), 60.0))
+        self.assertTrue(self.driver.world_store.checkpoint_due(time.time() + 61.0, 60.0))
+        self.assertEqual(2, self.driver.world_store.checkpoint())
+        self.assertEqual(0, self.driver.world_store.checkpoint())
+        self.restart()
+        bank2 = Bank("atm")
+        bank2.storage_file = "bank.json"
+        self.driver.world_store.open(self.dbfile)
+        bank2.load()
+        self.assertEqual(43.0, bank2.accounts["julie"])
+        self.assertEqual(0.0, bank2.accounts["unknown"])
+        board2 = BulletinBoard("board")
+        board2.storage_file = "board.json"
+        board2.load()
+        self.assertEqual("hello", board2.posts[0]["subject"])
+        self.assertEqual(1, self.driver.world_store.versions["board.json"])
+
+    def test_journal(self):
+        store = self.driver.world_store
+        store.compact_journal = 3
+        store.open(self.dbfile)
+        bank = Bank("atm")
+        bank.storage_file = "bank.json"
+        bank.load()
+        for amount in (10.0, 20.0):
+            bank.accounts["julie"] += amount
+            bank.log_transaction(self.actor, "deposit", amount, bank.accounts["julie"])
+            bank.save_transaction("julie")
+        board = BulletinBoard("board")
+        board.storage_file = "board.json"
+        board.load()
+        board.posts = [{"author": "julie", "date": "2017-01-01", "subject": "first", "text": "text"}]
+        board.save()
+        board.posts = [{"author": "julie", "date": "2017-01-02", "subject": "second", "text": "text"}] + board.posts
+        board.save_change({"post": board.posts[0]})
+        board.posts = board.posts[1:]
+        board.save_change({"remove": 0})
+        self.assertEqual({"board.json"}, set(store.dirty), "journal entries are written right away")
+        store.flush()
+        self.assertEqual(4, self.driver.world_store.conn.execute("SELECT count(*) FROM Journal").fetchone()[0])
+        self.restart()
+        self.driver.world_store.open(self.dbfile)
+        bank2 = Bank("atm")
+        bank2.storage_file = "bank.json"
+        bank2.load()
+        self.assertEqual(30.0, bank2.accounts["julie"])
+        self.assertEqual(2, len(bank2.transaction_log))
+        board2 = BulletinBoard("board")
+        board2.storage_file = "board.json"
+        board2.load()
+        self.assertEqual(["first"], [post["subject"] for post in board2.posts])
+        # the third journal entry of the bank compacts its journal
+        self.driver.world_store.compact_journal = 3
+        bank2.accounts["julie"] = 0.0
+        bank2.log_transaction(self.actor, "withdraw", 30.0, 0.0)
+        bank2.save_transaction("julie")
+        self.assertIn("bank.json", self.driver.world_store.dirty)
+        self.driver.world_store.checkpoint()
+        self.driver.world_store.flush()
+        self.assertEqual(0, self.driver.world_store.conn.execute("SELECT count(*) FROM Journal").fetchone()[0])
+        self.assertEqual(1, self.driver.world_store.num_compacted)
+        self.restart()
+        self.driver.world_store.open(self.dbfile)
+        bank3 = Bank("atm")
+        bank3.storage_file = "bank.json"
+        bank3.load()
+        self.assertEqual(0.0, bank3.accounts["julie"])
+        self.assertEqual(3, len(bank3.transaction_log))
+
+    def test_convert_datafile(self):
+        self.driver.user_resources["bank.json"] = json.dumps({"accounts": {"julie": 10.0}, "transactions": ["tx"]})
+        bank = Bank("atm")
+        bank.storage_file = "bank.json"
+        bank.load()
+        self.driver.world_store.open(self.dbfile)
+        self.assertEqual(10.0, bank.accounts["julie"])
+        self.assertEqual(["tx"], list(bank.transaction_log))
+        self.assertEqual(1, self.driver.world_store.checkpoint(), "converted state must be written to the store")
+
+    def test_without_store(self):
+        self.driver.world_store, store = None, self.driver.world_store   # if mode
+        try:
+            bank = Bank("atm")
+            bank.storage_file = "bank.json"
+            bank.accounts["julie"] = 5.0
+            bank.save()
+            self.assertEqual({"julie": 5.0}, json.loads(self.driver.user_resources["bank.json"].text)["accounts"])
+            bank2 = Bank("atm")
+            bank2.storage_file = "bank.json"
+            bank2.load()
+            self.assertEqual(5.0, bank2.accounts["julie"])
+        finally:
+            self.driver.world_store = store
+
+
+class TestTickStats(unittest.TestCase):
+    def test_histogram(self):
+        h = LatencyHistogram()
+        self.assertEqual(0.0, h.mean)
+        self.assertEqual(0.0, h.percentile(0.95))
+        for duration in [0.00005] * 90 + [0.003] * 9 + [4.0]:
+            h.add(duration)
+        self.assertEqual(100, h.count)
+        self.assertEqual(4.0, h.max)
+        self.assertAlmostEqual(4.0315, h.total)
+        self.assertEqual(0.0001, h.percentile(0.5))
+        self.assertEqual(0.005, h.percentile(0.95))
+        self.assertEqual(4.0, h.percentile(1.0))
+        d = h.as_dict()
+        self.assertEqual(90, d["buckets"]["<=0.0001"])
+        self.assertEqual(1, d["buckets"][">2.5"])
+
+    def test_ticks(self):
+        stats = TickStats(history=2)
+        stats.add_phase("commands", 0.5)
+        stats.add_phase("deferreds", 0.1)
+        stats.add_deferred("Thing.append", 0.1)
+        stats.add_verb("look", 0.5)
+        stats.end_tick(1.0, 1)
+        stats.add_phase("deferreds", 2.0)
+        stats.end_tick(1.0, 5)
+        stats.end_tick(1.0, 0)
+        self.assertEqual(3, stats.num_ticks)
+        self.assertEqual(1, stats.late_ticks)
+        self.assertEqual(2, len(stats.recent_ticks))
+        self.assertEqual(2.0, stats.recent_ticks[0]["duration"])
+        self.assertEqual(5, stats.recent_ticks[0]["num_deferreds"])
+        self.assertAlmostEqual(2.6, stats.tick_durations.as_dict()["total"])
+        dump = stats.dump()
+        json.dumps(dump)
+        self.assertEqual(1, dump["verbs"]["look"]["count"])
+        self.assertEqual(2, dump["phases"]["deferreds"]["count"])
+        stats.reset()
+        self.assertEqual(0, stats.num_ticks)
+        self.assertEqual({}, stats.verbs)
+
+    def test_server_tick(self):
+        driver = FakeDriver()
+        driver.story = tale.story.StoryBase()
+        t = Thing()
+        driver.defer(0.1, t.append, 42)
+        tale.mud_context.driver = driver
+        try:
+            driver._server_tick()
+        finally:
+            tale.mud_context.driver = None
+        self.assertEqual([42], t.x)
+        self.assertEqual(1, driver.tick_stats.num_ticks)
+        self.assertEqual(["Thing.append"], list(driver.tick_stats.deferred_actions))
+        self.assertEqual(1, driver.tick_stats.recent_ticks[0]["num_deferreds"])
+
+
+class TestActivityScheduler(unittest.TestCase):
+    class Npc:
+        def __init__(self, name: str, region: str) -> None:
+            self.name = name
+            self.region = region
+
+    def setUp(self):
+        self.runs = []
+
+    def activity(self, npc, ctx):
+        self.runs.append(npc.name)
+
+    def test_every_npc_once_per_period(self):
+        scheduler = ActivityScheduler(self.activity, lambda npc: npc.region, period=10.0, tick_time=2.0, budget=1.0)
+        self.assertEqual(5, len(scheduler.shards))
+        npcs = [self.Npc("npc%d" % i, "town") for i in range(20)]
+        for npc in npcs:
+            scheduler.add(npc)
+        self.assertEqual(20, len(scheduler))
+        self.assertIn(npcs[0], scheduler)
+        runs_per_tick = [scheduler.tick(None, {"town"}) for _ in range(5)]
+        self.assertEqual(20, sum(runs_per_tick))
+        self.assertLess(max(runs_per_tick), 20, "spread over the ticks")
+        self.assertEqual(sorted(npc.name for npc in npcs), sorted(self.runs))
+        scheduler.remove(npcs[0])
+        scheduler.remove(npcs[0])
+        self.assertNotIn(npcs[0], scheduler)
+        for _ in range(5):
+            scheduler.tick(None, {"town"})
+        self.assertEqual(39, len(self.runs))
+        stats = scheduler.stats()
+        self.assertEqual(19, stats["npcs"])
+        self.assertEqual(10, stats["ticks"])
+        self.assertEqual(39, stats["runs"])
+        self.assertEqual(0, stats["asleep"])
+        self.assertLess(stats["budget_used_max"], 1.0)
+
+    def test_sleep_and_priority(self):
+        scheduler = ActivityScheduler(self.activity, lambda npc: npc.region, period=1.0, tick_time=1.0)
+        scheduler.add(self.Npc("guard", "town"))
+        scheduler.add(self.Npc("wolf", "forest"))
+        self.assertEqual(0, scheduler.tick(None, set()))
+        self.assertEqual(1, scheduler.tick(None, {"forest"}))
+        self.assertEqual(["wolf"], self.runs)
+        self.assertEqual(3, scheduler.stats()["asleep"])
+        self.runs.clear()
+        scheduler.sleep_idle = False
+        self.assertEqual(2, scheduler.tick(None, {"forest"}))
+        self.assertEqual(["wolf", "guard"], self.runs, "npcs in awake regions go first")
+
+    def test_budget(self):
+        def slow_activity(npc, ctx):
+            self.runs.append(npc.name)
+            time.sleep(0.01)
+        scheduler = ActivityScheduler(slow_activity, lambda npc: npc.region, period=1.0, tick_time=1.0, budget=0.001)
+        for i in range(3):
+            scheduler.add(self.Npc("npc%d" % i, "town"))
+        self.assertEqual(1, scheduler.tick(None, {"town"}), "at least one is run, even over budget")
+        self.assertEqual(2, scheduler.stats()["pending"])
+        self.assertEqual(1, scheduler.tick(None, {"town"}))
+        self.assertEqual(1, scheduler.tick(None, {"town"}))
+        self.assertEqual(3, len(set(self.runs)), "carried over npcs are not queued twice")
+        stats = scheduler.stats()
+        self.assertEqual(3, stats["over_budget"])
+        self.assertEqual(6, stats["carried_over"], "two npcs were left over in every tick")
+        self.assertGreater(stats["budget_used_mean"], 1.0)
+
 
 class TestDeferreds(unittest.TestCase):
     def testSortable(self):
@@ -86,7 +640,7 @@ class TestDeferreds(unittest.TestCase):
         with self.assertRaises(ValueError):
             driver.defer("blerp", thing.move)
         driver.defer(3601, thing.move)
-        deferred = driver.deferreds[0]
+        deferred = next(iter(driver.deferreds))
         after = deferred.due_gametime - now
         self.assertEqual(3601, after.seconds)
 
@@ -97,7 +651,7 @@ class TestDeferreds(unittest.TestCase):
         driver.game_clock = tale.util.GameDateTime(now, 1)
         due = driver.game_clock.plus_realtime(datetime.timedelta(seconds=3601))
         driver.defer(due, thing.move)
-        deferred = driver.deferreds[0]
+        deferred = next(iter(driver.deferreds))
         after = deferred.due_gametime - now
         self.assertEqual(3601, after.seconds)
 
@@ -137,6 +691,52 @@ class TestDeferreds(unittest.TestCase):
         with self.assertRaises(ValueError):
             d = tale.driver.Deferred(due, lambda a, ctx=None: 1, [42], None)
 
+    def testCancel(self):
+        t = Thing()
+        due = datetime.datetime.now()
+        ctx = tale.util.Context(driver=FakeDriver(), clock=None, config=None, player_connection=None)
+        d = tale.driver.Deferred(due, t.append, [42], None)
+        self.assertFalse(d.cancelled)
+        d.cancel()
+        self.assertTrue(d.cancelled)
+        d(ctx=ctx)
+        self.assertEqual([], t.x, "cancelled deferred must not be called")
+
+    def testResolvedOnce(self):
+        due = datetime.datetime.now()
+        ctx = tale.util.Context(driver=FakeDriver(), clock=None, config=None, player_connection=None)
+        d = tale.driver.Deferred(due, module_level_func, [], None, periodical=(1, 2))
+        self.assertIsNone(d._func)
+        tale.mud_context.driver = ctx.driver
+        try:
+            d(ctx=ctx)
+            self.assertIs(module_level_func, d._func)
+            self.assertEqual("module:tests.test_driver", d.owner, "owner must stay serializable")
+            self.assertIn(d, ctx.driver.deferreds, "periodical must be rescheduled")
+            ctx.driver.deferreds.remove(d)
+            d(ctx=ctx)
+            self.assertTrue(tale.driver._accepts_ctx.cache_info().hits > 0)
+            self.assertIn(d, ctx.driver.deferreds)
+        finally:
+            tale.mud_context.driver = None
+
+    def testRemoveDeferreds(self):
+        t1 = Thing()
+        t2 = Thing()
+        driver = tale.driver.Driver()
+        driver.game_clock = tale.util.GameDateTime(datetime.datetime.now())
+        d1 = driver.defer(10, t1.append, 1)
+        d2 = driver.defer(20, t2.append, 2)
+        d3 = driver.defer(30, t1.append, 3)
+        due_now = tale.driver.Deferred(datetime.datetime.now(), t1.append, [4], None)
+        driver.deferreds_due = [due_now]     # as if it is being called in the current server tick
+        driver.remove_deferreds(t1)
+        self.assertEqual([d2], list(driver.deferreds))
+        self.assertTrue(d1.cancelled)
+        self.assertTrue(d3.cancelled)
+        self.assertFalse(d2.cancelled)
+        self.assertTrue(due_now.cancelled)
+
     def testDue_realtime(self):
         # test due timings where the gameclock == realtime clock
         game_clock = tale.util.GameDateTime(datetime.datetime(2013, 7, 18, 15, 29, 59, 123))
@@ -243,6 +843,19 @@ class TestCommands(unittest.TestCase):
         wiz = self.cmds.get([None])
         self.assertEqual({"verb2"}, set(wiz.keys()))
 
+    def testCompiledTable(self):
+        table = self.cmds.get_table({"wizard"})
+        self.assertEqual({"verb1", "verb2", "verb3"}, set(table))
+        self.assertIs(table, self.cmds.get_table(["wizard"]))
+        self.assertIsNot(table, self.cmds.get_table(["noob"]))
+        with self.assertRaises(TypeError):
+            table["verb5"] = func1
+        self.cmds.override("verb3", func1, "wizard")
+        table = self.cmds.get_table({"wizard"})
+        self.assertIs(func1, table["verb3"])
+        self.cmds.adjust_available_commands(GameMode.IF)
+        self.assertEqual({"verb2"}, set(self.cmds.get_table({"wizard"})), "func1 is disabled in IF mode")
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,128 @@
+"""
+Unit tests for the asyncio based mud I/O (web server and telnet)
+
+'Tale' mud driver, mudlib and interactive fiction framework
+Copyright by Irmen de Jong (irmen@razorvine.net)
+"""
+import asyncio
+import threading
+import unittest
+
+from tale.player import TextBuffer
+from tale.tio import mud_async_io
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+        self.transport = self
+
+    def write(self, data):
+        self.data += data
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 12345)
+
+
+class TestTelnet(unittest.TestCase):
+    def test_strip_commands(self):
+        strip = mud_async_io.strip_telnet_commands
+        self.assertEqual(b"look\r\n", strip(b"look\r\n"))
+        self.assertEqual(b"look\r\n", strip(bytes([255, 253, 1]) + b"lo" + bytes([255, 241]) + b"ok\r\n"))
+        self.assertEqual(b"a\xffb", strip(b"a\xff\xffb"))
+        self.assertEqual(b"ab", strip(b"a" + bytes([255, 250, 24, 0]) + b"xterm" + bytes([255, 240]) + b"b"))
+
+    def test_output_styles(self):
+        writer = FakeWriter()
+        io = mud_async_io.TelnetIo(None, writer)
+        self.assertEqual(b"", writer.data)
+        io.output("<bright>hello</>", "line2")
+        self.assertEqual(b"\x1b[1mhello\x1b[0m\r\nline2\r\n", writer.data)
+        self.assertEqual("line2", io.last_output_line)
+        writer.data = b""
+        io.do_styles = False
+        io.output_no_newline("<it>prompt</> ")
+        self.assertEqual(b"prompt ", writer.data)
+        io.destroy()
+        self.assertTrue(writer.closed)
+        io.output("gone")
+        self.assertEqual(b"prompt ", writer.data, "nothing is written after the connection is closed")
+
+    def test_render(self):
+        output = TextBuffer()
+        output.print("one two three four five six seven")
+        io = mud_async_io.TelnetIo(None, FakeWriter())
+        self.assertEqual("  one two three\n  four five six\n  seven\n", io.render_output(output.get_paragraphs(), indent=2, width=15))
+
+    def test_noecho(self):
+        writer = FakeWriter()
+        io = mud_async_io.TelnetIo(None, writer)
+        io.dont_echo_next_cmd = True
+        self.assertEqual(bytes([255, 251, 1]), writer.data)
+        io.dont_echo_next_cmd = True
+        self.assertEqual(bytes([255, 251, 1]), writer.data)
+        writer.data = b""
+        io.dont_echo_next_cmd = False
+        self.assertEqual(bytes([255, 252, 1]), writer.data)
+
+
+class TestAsyncWsgiServer(unittest.TestCase):
+    def test_request(self):
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            body = environ["wsgi.input"].read()
+            return [environ["REQUEST_METHOD"].encode(), b" ", environ["PATH_INFO"].encode(), b" ",
+                    environ["QUERY_STRING"].encode(), b" ", environ["HTTP_X_TEST"].encode(), b" ", body]
+
+        async def client():
+            server = mud_async_io.AsyncWsgiServer(app, "127.0.0.1", 0)
+            await server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.server_address[1])
+            writer.write(b"POST /tale/some%20path?a=1 HTTP/1.1\r\nX-Test: hi\r\nContent-Length: 4\r\n\r\nbody")
+            writer.write(b"GET /x HTTP/1.1\r\nX-Test: again\r\nConnection: close\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            server.close()
+            return response
+
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(client())
+        finally:
+            loop.close()
+        first, second = response.split(b"HTTP/1.1 200 OK")[1:]
+        self.assertIn(b"Connection: keep-alive", first)
+        self.assertTrue(first.endswith(b"\r\n\r\nPOST /tale/some path a=1 hi body"))
+        self.assertIn(b"Connection: close", second)
+        self.assertTrue(second.endswith(b"\r\n\r\nGET /x  again "))
+
+
+
+class TestAsyncHttpIo(unittest.TestCase):
+    def test_notify_from_other_thread(self):
+        async def wait(io):
+            threading.Thread(target=io.notify_html_available).start()
+            await io.wait_html_available_async(timeout=5)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            io = mud_async_io.AsyncMudHttpIo(None)
+            start = loop.time()
+            loop.run_until_complete(wait(io))
+            self.assertLess(loop.time() - start, 4)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        io.notify_html_available()   # doesn't fail when the loop is already closed
+
+
+if __name__ == '__main__':
+    unittest.main()
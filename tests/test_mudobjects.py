@@ -239,6 +239,21 @@ class TestLocations(unittest.TestCase):
         all_verbs = mud_context.driver.current_verbs(player)
         self.assertEqual({"xywobble", "snakeverb", "frobnitz", "kowabooga", "boxverb", "exitverb"}, set(custom_verbs))
         self.assertEqual(set(), set(custom_verbs) - set(all_verbs))
+        self.assertIs(custom_verbs, mud_context.driver.current_custom_verbs(player), "should be cached")
+        with self.assertRaises(TypeError):
+            custom_verbs["xywobble"] = "changed"
+        # changes in the verbs themselves are seen directly, changes in the contents invalidate the cache
+        monster.verbs["snakeverb2"] = "s2"
+        self.assertIn("snakeverb2", custom_verbs)
+        room.remove(chair1, None)
+        custom_verbs = mud_context.driver.current_custom_verbs(player)
+        self.assertEqual("c2", custom_verbs["frobnitz"])
+        room.remove(chair2, None)
+        self.assertNotIn("frobnitz", mud_context.driver.current_custom_verbs(player))
+        player.remove(box_in_inventory, player)
+        self.assertNotIn("boxverb", mud_context.driver.current_custom_verbs(player))
+        player.insert(chair1, player)
+        self.assertIn("frobnitz", mud_context.driver.current_custom_verbs(player))
 
     def test_notify(self):
         room = Location("room")
@@ -1196,6 +1211,35 @@ class TestItem(unittest.TestCase):
         with self.assertRaises(ValueError):
             item2.clone()   # can't clone something with stuff in it
 
+    def test_clone_shares_descriptions(self):
+        hall = Location("hall")
+        item = Item("thing", "strange thing", descr="a very strange thing")
+        item.add_extradesc({"marks"}, "scratch marks")
+        item.aliases = frozenset({"strange"})
+        item.location = hall
+        item2 = item.clone()
+        self.assertNotEqual(item.vnum, item2.vnum)
+        self.assertIs(item2, MudObjRegistry.all_items[item2.vnum])
+        self.assertIs(item.description, item2.description)
+        self.assertIs(item.extra_desc, item2.extra_desc)
+        self.assertIs(item.aliases, item2.aliases)
+        self.assertIs(hall, item2.location)
+        self.assertIsNot(item.verbs, item2.verbs)
+        item2.add_extradesc({"dust"}, "lots of dust")    # copy-on-write
+        self.assertEqual({"marks", "dust"}, set(item2.extra_desc))
+        self.assertEqual({"marks"}, set(item.extra_desc))
+        item.add_extradesc({"glow"}, "it glows")
+        self.assertEqual({"marks", "glow"}, set(item.extra_desc))
+        self.assertEqual({"marks", "dust"}, set(item2.extra_desc))
+        item2.aliases |= {"odd"}
+        self.assertEqual({"strange"}, item.aliases)
+        item3 = Item("thing")
+        item3.share_descriptions(item)
+        self.assertEqual("strange thing", item3.title)
+        self.assertIs(item.extra_desc, item3.extra_desc)
+        item3.title = "odd thing"
+        self.assertEqual("strange thing", item.title)
+
     def test_combine_default(self):
         actor = Living("person", "m", race="human")
         thing = Item("thing")
@@ -5,6 +5,7 @@ Unittests for Mud base objects
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
 
+import hashlib
 import pathlib
 import sys
 import tempfile
@@ -296,6 +297,29 @@ class TestPlayer(unittest.TestCase):
         attic.tell("message for room")
         self.assertEqual(["message for room\n"], player.test_get_output_paragraphs())
 
+    def test_wiretap_lazy(self):
+        attic = Location("Attic", "A dark attic.")
+        julie = Living("julie", "f")
+        julie.move(attic)
+        topicname = ("wiretap-living", "julie#%d" % julie.vnum)
+        julie.tell("message for julie")
+        attic.tell("message for room")
+        self.assertNotIn(topicname, pubsub.all_topics, "no wiretap topic should be created when nobody taps")
+        player = Player("fritz", "m")
+        player.privileges = {"wizard"}
+        player.create_wiretap(julie)
+        tap = pubsub.all_topics[topicname]
+        julie.tell("message for julie")
+        self.assertEqual([("julie", "message for julie")], tap.events)
+        player.clear_wiretaps()
+        tap.destroy()
+        julie.tell("message for julie")
+        self.assertIsNone(julie._wiretap)
+        self.assertNotIn(topicname, pubsub.all_topics)
+        player.create_wiretap(julie)
+        self.assertIsNot(tap, julie.get_wiretap())
+        self.assertIn(topicname, pubsub.all_topics)
+
     def test_socialize(self):
         player = Player("fritz", "m")
         attic = Location("Attic", "A dark attic.")
@@ -532,6 +556,16 @@ class TestPlayerConnection(unittest.TestCase):
 
 
 class TestTextbuffer(unittest.TestCase):
+    def test_bool(self):
+        output = TextBuffer()
+        self.assertFalse(output)
+        output.print("")
+        self.assertFalse(output)
+        output.print("line")
+        self.assertTrue(output)
+        output.get_paragraphs()
+        self.assertFalse(output)
+
     def test_empty_lines(self):
         output = TextBuffer()
         output.print("")
@@ -752,6 +786,48 @@ class TestMudAccounts(unittest.TestCase):
         self.assertEqual(pw, pw2)
         self.assertEqual(salt, salt2)
 
+    def test_kdf(self):
+        pw, salt = MudAccounts._pwhash("secret")
+        self.assertTrue(pw.startswith("pbkdf2$100000$"))
+        self.assertTrue(MudAccounts._verify_pwhash("secret", pw, salt))
+        self.assertFalse(MudAccounts._verify_pwhash("secret2", pw, salt))
+        legacy_pw, legacy_salt = MudAccounts._pwhash("secret", kdf="sha1")
+        self.assertNotIn("$", legacy_pw)
+        self.assertTrue(MudAccounts._verify_pwhash("secret", legacy_pw, legacy_salt))
+        self.assertFalse(MudAccounts._verify_pwhash("secret2", legacy_pw, legacy_salt))
+        with self.assertRaises(ValueError):
+            MudAccounts._pwhash("secret", kdf="rot13")
+        with self.assertRaises(ValueError):
+            MudAccounts(":memory:", kdf="rot13")
+        if hasattr(hashlib, "scrypt"):
+            pw, salt = MudAccounts._pwhash("secret", kdf="scrypt")
+            self.assertTrue(pw.startswith("scrypt$16384$8$1$"))
+            self.assertTrue(MudAccounts._verify_pwhash("secret", pw, salt))
+
+    def test_rehash(self):
+        accounts = MudAccounts(":memory:", workers=2)
+        try:
+            accounts.create("testname", "s3cr3t", "test@invalid", Stats.from_race("elf", gender='f'))
+            legacy_pw, legacy_salt = MudAccounts._pwhash("s3cr3t", kdf="sha1")
+            with accounts._transaction() as conn:
+                accounts._invalidate("testname")
+                conn.execute("UPDATE Account SET pw_hash=?, pw_salt=? WHERE name=?", (legacy_pw, legacy_salt, "testname"))
+            account = accounts.get("testname")
+            self.assertTrue(accounts.needs_rehash(account))
+            accounts.submit(accounts.check_password, account, "s3cr3t").result()
+            with self.assertRaises(ValueError):
+                accounts.submit(accounts.check_password, account, "wrong").result()
+            accounts.submit(accounts.rehash_password, "testname", "s3cr3t").result()
+            account = accounts.get("testname")
+            self.assertFalse(accounts.needs_rehash(account))
+            accounts.check_password(account, "s3cr3t")
+        finally:
+            accounts.close()
+        accounts = MudAccounts(":memory:")
+        self.assertIsNone(accounts.pool)
+        self.assertEqual(3, accounts.submit(len, "abc").result(), "without workers the job is done right away")
+        accounts.close()
+
     def test_accountcreate_fail(self):
         stats = Stats()  # uninitialized stats
         accounts = MudAccounts(":memory:")
@@ -782,6 +858,7 @@ class TestMudAccounts(unittest.TestCase):
             account = accounts.get("testname")
             self.assertFalse(account.banned)
         finally:
+            accounts.close()
             dbfile.unlink()
 
     def test_dbcreate(self):
@@ -803,6 +880,7 @@ class TestMudAccounts(unittest.TestCase):
             self.assertEqual(races.BodySize.HUMAN_SIZED, account.stats.size)
             self.assertEqual("Edhellen", account.stats.language)
         finally:
+            accounts.close()
             dbfile.unlink()
 
     def test_storydata(self):
@@ -820,8 +898,82 @@ class TestMudAccounts(unittest.TestCase):
             account = accounts.get("testname")
             self.assertEqual({"test": 42, "thing": [1.2, 3.4]}, account.story_data)
         finally:
+            accounts.close()
             dbfile.unlink()
 
+    def test_queries(self):
+        accounts = MudAccounts(":memory:")   # the connection stays open, so this is the same database all the time
+        try:
+            accounts.create("zelda", "s3cr3t", "zelda@invalid", Stats.from_race("elf", gender='f'), {"wizard"})
+            accounts.create("bob", "s3cr3t2", "bob@invalid", Stats.from_race("human", gender='m'))
+            accounts.save_story_data("bob", {"quest": 1})
+            accounts.save_story_data("bob", {"quest": 2})
+            with self.assertRaises(LookupError):
+                accounts.save_story_data("nobody", {})
+            with self.assertRaises(LookupError):
+                accounts.get("nobody")
+            self.assertEqual(["bob", "zelda"], [acc.name for acc in accounts.all_accounts()])
+            self.assertEqual(["zelda"], [acc.name for acc in accounts.all_accounts(having_privilege="wizard")])
+            bob = accounts.get("bob")
+            self.assertEqual(set(), bob.privileges)
+            self.assertEqual({"quest": 2}, bob.story_data)
+            self.assertEqual("m", bob.stats.gender)
+            self.assertEqual("human", bob.stats.race)
+            accounts.check_password(bob, "s3cr3t2")
+            with self.assertRaises(ValueError):
+                accounts.check_password(bob, "s3cr3t")
+            accounts.valid_password("zelda", "s3cr3t")
+            accounts.logged_in("zelda")
+            self.assertIsNotNone(accounts.get("zelda").logged_in)
+        finally:
+            accounts.close()
+
+
+    def test_cache(self):
+        accounts = MudAccounts(":memory:")
+        wizard = Living("wizz", gender="f")
+        wizard.privileges.add("wizard")
+        try:
+            accounts.cache_size = 2
+            for name in ("anne", "bob", "carl"):
+                accounts.create(name, "s3cr3t", name + "@invalid", Stats.from_race("human", gender='f'))
+            anne = accounts.get("anne")
+            anne.stats.hp = 999
+            anne.story_data["x"] = 1
+            anne2 = accounts.get("anne")
+            self.assertIsNot(anne, anne2, "callers get a copy of the cached account")
+            self.assertNotEqual(999, anne2.stats.hp)
+            self.assertEqual({}, anne2.story_data)
+            self.assertEqual({"size": 1, "max_size": 2, "hits": 1, "misses": 1}, accounts.cache_stats())
+            accounts.get("bob")
+            accounts.get("anne")
+            accounts.get("carl")    # bob was used least recently
+            self.assertEqual(["anne", "carl"], list(accounts.cache))
+            accounts.ban("anne", wizard)
+            self.assertNotIn("anne", accounts.cache)
+            self.assertTrue(accounts.get("anne").banned)
+            accounts.update_privileges("anne", {"wizard"}, wizard)
+            self.assertEqual({"wizard"}, accounts.get("anne").privileges)
+            accounts.save_story_data("anne", {"x": 1})
+            self.assertEqual({"x": 1}, accounts.get("anne").story_data)
+            accounts.change_password_email("anne", "s3cr3t", new_email="anne@other")
+            self.assertEqual("anne@other", accounts.get("anne").email)
+            accounts.valid_password("anne", "s3cr3t")
+            # the list of all accounts is cached as well, until an account changes
+            self.assertEqual(3, len(accounts.all_accounts()))
+            hits = accounts.cache_hits
+            self.assertEqual(["anne"], [acc.name for acc in accounts.all_accounts(having_privilege="wizard")])
+            self.assertEqual(hits + 1, accounts.cache_hits)
+            accounts.create("dave", "s3cr3t", "dave@invalid", Stats.from_race("human", gender='m'))
+            self.assertEqual(4, len(accounts.all_accounts()))
+            accounts.unban("anne", wizard)
+            self.assertFalse(accounts.all_accounts()[0].banned)
+            accounts.all_accounts()[0].privileges.add("god")
+            self.assertEqual({"wizard"}, accounts.all_accounts()[0].privileges)
+        finally:
+            accounts.close()
+
+
 
 class WrappedConsoleIO(ConsoleIo):
     def __init__(self, connection: PlayerConnection) -> None:
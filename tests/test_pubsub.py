@@ -9,7 +9,8 @@ import gc
 import time
 import unittest
 
-from tale.pubsub import topic, unsubscribe_all, Listener, sync, pending
+from tale import pubsub
+from tale.pubsub import topic, unsubscribe_all, Listener, sync, pending, destroy_idle_topics
 
 
 class Subber(Listener):
@@ -186,6 +187,72 @@ class TestPubsub(unittest.TestCase):
         s.send("event")
         self.assertLess(s.idle_time, 0.1)
 
+    def test_no_subscribers(self):
+        sync()
+        s = topic("testnosubs")
+        self.assertIsNone(s.send("event"))
+        self.assertEqual([], s.send("event", True))
+        self.assertEqual([], s.events)
+        self.assertFalse(s.dirty)
+        subber = Subber("sub1")
+        s.subscribe(subber)
+        self.assertEqual(1, len(s.subscribers))
+        del subber
+        gc.collect()
+        self.assertEqual(0, len(s.subscribers), "dead subscribers should be removed")
+
+    def test_sync_dirty_topics_in_order(self):
+        sync()
+
+        class Forwarder(Subber):
+            def pubsub_event(self, topicname, event):
+                super().pubsub_event(topicname, event)
+                for target in self.targets:
+                    target.send(event + "-forwarded")
+
+        first = topic("testorder1")
+        second = topic("testorder2")
+        forwarder = Forwarder("fwd")
+        forwarder.targets = [first, second]
+        first.subscribe(forwarder)
+        second.subscribe(forwarder)
+        first.send("a")
+        self.assertTrue(first.dirty)
+        self.assertFalse(second.dirty)
+        sync()
+        # the event forwarded to the later topic is delivered in the same round, the one to the first topic in the next
+        self.assertEqual([("testorder1", "a"), ("testorder2", "a-forwarded")], forwarder.messages)
+        self.assertEqual(["a-forwarded", "a-forwarded-forwarded"], first.events)
+        self.assertEqual(["a-forwarded-forwarded"], second.events)
+        forwarder.targets = []
+        forwarder.clear()
+        sync()
+        self.assertEqual([("testorder1", "a-forwarded"), ("testorder1", "a-forwarded-forwarded"),
+                          ("testorder2", "a-forwarded-forwarded")], forwarder.messages)
+        self.assertEqual([], first.events)
+        self.assertEqual([], second.events)
+
+    def test_destroy_idle_topics(self):
+        s1 = topic("testexpire1", idle_expiry=0.1)
+        s2 = topic("testexpire2", idle_expiry=0.1)
+        s3 = topic("testexpire3")
+        subber = Subber("sub1")
+        s2.subscribe(subber)
+        destroy_idle_topics()
+        self.assertIn("testexpire1", pubsub.all_topics)
+        time.sleep(0.15)
+        destroy_idle_topics()
+        self.assertTrue(s1.destroyed)
+        self.assertNotIn("testexpire1", pubsub.all_topics)
+        self.assertIn("testexpire2", pubsub.all_topics)
+        self.assertIn("testexpire3", pubsub.all_topics)
+        s2.unsubscribe(subber)
+        time.sleep(0.15)
+        destroy_idle_topics()
+        self.assertTrue(s2.destroyed)
+        self.assertFalse(s3.destroyed)
+        s3.destroy()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,14 +4,17 @@ Unit tests for serialization
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import io
 import os
 import unittest
 import datetime
+import zlib
 
 from tale import mud_context, races, base, player, util, driver
 from tale.items import basic, bank, board
 from tale.story import *
-from tale.savegames import TaleSerializer, TaleDeserializer
+from tale.savegames import TaleSerializer, TaleDeserializer, SavegameWriter, SavegameReader, SavegameLoader, SavegameSnapshot, \
+    find_missing_references
 
 from tests.supportstuff import FakeDriver, Thing
 
@@ -290,6 +293,7 @@ class TestSerializing(unittest.TestCase):
                      driver.Deferred(now, item.init, [], None, periodical=(11.1, 22.2))]
         x1, x2, x3, x4 = serializecycle(deferreds)
         assert x1["__class__"] == "tale.driver.Deferred"
+        assert set(x1) == {"__class__", "due_gametime", "owner", "action", "vargs", "kwargs", "periodical"}
         assert x1["action"] == "append"
         assert x1["vargs"] == [1, 2, 3]
         assert x1["kwargs"] == {"kwarg": 42}
@@ -364,5 +368,156 @@ class TestSerializing(unittest.TestCase):
         assert x["dummy"] == "dummyvalue"
 
 
+class TestIntegrity(unittest.TestCase):
+    def setUp(self):
+        mud_context.driver = FakeDriver()
+        mud_context.config = StoryConfig()
+
+    def test_missing_references(self):
+        room = base.Location("room")
+        hall = base.Location("hall")
+        exit = base.Exit("hall", hall, "to the hall")
+        room.add_exits([exit])
+        julie = player.Player("julie", "f")
+        dog = base.Living("dog", "m")
+        key = base.Item("key")
+        bone = base.Item("bone")
+        coin = base.Item("coin")
+        room.insert(julie, None)
+        hall.insert(dog, None)
+        julie.insert(key, julie)
+        dog.insert(bone, dog)
+        room.insert(coin, None)
+        assert find_missing_references([key, bone, coin], [dog], [room, hall], [exit], julie) == []
+        problems = find_missing_references([coin], [], [room], [], julie)
+        assert [p.split(":")[0] for p in problems] == ["missing item (from player inventory)", "missing exit (from location)"]
+        problems = find_missing_references([key, coin], [dog], [room], [exit], julie)
+        assert [p.split(":")[0] for p in problems] == ["missing item (from living inventory)", "missing location (from livings)"]
+        problems = find_missing_references([key, bone, coin], [], [room, hall], [exit])
+        assert [p.split(":")[0] for p in problems] == ["missing living (from locations)", "missing living (from locations)"]
+        with self.assertRaises(ValueError) as x:
+            TaleSerializer().serialize(None, julie, [coin], [dog], [room], [exit], [], None)
+        assert "missing item (from player inventory)" in str(x.exception)
+        assert "missing location (from livings)" in str(x.exception)
+
+
+class TestStreamingSavegame(unittest.TestCase):
+    def setUp(self):
+        mud_context.driver = FakeDriver()
+        mud_context.config = StoryConfig()
+        mud_context.resources = mud_context.driver.resources
+        self.player = player.Player("julie", "f")
+        self.room = base.Location("room", "description")
+        self.room.insert(self.player, None)
+        self.key = base.Item("key")
+        self.bag = base.Container("bag")
+        self.bag.insert(self.key, None)
+        self.room.insert(self.bag, None)
+        self.dog = base.Living("dog", "m")
+        self.room.insert(self.dog, None)
+        self.clock = util.GameDateTime(datetime.datetime(2020, 1, 1))
+
+    def save(self, writer, items=None):
+        stream = io.BytesIO()
+        items = items or [self.key, self.bag]
+        writer.write(stream, mud_context.config, self.player, items, [self.dog], [self.room], [], [], self.clock)
+        return stream.getvalue()
+
+    def test_records(self):
+        writer = SavegameWriter()
+        data = self.save(writer)
+        assert data.startswith(b"TALESAVE2")
+        assert writer.num_objects == writer.num_written == 5     # 2 items, 2 locations (including limbo), 1 living
+        assert len(writer.digests) == 5
+        records = list(SavegameReader(data).records())
+        kinds = [kind for kind, _ in records]
+        assert kinds == ["story_config", "clock", "items", "items", "locations", "locations", "livings", "player"]
+        items = [literal for kind, literal in records if kind == "items"]
+        assert [i["name"] for i in items] == ["key", "bag"]
+        assert items[1]["inventory"] == {(self.key.vnum, "key", "tale.base.Item", "tale.base.Item")}
+        assert records[-1][1]["name"] == "julie"
+
+    def test_snapshot_is_detached(self):
+        self.key.story_data["notes"] = {"shape": ["round"]}
+        self.dog.stats.hp = 7
+        snapshot = SavegameSnapshot(mud_context.config, self.player, [self.key, self.bag], [self.dog], [self.room], [], [], self.clock)
+        self.key.story_data["notes"]["shape"].append("flat")
+        self.key.story_data["notes"]["color"] = "red"
+        self.dog.stats.hp = 3
+        key_state = next(state for state in snapshot.sections["items"] if state["vnum"] == self.key.vnum)
+        assert key_state["story_data"] == {"notes": {"shape": ["round"]}}
+        dog_state = next(state for state in snapshot.sections["livings"] if state["vnum"] == self.dog.vnum)
+        assert dog_state["stats"]["hp"] == 7
+
+    def test_validate(self):
+        data = self.save(SavegameWriter())
+        SavegameReader(data).validate()
+        damaged = bytearray(data)
+        damaged[len(data) // 2] ^= 0xff
+        with self.assertRaises((ValueError, EOFError, OSError, zlib.error)):
+            SavegameReader(bytes(damaged)).validate()
+        with self.assertRaises((ValueError, EOFError)):
+            SavegameReader(data[:-10]).validate()
+
+    def test_loader(self):
+        self.key.story_data["shape"] = frozenset({"round"})
+        data = self.save(SavegameWriter())
+        # change the world after saving
+        self.bag.remove(self.key, None)
+        self.dog.insert(self.key, self.dog)
+        self.key.story_data.clear()
+        hall = base.Location("hall")
+        self.dog.move(hall)
+        loader = SavegameLoader()
+        julie = loader.load(SavegameReader(data).records())
+        assert julie is loader.player
+        assert julie is not self.player
+        assert julie.name == "julie"
+        assert julie.location is self.room
+        assert self.dog.location is self.room
+        assert self.dog not in hall.livings
+        assert self.key.contained_in is self.bag
+        assert self.key in self.bag.inventory
+        assert self.dog.inventory_size == 0
+        assert self.key.story_data == {"shape": frozenset({"round"})}
+        assert loader.clock.clock == self.clock.clock
+        assert loader.deferreds == []
+
+    def test_oldformat(self):
+        data = TaleSerializer().serialize(mud_context.config, self.player, [self.key, self.bag], [self.dog], [self.room],
+                                          [], [], self.clock)
+        records = list(SavegameReader(data).records())
+        kinds = [kind for kind, _ in records]
+        assert kinds == ["story_config", "clock", "items", "items", "locations", "locations", "livings", "player"]
+        with self.assertRaises(ValueError):
+            SavegameReader(data, delta_data=data)
+
+    def test_delta(self):
+        full_writer = SavegameWriter()
+        full = self.save(full_writer)
+        delta_writer = SavegameWriter(full_writer.save_id, full_writer.digests)
+        self.assertTrue(delta_writer.is_delta)
+        delta = self.save(delta_writer)
+        assert delta_writer.num_objects == 5
+        assert delta_writer.num_written == 0
+        assert list(SavegameReader(full, delta).records()) == list(SavegameReader(full).records())
+        # change the world: the dog gets a name, the key is gone and a new coin is lying around
+        self.dog.aliases.add("fido")
+        self.bag.remove(self.key, None)
+        coin = base.Item("coin")
+        self.room.insert(coin, None)
+        delta_writer = SavegameWriter(full_writer.save_id, full_writer.digests)
+        delta = self.save(delta_writer, items=[self.bag, coin])
+        assert delta_writer.num_written == 4    # bag, coin, room and dog
+        records = list(SavegameReader(full, delta).records())
+        assert records == list(SavegameReader(self.save(SavegameWriter(), items=[self.bag, coin])).records())
+        items = [literal["name"] for kind, literal in records if kind == "items"]
+        assert items == ["bag", "coin"]
+        dog = [literal for kind, literal in records if kind == "livings"][0]
+        assert dog["aliases"] == {"fido"}
+        with self.assertRaises(ValueError):
+            SavegameReader(self.save(SavegameWriter()), delta)
+
+
 if __name__ == '__main__':
     unittest.main()
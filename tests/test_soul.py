@@ -13,6 +13,7 @@ import tale.base
 import tale.errors
 import tale.player
 import tale.verbdefs
+from tale.nameindex import NameIndex
 from tale.story import StoryConfig
 from tests.supportstuff import FakeDriver
 
@@ -482,6 +483,55 @@ class TestSoul(unittest.TestCase):
         result = soul.check_name_with_spaces(["go", "south", "bound", "somewhere", "yes"], 1, livings, items, exits)
         self.assertEqual((exit_south, "south bound somewhere", 3), result)
 
+    def testMatchNameWithSpaces(self) -> None:
+        blue_gem = tale.base.Item("BLUE GEM")
+        dark_crystal = tale.base.Item("DARK RED CRYSTAL")
+        dark = tale.base.Item("DARK")
+        brown_bird = tale.base.Living("BROWN BIRD", "n")
+        livings = NameIndex([tale.base.Living("RAT", "n"), brown_bird])
+        items = NameIndex([tale.base.Item("PAPER"), blue_gem, dark_crystal])
+        soul = tale.base.Soul()
+        result = soul.match_name_with_spaces(["give", "the", "blue", "gem", "to", "rat"], 1, [livings, items])
+        self.assertEqual((None, "", 0), result)
+        result = soul.match_name_with_spaces(["give", "the", "blue", "gem", "to", "rat"], 2, [livings, items])
+        self.assertEqual((blue_gem, "blue gem", 2), result)
+        result = soul.match_name_with_spaces(["give", "the", "dark", "red", "crystal", "to", "rat"], 2, [livings, items])
+        self.assertEqual((dark_crystal, "dark red crystal", 3), result)
+        result = soul.match_name_with_spaces(["give", "the", "dark", "red", "paper", "to", "rat"], 2, [livings, items])
+        self.assertEqual((None, "", 0), result)
+        result = soul.match_name_with_spaces(["give", "paper", "to", "brown", "bird"], 3, [livings, items])
+        self.assertEqual((brown_bird, "brown bird", 2), result)
+        items.add(dark)
+        result = soul.match_name_with_spaces(["give", "the", "dark", "red", "crystal", "to", "rat"], 2, [livings, items])
+        self.assertEqual((dark, "dark", 1), result, "shortest name should match")
+        items.remove(dark)
+        items.remove(dark_crystal)
+        result = soul.match_name_with_spaces(["give", "the", "dark", "red", "crystal", "to", "rat"], 2, [livings, items])
+        self.assertEqual((None, "", 0), result)
+        self.assertEqual({"blue": {"gem": {None: "blue gem"}}, "paper": {None: "paper"}}, items.trie)
+
+    def testNameIndex(self):
+        rat1 = tale.base.Living("rat", "n")
+        rat2 = tale.base.Living("rat", "n")
+        rat2.aliases = {"big rat"}
+        index = NameIndex([rat1])
+        self.assertEqual({"rat"}, set(index))
+        index.add(rat2)
+        self.assertEqual({"rat", "big rat"}, set(index))
+        self.assertIs(rat2, index["rat"])
+        index.remove(rat2)
+        index.remove(rat2)
+        self.assertIs(rat1, index["rat"])
+        self.assertNotIn("big rat", index)
+        room = tale.base.Location("room")
+        room.insert(rat1, None)
+        room.insert(rat2, None)
+        self.assertIs(rat2, room.living_names["big rat"])
+        rat2.move(tale.base.Location("elsewhere"))
+        self.assertNotIn("big rat", room.living_names)
+        room.livings = {rat2}   # direct manipulation of the set is detected
+        self.assertIs(rat2, room.living_names["big rat"])
+
     def testCheckNamesWithSpacesParsing(self):
         soul = tale.base.Soul()
         player = tale.player.Player("julie", "f")
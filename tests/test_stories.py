@@ -4,14 +4,20 @@ Unit tests for demo story
 'Tale' mud driver, mudlib and interactive fiction framework
 Copyright by Irmen de Jong (irmen@razorvine.net)
 """
+import os
 import pathlib
 import sys
+import tempfile
+import time
 import unittest
+from unittest import mock
 
 import tale
 import tale.verbdefs
 from tale import mud_context
 from tale.story import StoryConfig, StoryBase, StoryConfigError
+from tale.util import Context
+from tale.vfs import VirtualFileSystem
 from tests.supportstuff import FakeDriver
 from tale.items.basic import Money
 
@@ -69,6 +75,26 @@ class TestDemoStory(StoryCaseBase, unittest.TestCase):
 class TestCircleStory(StoryCaseBase, unittest.TestCase):
     directory = pathlib.Path("./stories/circle").resolve()
 
+    def init_zones(self):
+        """Initializes the circle zones with temporary user resources. Everything is restored after the test."""
+        import zones
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        driver = mud_context.driver
+        patcher = mock.patch.object(driver, "user_resources", VirtualFileSystem(root_path=tempdir.name, readonly=False), create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        driver_defer = driver.defer
+
+        def defer(*args, **kwargs):
+            deferred = driver_defer(*args, **kwargs)
+            self.addCleanup(deferred.cancel)
+            return deferred
+
+        with mock.patch.object(driver, "defer", defer):
+            zones.init_zones(driver)
+        return zones
+
     def test_story(self):
         import story
         s = story.Story()
@@ -101,6 +127,99 @@ class TestCircleStory(StoryCaseBase, unittest.TestCase):
         self.assertEqual("pile", o.name)
         self.assertEqual(23574.0, o.value, "money object must have value>0")
 
+    def test_world_cache(self):
+        from zones.circledata import world_cache, parse_mob_files, parse_zon_files
+        with tempfile.TemporaryDirectory() as tempdir, \
+                mock.patch.object(world_cache, "prebuilt_cache", os.path.join(tempdir, "no-prebuilt.cache")):
+            user_resources = VirtualFileSystem(root_path=tempdir, readonly=False)
+            self.assertFalse(world_cache.load_world(user_resources), "no cache yet, the world files are parsed")
+            self.assertIn(world_cache.cache_filename, list(user_resources.contents()))
+            num_mobs = len(parse_mob_files._mobs)
+            parse_mob_files._mobs.clear()
+            parse_zon_files._zones.clear()
+            self.assertTrue(world_cache.load_world(user_resources))
+            self.assertEqual(num_mobs, len(parse_mob_files._mobs))
+            self.assertEqual(30, len(parse_zon_files.get_zones()))
+            parse_zon_files._zones.clear()
+            with mock.patch.object(world_cache, "cache_version", world_cache.cache_version + 1):
+                self.assertFalse(world_cache.load_world(user_resources), "the cache is outdated now")
+
+    def test_parallel_parse(self):
+        from zones.circledata import parallel_parse, parse_wld_files, parse_zon_files
+        counts = parallel_parse.parse_world(workers=2)
+        self.assertEqual({"mob": 569, "obj": 679, "shp": 46, "wld": 1878, "zon": 30}, counts)
+        room = parse_wld_files.get_rooms()[3001]
+        zone = parse_zon_files.get_zones()[30]
+        parse_wld_files._rooms.clear()
+        parse_zon_files._zones.clear()
+        self.assertEqual(counts, parallel_parse.parse_world(workers=0))
+        self.assertEqual(vars(room), vars(parse_wld_files.get_rooms()[3001]))
+        self.assertEqual([(mob.vnum, mob.room, mob.max_exist) for mob in zone.mobs],
+                         [(mob.vnum, mob.room, mob.max_exist) for mob in parse_zon_files.get_zones()[30].mobs])
+        self.assertEqual(counts, parallel_parse.parse_world(workers=0), "nothing left to parse")
+
+    def test_lazy_zones(self):
+        zones = self.init_zones()
+        from zones.circledata import circle_locations
+        from zones.circledata.circle_locations import active_zones, converted_rooms, ZoneExit
+        import zones.midgaard_city
+        self.assertEqual({30}, active_zones, "only the zone of the temple is activated")
+        self.assertEqual(3001, zones.midgaard_city.temple.circle_vnum)
+        self.assertTrue(any(loc.livings for loc in converted_rooms.values()), "the zone is populated")
+        entrance = next(xt for loc in converted_rooms.values() for xt in loc.exits.values() if isinstance(xt, ZoneExit))
+        target_zone = circle_locations.rooms[entrance.target_vnum].zone
+        self.assertNotIn(entrance.target_vnum, converted_rooms)
+        self.assertEqual({}, entrance.target.exits, "placeholder target room")
+        entrance.allow_passage(None)
+        self.assertEqual({30, target_zone}, active_zones)
+        self.assertIs(converted_rooms[entrance.target_vnum], entrance.target)
+        self.assertTrue(entrance.target.exits)
+        with mock.patch.object(zones, "zone_idle_time", 0.0):
+            zones.deactivate_idle_zones(Context(mud_context.driver, None, None, None))
+        self.assertEqual({30}, active_zones, "the idle zone is deactivated, the permanent zone of the temple isn't")
+        self.assertNotIn(entrance.target_vnum, converted_rooms)
+        self.assertEqual({}, entrance.target.exits)
+
+    def test_zone_reset(self):
+        zones = self.init_zones()
+        from zones.circledata.circle_locations import converted_rooms
+        import zones.midgaard_city
+        ctx = Context(mud_context.driver, None, None, None)
+        midgaard = zones.get_zones()[30]
+        mobref = next(mobref for mobref in midgaard.mobs if mobref.max_exist == 1)
+        mob = next(iter(zones.live_mobs[mobref.vnum]))
+        self.assertIs(converted_rooms[mobref.room], mob.location)
+        mob.destroy(ctx)
+        self.assertEqual(0, zones.live_mob_count(mobref.vnum))
+        for _ in range(3):
+            zones.zone_resets_due[30] = 0
+            zones.pulse_zone(ctx)
+            self.assertEqual([], list(zones.reset_queue)[1:], "one zone reset in progress")
+            while zones.reset_queue:
+                zones.pulse_zone(ctx)
+            self.assertEqual(1, zones.live_mob_count(mobref.vnum), "respawned, but not more than max_exist")
+        self.assertEqual(3, zones.num_zone_resets[30])
+        self.assertGreater(zones.zone_resets_due[30], time.time() + midgaard.lifespan_minutes * 60 - 10)
+        for mobref in midgaard.mobs:
+            self.assertLessEqual(zones.live_mob_count(mobref.vnum), mobref.max_exist)
+
+    def test_prototypes(self):
+        self.init_zones()
+        from zones.circledata.circle_items import make_item, item_prototypes
+        from zones.circledata.circle_mobs import make_mob
+        bread1, bread2 = make_item(3010), make_item(3010)
+        self.assertIsNot(bread1, bread2)
+        self.assertIsNot(item_prototypes[3010], bread1)
+        self.assertEqual(3010, bread2.circle_vnum)
+        self.assertIs(bread1.description, bread2.description)
+        self.assertIs(bread1.aliases, bread2.aliases)
+        self.assertIs(bread1.extra_desc, bread2.extra_desc)
+        mob1, mob2 = make_mob(3060), make_mob(3060)
+        self.assertEqual(mob1.title, mob2.title)
+        self.assertIs(mob1.description, mob2.description)
+        self.assertIs(mob1.aliases, mob2.aliases)
+        self.assertIsNot(mob1.stats, mob2.stats)
+
 
 class TestBuiltinDemoStory(StoryCaseBase, unittest.TestCase):
     directory = pathlib.Path("demo-story-dummy-path")
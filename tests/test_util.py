@@ -455,6 +455,18 @@ class TestVfs(unittest.TestCase):
         self.assertEqual("overwrittenappended", vfs["unittest.txt"].text)
         del vfs["unittest.txt"]
 
+    def test_vfs_replace(self):
+        vfs = VirtualFileSystem(root_path=".", readonly=False)
+        vfs["unittest.txt"] = "old"
+        vfs["unittest.txt.tmp"] = b"new"
+        vfs.replace("unittest.txt.tmp", "unittest.txt")
+        self.assertEqual("new", vfs["unittest.txt"].text)
+        with self.assertRaises(FileNotFoundError):
+            _ = vfs["unittest.txt.tmp"]
+        del vfs["unittest.txt"]
+        with self.assertRaises(VfsError):
+            VirtualFileSystem(root_path=".", readonly=True).replace("unittest.txt.tmp", "unittest.txt")
+
     def test_vfs_read_files(self):
         vfs = VirtualFileSystem(root_path=".", readonly=True)
         # text file